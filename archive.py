@@ -0,0 +1,528 @@
+"""Imports quotes from chat exports, and exports quotes as NDJSON.
+
+Telegram Desktop exports (Export chat history → JSON) are read as a stream, so
+memory use doesn't grow with the size of the export:
+
+    python3 archive.py import result.json
+    python3 archive.py import result.json --all --chat-id -1001234567890
+    python3 archive.py export --chat-id -1001234567890 > quotes.ndjson
+    python3 archive.py import quotes.ndjson
+
+By default, the quotes in a Telegram export are the messages that someone
+replied to with /addquote, as if the bot had seen them. With --all, every
+text message is imported as a quote.
+
+NDJSON files have one quote per line, along with its chat and users, and can
+be imported into another database as they are."""
+import argparse
+import json
+import sys
+import time
+from datetime import datetime
+
+from classes import Chat, User
+from database import QuoteDatabase
+
+
+# Number of quotes inserted in each transaction
+BATCH_SIZE = 20000
+
+# Size of the chunks the export is read in
+CHUNK_SIZE = 1 << 16
+
+WHITESPACE = ' \t\r\n'
+
+# Telegram export chat types, and the Bot API chat types they correspond to
+CHAT_TYPES = {
+    'personal_chat': 'private',
+    'bot_chat': 'private',
+    'saved_messages': 'private',
+    'private_group': 'group',
+    'private_supergroup': 'supergroup',
+    'public_supergroup': 'supergroup',
+    'private_channel': 'channel',
+    'public_channel': 'channel',
+}
+
+# Entity types that are named differently in exports than in the Bot API
+ENTITY_TYPES = {
+    'mention_name': 'text_mention',
+    'link': 'url',
+}
+
+
+class ExportError(Exception):
+    pass
+
+
+# Streaming JSON
+
+class JSONStream:
+    """Reads JSON values one at a time from a file, without loading the rest
+    of the file."""
+
+    def __init__(self, f):
+        self.f = f
+        self.buffer = ''
+        self.position = 0
+        self.discarded = 0
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        """Reads another chunk into the buffer. Returns False at the end of
+        the file."""
+        chunk = self.f.read(CHUNK_SIZE)
+        if not chunk:
+            return False
+
+        self.discarded += self.position
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def tell(self):
+        """Returns the number of characters read so far."""
+        return self.discarded + self.position
+
+    def peek(self):
+        """Returns the next character that isn't whitespace, or '' at the
+        end of the file."""
+        while True:
+            while self.position < len(self.buffer):
+                if self.buffer[self.position] not in WHITESPACE:
+                    return self.buffer[self.position]
+                self.position += 1
+
+            if not self._fill():
+                return ''
+
+    def expect(self, character):
+        if self.peek() != character:
+            raise ExportError("expected {0!r} at {1!r}".format(
+                character, self.buffer[self.position:self.position + 20]))
+
+        self.position += 1
+
+    def value(self):
+        """Decodes the next value."""
+        self.peek()
+
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(
+                    self.buffer, self.position)
+            except json.JSONDecodeError:
+                # The value may continue past the end of the buffer
+                if not self._fill():
+                    raise
+                continue
+
+            # Numbers and literals at the end of the buffer may be cut off
+            if end == len(self.buffer) and self._fill():
+                continue
+
+            self.position = end
+            return value
+
+    def items(self):
+        """Yields the keys of the object that starts at the current position,
+        leaving the position at each key's value. Values that aren't read
+        by the caller are skipped."""
+        self.expect('{')
+
+        while self.peek() != '}':
+            key = self.value()
+            self.expect(':')
+
+            start = self.tell()
+            yield key
+
+            if self.tell() == start:
+                self.skip()
+
+            if self.peek() == ',':
+                self.position += 1
+
+        self.position += 1
+
+    def elements(self):
+        """Yields the elements of the array that starts at the current
+        position."""
+        self.expect('[')
+
+        while self.peek() != ']':
+            yield self.value()
+
+            if self.peek() == ',':
+                self.position += 1
+
+        self.position += 1
+
+    def skip(self):
+        """Skips the next value. Arrays are skipped one element at a time."""
+        if self.peek() == '[':
+            for _ in self.elements():
+                pass
+        else:
+            self.value()
+
+
+# Telegram exports
+
+def chat_id_from_export(export_type, export_id):
+    """Converts the ID of a chat in an export to the chat's Bot API ID."""
+    chat_type = CHAT_TYPES.get(export_type, 'supergroup')
+
+    if chat_type in ('supergroup', 'channel'):
+        return -(10 ** 12 + export_id)
+    elif chat_type == 'group':
+        return -export_id
+    else:
+        return export_id
+
+
+def user_id_from_export(from_id):
+    """Returns the user ID in a from_id field such as "user1234", or None if
+    the message wasn't sent by a user."""
+    if isinstance(from_id, int):
+        return from_id
+
+    if not from_id or not from_id.startswith('user'):
+        return None
+
+    return int(from_id[len('user'):])
+
+
+def utf16_length(text):
+    return len(text.encode('utf-16-le')) // 2
+
+
+def text_and_entities(message):
+    """Returns the message's text and its entities in the Bot API format.
+    Exports list the text as parts, which are plain strings or entities."""
+    parts = message.get('text_entities')
+    if parts is None:
+        parts = message.get('text', '')
+        if isinstance(parts, str):
+            parts = [parts]
+
+    text = []
+    entities = []
+    offset = 0
+
+    for part in parts:
+        if isinstance(part, str):
+            part = {'type': 'plain', 'text': part}
+
+        part_text = part.get('text', '')
+        length = utf16_length(part_text)
+
+        if part['type'] != 'plain' and length > 0:
+            entity = {'type': ENTITY_TYPES.get(part['type'], part['type']),
+                'offset': offset, 'length': length}
+
+            if 'href' in part:
+                entity['url'] = part['href']
+            if 'user_id' in part:
+                entity['user'] = {'id': part['user_id']}
+            if part['type'] == 'pre' and part.get('language'):
+                entity['language'] = part['language']
+
+            entities.append(entity)
+
+        text.append(part_text)
+        offset += length
+
+    return ''.join(text), entities
+
+
+def sent_at(message):
+    if 'date_unixtime' in message:
+        return int(message['date_unixtime'])
+
+    # Older exports only have the date in local time
+    return int(datetime.strptime(
+        message['date'], '%Y-%m-%dT%H:%M:%S').timestamp())
+
+
+def user_from_message(message):
+    user_id = user_id_from_export(message.get('from_id'))
+    if user_id is None:
+        return None
+
+    # Exports only have display names, so the whole name is the first name
+    return User(user_id, message.get('from') or 'Deleted Account')
+
+
+def is_addquote(text, username):
+    """Returns whether the text is an /addquote command."""
+    command = text.split(maxsplit=1)[0].lower() if text.strip() else ''
+
+    if command == '/addquote':
+        return True
+
+    return username is not None and command == '/addquote@' + username
+
+
+def read_chat(f):
+    """Returns the type, ID and name of the chat in an export, reading the
+    file until the messages. Exports list them first."""
+    stream = JSONStream(f)
+    info = dict()
+
+    for key in stream.items():
+        if key == 'messages':
+            return info, stream
+
+        if key in ('type', 'id', 'name'):
+            info[key] = stream.value()
+
+    raise ExportError("no messages in export")
+
+
+def messages(filename):
+    """Yields the chat info and then each message in an export."""
+    with open(filename, 'r', encoding='utf8') as f:
+        info, stream = read_chat(f)
+        yield info
+
+        for message in stream.elements():
+            if message.get('type') == 'message':
+                yield message
+
+
+def find_addquotes(filename, username):
+    """Returns the IDs of the messages that were replied to with /addquote,
+    mapped to the user who added each one."""
+    added = dict()
+
+    stream = messages(filename)
+    next(stream)
+
+    for message in stream:
+        target = message.get('reply_to_message_id')
+        if target is None or target in added:
+            continue
+
+        text, _ = text_and_entities(message)
+        if is_addquote(text, username):
+            added[target] = user_from_message(message)
+
+    return added
+
+
+def import_export(database, filename, chat_id=None, include_all=False,
+        username=None):
+    """Imports quotes from a Telegram export. Returns the number of quotes
+    read and inserted."""
+    # Reading the export twice keeps memory use down to the added messages,
+    # instead of every message that could be replied to
+    added = None if include_all else find_addquotes(filename, username)
+
+    stream = messages(filename)
+    info = next(stream)
+
+    if chat_id is None:
+        if 'id' not in info:
+            raise ExportError("the export has no chat ID; use --chat-id")
+        chat_id = chat_id_from_export(info.get('type'), info['id'])
+
+    chat = Chat(chat_id, CHAT_TYPES.get(info.get('type'), 'supergroup'),
+        info.get('name'))
+
+    users = dict()
+    quotes = []
+    read = inserted = 0
+
+    for message in stream:
+        message_id = message['id']
+
+        if added is None:
+            quoted_by = None
+        elif message_id in added:
+            quoted_by = added[message_id]
+        else:
+            continue
+
+        sender = user_from_message(message)
+        text, entities = text_and_entities(message)
+        if sender is None or not text:
+            continue
+
+        # Users can't quote their own messages
+        if quoted_by is not None and quoted_by.id == sender.id:
+            continue
+
+        users[sender.id] = sender
+        if quoted_by is not None:
+            users[quoted_by.id] = quoted_by
+
+        quotes.append((message_id, sent_at(message), sender.id, text,
+            entities, quoted_by and quoted_by.id))
+
+        if len(quotes) == BATCH_SIZE:
+            read += len(quotes)
+            inserted += database.import_quotes(chat, users.values(), quotes)
+            users.clear()
+            quotes.clear()
+
+    read += len(quotes)
+    inserted += database.import_quotes(chat, users.values(), quotes)
+
+    return read, inserted
+
+
+# NDJSON
+
+def user_to_json(user):
+    if user is None:
+        return None
+
+    return {'id': user.id, 'first_name': user.first_name,
+        'last_name': user.last_name, 'username': user.username}
+
+
+def user_from_json(user):
+    if user is None:
+        return None
+
+    return User(user['id'], user['first_name'], user.get('last_name'),
+        user.get('username'))
+
+
+def export_ndjson(database, f, chat_id=None):
+    """Writes quotes to a file, one JSON object per line. Returns the number
+    of quotes written."""
+    count = 0
+
+    for quote, chat, sender, adder in database.export_quotes(chat_id):
+        line = {
+            'chat': None if chat is None else {'id': chat.id,
+                'type': chat.type, 'title': chat.title,
+                'username': chat.username},
+            'message_id': quote.message_id,
+            'sent_at': quote.sent_at,
+            'sent_by': user_to_json(sender),
+            'quoted_by': user_to_json(adder),
+            # Quotes added before the raw text was kept only have content
+            'text': quote.text if quote.text is not None else quote.content,
+            'entities': quote.entities or [],
+        }
+
+        f.write(json.dumps(line, ensure_ascii=False) + '\n')
+        count += 1
+
+    return count
+
+
+def import_ndjson(database, filename, chat_id=None):
+    """Imports quotes written by export_ndjson. Returns the number of quotes
+    read and inserted."""
+    batches = dict()
+    read = inserted = 0
+
+    def write(batch):
+        chat, users, quotes = batch
+        count = database.import_quotes(chat, users.values(), quotes)
+        users.clear()
+        quotes.clear()
+        return count
+
+    with open(filename, 'r', encoding='utf8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+
+            line = json.loads(line)
+            chat = line['chat']
+            chat = Chat(chat['id'] if chat_id is None else chat_id,
+                chat['type'], chat.get('title'), chat.get('username'))
+
+            sender = user_from_json(line['sent_by'])
+            adder = user_from_json(line['quoted_by'])
+            if sender is None:
+                continue
+
+            batch = batches.get(chat.id)
+            if batch is None:
+                batch = batches[chat.id] = (chat, dict(), [])
+
+            _, users, quotes = batch
+            users[sender.id] = sender
+            if adder is not None:
+                users[adder.id] = adder
+
+            quotes.append((line['message_id'], line['sent_at'], sender.id,
+                line['text'], line['entities'], adder and adder.id))
+            read += 1
+
+            if len(quotes) == BATCH_SIZE:
+                inserted += write(batch)
+
+    for batch in batches.values():
+        inserted += write(batch)
+
+    return read, inserted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', default='data.db')
+    parser.add_argument('--shards', type=int, default=1,
+        help="number of shards that the bot uses")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    importer = commands.add_parser('import',
+        help="import a Telegram export (result.json) or an NDJSON file")
+    importer.add_argument('filename')
+    importer.add_argument('--chat-id', type=int,
+        help="ID of the chat to import into, as the bot sees it")
+    importer.add_argument('--all', action='store_true',
+        help="import every text message, not just the ones added with "
+        "/addquote")
+    importer.add_argument('--username',
+        help="the bot's username, to recognize /addquote@username")
+
+    exporter = commands.add_parser('export', help="export quotes as NDJSON")
+    exporter.add_argument('--chat-id', type=int,
+        help="only export quotes from this chat")
+    exporter.add_argument('--output', help="file to write to, or stdout")
+
+    args = parser.parse_args()
+
+    database = QuoteDatabase(args.database, write_behind=False,
+        online=False, shards=args.shards)
+    start = time.perf_counter()
+
+    try:
+        if args.command == 'import':
+            if args.filename.endswith(('.ndjson', '.jsonl')):
+                read, inserted = import_ndjson(
+                    database, args.filename, args.chat_id)
+            else:
+                username = args.username and args.username.lstrip('@').lower()
+                read, inserted = import_export(database, args.filename,
+                    args.chat_id, args.all, username)
+
+            print("imported {0} of {1} quotes in {2:.1f} s".format(
+                inserted, read, time.perf_counter() - start), file=sys.stderr)
+        else:
+            if args.output:
+                with open(args.output, 'w', encoding='utf8') as f:
+                    count = export_ndjson(database, f, args.chat_id)
+            else:
+                count = export_ndjson(database, sys.stdout, args.chat_id)
+
+            print("exported {0} quotes in {1:.1f} s".format(
+                count, time.perf_counter() - start), file=sys.stderr)
+    except ExportError as e:
+        print("error: {0}".format(e), file=sys.stderr)
+        return 1
+    finally:
+        database.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
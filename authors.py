@@ -0,0 +1,200 @@
+import threading
+import unicodedata
+from collections import OrderedDict, namedtuple
+
+
+# How well a name matches a search, from worst to best
+FUZZY, SUBSTRING, PREFIX, EXACT = range(1, 5)
+
+# The minimum share of trigrams that a word in a fuzzy match has in common
+# with the search (as a Dice coefficient)
+FUZZY_THRESHOLD = 0.4
+
+# A user's normalized names, the words in them, and each word's trigrams
+Names = namedtuple('Names', ['fields', 'words', 'word_grams'])
+
+
+def normalize(text):
+    """Lowercases text and strips accents and extra whitespace, so that
+    "Zoë  Smith" matches "zoe smith"."""
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return ' '.join(text.casefold().split())
+
+
+def trigrams(text):
+    padded = ' {0} '.format(text)
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def names_of(user):
+    first = normalize(user.first_name)
+    full = normalize('{0} {1}'.format(user.first_name, user.last_name or ''))
+    username = normalize(user.username)
+
+    fields = tuple(field for field in (username, first, full) if field)
+    words = tuple(word for word in full.split() + [username] if word)
+    return Names(fields, words, tuple(trigrams(word) for word in words))
+
+
+def match(names, search, grams):
+    """Returns how well a user's names match a normalized search, as a
+    (rank, similarity) pair, or None if they don't match. The similarity is
+    that of the closest word in the names."""
+    similarity = max((2 * len(word & grams) / (len(word) + len(grams))
+        for word in names.word_grams), default=0)
+
+    if search in names.fields:
+        rank = EXACT
+    elif any(word.startswith(search) for word in names.words) \
+            or any(field.startswith(search) for field in names.fields):
+        rank = PREFIX
+    elif any(search in field for field in names.fields):
+        rank = SUBSTRING
+    elif similarity >= FUZZY_THRESHOLD:
+        rank = FUZZY
+    else:
+        return None
+
+    return rank, similarity
+
+
+class AuthorIndex:
+    """Finds the users who have quotes in a chat by name, using a per-chat,
+    in-memory index of their names' trigrams, so that /author doesn't scan
+    the chat's quotes.
+
+    Matches are ranked: exact names, then prefixes of names or words in
+    them, then substrings, then names that share most of their trigrams with
+    the search, which catches typos."""
+
+    def __init__(self, load, max_chats=1000):
+        # load(chat_id) returns an iterable of (user, quote count) for the
+        # users who have quotes in the chat
+        self.load = load
+        self.max_chats = max_chats
+
+        # Maps chat IDs to their authors, as {user ID: [quote count, user,
+        # names]}, and to an inverted index of {trigram: {user ID, ...}}
+        self._authors = OrderedDict()
+        self._grams = dict()
+        self._lock = threading.Lock()
+
+    def _get(self, chat_id):
+        authors = self._authors.get(chat_id)
+
+        if authors is None:
+            authors = self._authors[chat_id] = dict()
+            grams = self._grams[chat_id] = dict()
+
+            for user, count in self.load(chat_id):
+                names = names_of(user)
+                authors[user.id] = [count, user, names]
+
+                for gram in set().union(*names.word_grams):
+                    grams.setdefault(gram, set()).add(user.id)
+
+            # Evict the least recently used chat
+            if len(self._authors) > self.max_chats:
+                evicted, _ = self._authors.popitem(last=False)
+                del self._grams[evicted]
+        else:
+            self._authors.move_to_end(chat_id)
+
+        return authors
+
+    def find(self, chat_id, name):
+        """Returns the users in the chat whose names best match the search,
+        as (user, quote count) pairs: one user if a single user matches best,
+        or several, most quoted first, if they match equally well."""
+        search = normalize(name.lstrip('@'))
+        if not search:
+            return []
+
+        grams = trigrams(search)
+
+        with self._lock:
+            authors = self._get(chat_id)
+
+            # Users who share no trigrams with the search can only match as
+            # a substring, if the search is too short to have full trigrams
+            if len(search) < 3:
+                candidates = authors.keys()
+            else:
+                index = self._grams[chat_id]
+                candidates = set().union(
+                    *(index.get(gram, ()) for gram in grams))
+
+            matches = []
+            for user_id in candidates:
+                count, user, names = authors[user_id]
+                result = match(names, search, grams)
+
+                if result is not None:
+                    matches.append((result, count, user))
+
+        if not matches:
+            return []
+
+        best = max(result[0] for result, _, _ in matches)
+
+        # Among fuzzy matches, the closest one is the best
+        if best == FUZZY:
+            closest = max(result[1] for result, _, _ in matches)
+            matches = [m for m in matches if m[0][1] == closest]
+
+        matches = [m for m in matches if m[0][0] == best]
+        matches.sort(key=lambda m: m[1], reverse=True)
+
+        return [(user, count) for _, count, user in matches]
+
+    def count(self, chat_id):
+        """Returns the number of quotes in the chat's index, or None if it
+        isn't loaded."""
+        with self._lock:
+            authors = self._authors.get(chat_id)
+            if authors is None:
+                return None
+
+            return sum(entry[0] for entry in authors.values())
+
+    def add(self, chat_id, user_id):
+        """Counts a new quote by the user in the chat's index, if it's
+        loaded."""
+        with self._lock:
+            authors = self._authors.get(chat_id)
+            if authors is None:
+                return
+
+            entry = authors.get(user_id)
+            if entry is not None:
+                entry[0] += 1
+                return
+
+        # The user's names aren't known here: reload the chat's index
+        self.invalidate(chat_id)
+
+    def update_user(self, user):
+        """Updates a user's names in every index they're in."""
+        names = names_of(user)
+
+        with self._lock:
+            for chat_id, authors in self._authors.items():
+                entry = authors.get(user.id)
+                if entry is None or entry[2] == names:
+                    continue
+
+                grams = self._grams[chat_id]
+                for gram in set().union(*entry[2].word_grams):
+                    grams[gram].discard(user.id)
+                for gram in set().union(*names.word_grams):
+                    grams.setdefault(gram, set()).add(user.id)
+
+                entry[1], entry[2] = user, names
+
+    def invalidate(self, chat_id):
+        """Drops the chat's index, so that it's reloaded on the next
+        search."""
+        with self._lock:
+            self._authors.pop(chat_id, None)
+            self._grams.pop(chat_id, None)
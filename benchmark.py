@@ -0,0 +1,286 @@
+"""Microbenchmarks for QuoteDatabase.
+
+Fills a temporary database with synthetic chats, users and quotes, times each
+public QuoteDatabase method, and prints the results as JSON:
+
+    python3 benchmark.py --quotes 100000 --output results.json
+    python3 benchmark.py --quotes 100000 --baseline results.json
+
+When a baseline is given, methods whose median latency got worse by more than
+the tolerance are listed on stderr, and the exit status is 1."""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import search
+from classes import Chat, User
+from database import QuoteDatabase
+
+
+WORDS = ('soup dumpling quote chat bot message random search stats author '
+    'pork crab ginger broth steam bamboo basket vinegar chili noodle rice '
+    'tea sesame scallion wrapper pleat bite spoon slurp hot cold good bad '
+    'always never maybe today tomorrow yesterday why how what when who').split()
+
+FIRST_NAMES = ('Alice Bob Carol Dave Erin Frank Grace Heidi Ivan Judy Mallory '
+    'Niaj Olivia Peggy Rupert Sybil Trent Victor Walter').split()
+
+
+def generate(database, chats, users, quotes, members, rng):
+    """Fills the database with synthetic data. Quotes are spread across chats
+    with a skewed distribution, so that a few chats are much larger than the
+    rest, like in real deployments."""
+    db = database.db
+
+    db.executemany("INSERT INTO user VALUES (?, ?, ?, ?);", (
+        (user_id, rng.choice(FIRST_NAMES), 'User{0}'.format(user_id),
+            'user{0}'.format(user_id))
+        for user_id in range(1, users + 1)))
+
+    chat_ids = [-(1000 + i) for i in range(chats)]
+    db.executemany("INSERT INTO chat VALUES (?, ?, ?, ?);", (
+        (chat_id, 'supergroup', 'Chat {0}'.format(-chat_id), None)
+        for chat_id in chat_ids))
+
+    chat_members = dict()
+    for chat_id in chat_ids:
+        chat_members[chat_id] = rng.sample(
+            range(1, users + 1), min(members, users))
+
+    db.executemany("INSERT INTO membership (user_id, chat_id) VALUES (?, ?);",
+        ((user_id, chat_id) for chat_id, user_ids in chat_members.items()
+            for user_id in user_ids))
+    db.commit()
+
+    weights = [1 / (rank + 1) for rank in range(chats)]
+    insert = ("INSERT INTO quote (chat_id, message_id, sent_at, sent_by, "
+        "content, quoted_by, text) VALUES (?, ?, ?, ?, ?, ?, ?);")
+
+    def rows():
+        for message_id in range(1, quotes + 1):
+            chat_id = rng.choices(chat_ids, weights)[0]
+            sent_by, quoted_by = rng.sample(chat_members[chat_id], 2)
+            text = ' '.join(rng.choices(WORDS, k=rng.randint(3, 20)))
+            sent_at = 1500000000 + message_id * 60
+
+            yield (chat_id, message_id, sent_at, sent_by, text, quoted_by,
+                text)
+
+    batch = []
+    for row in rows():
+        batch.append(row)
+
+        if len(batch) == 10000:
+            db.executemany(insert, batch)
+            batch.clear()
+
+    db.executemany(insert, batch)
+    search.index_quotes(db.cursor())
+    db.commit()
+
+    return chat_ids, chat_members
+
+
+def time_calls(function, iterations, warmup):
+    """Calls the function repeatedly and returns its latency statistics."""
+    for i in range(warmup):
+        function(i)
+
+    samples = []
+    for i in range(iterations):
+        start = time.perf_counter_ns()
+        function(warmup + i)
+        samples.append(time.perf_counter_ns() - start)
+
+    samples.sort()
+    total = sum(samples)
+
+    def percentile(p):
+        return samples[min(len(samples) - 1, int(len(samples) * p))] / 1000
+
+    return {
+        'iterations': iterations,
+        'mean_us': total / len(samples) / 1000,
+        'p50_us': percentile(0.50),
+        'p99_us': percentile(0.99),
+        'ops_per_sec': len(samples) / (total / 1e9) if total else None,
+    }
+
+
+def benchmarks(database, chat_ids, chat_members, users, rng):
+    """Returns a mapping of benchmark names to functions that take the
+    iteration number."""
+    # The largest chat gets the most quotes
+    big = chat_ids[0]
+
+    def any_chat(i):
+        return rng.choice(chat_ids)
+
+    def member(chat_id):
+        return rng.choice(chat_members[chat_id])
+
+    def word(i):
+        return rng.choice(WORDS)
+
+    return {
+        'get_user_by_id':
+            lambda i: database.get_user_by_id(rng.randint(1, users)),
+        'user_exists':
+            lambda i: database.user_exists(User(rng.randint(1, users), '')),
+        'add_or_update_user.unchanged':
+            lambda i: database.add_or_update_user(User(1, 'Same', 'Name')),
+        'add_or_update_user.changed':
+            lambda i: database.add_or_update_user(
+                User(rng.randint(1, users), 'Name{0}'.format(i))),
+        'add_or_update_chat':
+            lambda i: database.add_or_update_chat(
+                Chat(any_chat(i), 'supergroup', 'Title {0}'.format(i))),
+        'add_membership':
+            lambda i: database.add_membership(
+                rng.randint(1, users), any_chat(i)),
+        'get_chats':
+            lambda i: database.get_chats(member(big)),
+        'get_or_create_state':
+            lambda i: database.get_or_create_state(rng.randint(1, users)),
+        'set_state':
+            lambda i: database.set_state(rng.randint(1, users), 2, str(big)),
+        'get_chat_by_id':
+            lambda i: database.get_chat_by_id(any_chat(i)),
+        'get_most_quoted':
+            lambda i: database.get_most_quoted(big),
+        'get_most_quotes_added':
+            lambda i: database.get_most_quotes_added(big),
+        'get_quote_count':
+            lambda i: database.get_quote_count(big),
+        'get_quote_count.search':
+            lambda i: database.get_quote_count(big, search=word(i)),
+        'get_first_quote':
+            lambda i: database.get_first_quote(big),
+        'get_random_quote':
+            lambda i: database.get_random_quote(big),
+        'get_random_quote.any_chat':
+            lambda i: database.get_random_quote(any_chat(i)),
+        'get_random_quote.author':
+            lambda i: database.get_random_quote(big, name=rng.choice(
+                FIRST_NAMES)),
+        'search_quote':
+            lambda i: database.search_quote(big, word(i)),
+        'add_quote':
+            lambda i: database.add_quote(big, 10 ** 9 + i, 1700000000 + i,
+                member(big), ' '.join(rng.choices(WORDS, k=10)),
+                [{'type': 'bold', 'offset': 0, 'length': 4}], member(big)),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Returns the benchmarks whose median latency is worse than in the
+    baseline by more than the tolerance."""
+    regressions = []
+
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None or not previous['p50_us']:
+            continue
+
+        ratio = result['p50_us'] / previous['p50_us']
+        result['baseline_ratio'] = ratio
+
+        if ratio > 1 + tolerance:
+            regressions.append((name, previous['p50_us'], result['p50_us']))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--chats', type=int, default=100)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--members', type=int, default=50,
+        help="users in each chat")
+    parser.add_argument('--quotes', type=int, default=10000)
+    parser.add_argument('--iterations', type=int, default=1000)
+    parser.add_argument('--warmup', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', nargs='*',
+        help="names of the benchmarks to run")
+    parser.add_argument('--output', help="file to write the results to")
+    parser.add_argument('--baseline', help="results file to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+        help="allowed median slowdown compared to the baseline")
+    parser.add_argument('--keep', action='store_true',
+        help="keep the generated database")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    directory = tempfile.mkdtemp(prefix='soup-benchmark-')
+    filename = os.path.join(directory, 'benchmark.db')
+
+    # Upserts are timed on the calling thread, not the write-behind queue
+    database = QuoteDatabase(filename, write_behind=False, online=False)
+
+    try:
+        start = time.perf_counter()
+        chat_ids, chat_members = generate(database, args.chats, args.users,
+            args.quotes, args.members, rng)
+        generate_seconds = time.perf_counter() - start
+
+        results = dict()
+        for name, function in benchmarks(
+                database, chat_ids, chat_members, args.users, rng).items():
+            if args.only and name not in args.only:
+                continue
+
+            results[name] = time_calls(function, args.iterations, args.warmup)
+            print("{0}: p50 {1:.1f} us, p99 {2:.1f} us".format(name,
+                results[name]['p50_us'], results[name]['p99_us']),
+                file=sys.stderr)
+    finally:
+        database.close()
+
+        if args.keep:
+            print("kept {0}".format(filename), file=sys.stderr)
+        else:
+            shutil.rmtree(directory)
+
+    report = {
+        'config': {key: getattr(args, key) for key in
+            ('chats', 'users', 'members', 'quotes', 'iterations', 'seed')},
+        'environment': {
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'machine': platform.machine(),
+        },
+        'generate_seconds': generate_seconds,
+        'results': results,
+    }
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+
+        regressions = compare(results, baseline['results'], args.tolerance)
+
+        for name, before, after in regressions:
+            print("regression: {0}: p50 {1:.1f} us -> {2:.1f} us".format(
+                name, before, after), file=sys.stderr)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
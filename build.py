@@ -0,0 +1,67 @@
+"""Resolves the commit the bot is running, once per process.
+
+Deployments without a .git directory can generate build.json beforehand by
+running `python3 build.py` in the repository."""
+import json
+import os
+import time
+from subprocess import CalledProcessError, check_output
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BUILD_FILE = os.path.join(HERE, 'build.json')
+
+UNITS = (
+    ('year', 365 * 24 * 60 * 60),
+    ('month', 30 * 24 * 60 * 60),
+    ('week', 7 * 24 * 60 * 60),
+    ('day', 24 * 60 * 60),
+    ('hour', 60 * 60),
+    ('minute', 60),
+    ('second', 1),
+)
+
+
+def from_git():
+    """Returns the hash and commit timestamp of HEAD."""
+    output = check_output(['git', 'log', '-1', r'--pretty=format:%H %ct'],
+        cwd=HERE, encoding='utf8')
+    commit_hash, timestamp = output.split()
+
+    return {'hash': commit_hash, 'timestamp': int(timestamp)}
+
+
+def load():
+    """Returns the build metadata from build.json if it exists, or from git
+    otherwise."""
+    if os.path.isfile(BUILD_FILE):
+        with open(BUILD_FILE, 'r') as f:
+            return json.load(f)
+
+    try:
+        return from_git()
+    except (CalledProcessError, OSError, ValueError):
+        return {'hash': 'unknown', 'timestamp': None}
+
+
+def relative_date(timestamp, now=None):
+    """Formats the time since the timestamp, like `git log --date=relative`."""
+    if now is None:
+        now = time.time()
+
+    delta = max(int(now - timestamp), 0)
+
+    for unit, seconds in UNITS:
+        count = delta // seconds
+        if count >= 1 or unit == 'second':
+            plural = '' if count == 1 else 's'
+            return '{0} {1}{2} ago'.format(count, unit, plural)
+
+
+if __name__ == '__main__':
+    info = from_git()
+
+    with open(BUILD_FILE, 'w') as f:
+        json.dump(info, f)
+
+    print("wrote {0} ({1})".format(BUILD_FILE, info['hash']))
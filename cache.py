@@ -0,0 +1,116 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """A thread-safe mapping that holds at most `size` items, evicting the
+    least recently used item when it's full. Counts hits and misses.
+
+    With a `ttl` in seconds, items also expire that long after they were
+    stored."""
+
+    def __init__(self, size=10000, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        """Returns the item stored under the key, or the default if there's
+        no such item."""
+        with self._lock:
+            try:
+                value, expires = self._items[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None and expires <= time.monotonic():
+                del self._items[key]
+                self.misses += 1
+                return default
+
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Stores an item, evicting the least recently used item if the cache
+        is full."""
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+
+        with self._lock:
+            self._items[key] = (value, expires)
+            self._items.move_to_end(key)
+
+            if len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Removes an item and returns it, or the default if there's no such
+        item."""
+        with self._lock:
+            item = self._items.pop(key, None)
+
+        if item is None:
+            return default
+
+        return item[0]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        """Returns the cache's size and hit and miss counts."""
+        return {'size': len(self._items),
+            'hits': self.hits, 'misses': self.misses}
+
+
+class RecentKeys:
+    """Remembers the last `size` keys added, in a ring buffer, so that
+    repeated keys are recognized in constant time and bounded memory."""
+
+    def __init__(self, size=10000):
+        self.size = size
+
+        self._ring = [None] * size
+        self._next = 0
+        self._keys = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def add(self, key):
+        """Remembers the key, and returns False if it was already
+        remembered."""
+        with self._lock:
+            if key in self._keys:
+                return False
+
+            # Forget the oldest key to make room
+            oldest = self._ring[self._next]
+            if oldest is not None:
+                self._keys.discard(oldest)
+
+            self._ring[self._next] = key
+            self._next = (self._next + 1) % self.size
+            self._keys.add(key)
+
+            return True
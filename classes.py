@@ -1,9 +1,19 @@
+import json
 from collections import namedtuple
 
+from compression import decompress
+
+
+# Shown for users who aren't in the database
+UNKNOWN_NAME = "unknown"
+
 
 class User:
-    def __init__(self, id_, first_name, last_name='', username='',
-            language_code=''):
+    __slots__ = ('id', 'first_name', 'last_name', 'username')
+
+    # Other fields sent by Telegram, like is_bot and language_code, aren't
+    # stored
+    def __init__(self, id_, first_name, last_name='', username='', **kwargs):
         self.id = id_
         self.first_name = first_name
         self.last_name = last_name
@@ -21,6 +31,8 @@ class User:
 
 
 class Chat:
+    __slots__ = ('id', 'type', 'title', 'username')
+
     def __init__(self, id_, type_, title='', username='', **kwargs):
         self.id = id_
         self.type = type_
@@ -40,8 +52,11 @@ class Chat:
 
 
 class Quote:
+    __slots__ = ('id', 'chat_id', 'message_id', 'sent_at', 'sent_by',
+        'content', 'quoted_by', 'text', 'entities')
+
     def __init__(self, id_, chat_id, message_id, sent_at, sent_by,
-            content, quoted_by=None):
+            content, quoted_by=None, text=None, entities=None):
         self.id = id_
         self.chat_id = chat_id
         self.message_id = message_id
@@ -49,10 +64,46 @@ class Quote:
         self.sent_by = sent_by
         self.content = content
         self.quoted_by = quoted_by
+        self.text = text
+        self.entities = entities
 
     @classmethod
     def from_database(cls, quote):
-        return cls(*quote)
+        quote = cls(*quote)
+
+        # Long text and entities are stored compressed
+        quote.text = decompress(quote.text)
+
+        # Entities are stored as JSON
+        if quote.entities is not None:
+            quote.entities = json.loads(decompress(quote.entities))
+
+        return quote
 
 
 Result = namedtuple('Result', ['quote', 'user'])
+
+
+# Row factories, for cursors whose rows are in the tables' column order
+
+def user_row(cursor, row):
+    return User.from_database(row)
+
+
+def chat_row(cursor, row):
+    return Chat.from_database(row)
+
+
+def result_row(cursor, row):
+    """Builds a Result from a quote's columns followed by its sender's. If
+    the sender's row is missing (the user's columns are NULL), e.g. for an
+    imported quote, the sender is a placeholder named "unknown"."""
+    split = len(Quote.__slots__)
+    quote = Quote.from_database(row[:split])
+
+    if row[split] is not None:
+        user = User.from_database(row[split:])
+    else:
+        user = User(quote.sent_by, UNKNOWN_NAME, None, None)
+
+    return Result(quote, user)
@@ -0,0 +1,123 @@
+"""Compresses the raw text and entities stored with quotes.
+
+Values longer than THRESHOLD bytes are stored as BLOBs of deflate data,
+behind a header that names the preset dictionary they were compressed with.
+Short values, and values that wouldn't get smaller, stay TEXT, so databases
+can mix both. Dictionaries are trained from existing quotes, stored in the
+compression_dictionary table and identified by their CRC-32, so a value can
+always be decompressed with the dictionary it was written with."""
+import re
+import struct
+import zlib
+from collections import Counter
+
+
+# Values shorter than this many bytes aren't compressed
+THRESHOLD = 128
+
+# Size of trained dictionaries. Deflate only looks back 32 KiB.
+DICTIONARY_SIZE = 16 * 1024
+
+# Format version, then the dictionary's ID (0 if there's none)
+HEADER = struct.Struct('>BI')
+VERSION = 1
+
+WORDS = re.compile(r'\w+|[^\w\s]+')
+
+# Dictionaries that have been loaded, by ID
+_dictionaries = {0: b''}
+
+
+def dictionary_id(data):
+    return zlib.crc32(data) if data else 0
+
+
+def register(data):
+    """Makes a dictionary available to decompress(), and returns its ID."""
+    key = dictionary_id(data)
+    _dictionaries[key] = data
+    return key
+
+
+def decompress(value):
+    """Returns a stored value as a string."""
+    if not isinstance(value, bytes):
+        return value
+
+    version, key = HEADER.unpack_from(value)
+    if version != VERSION:
+        raise ValueError("unknown compression format {0}".format(version))
+
+    try:
+        dictionary = _dictionaries[key]
+    except KeyError:
+        raise ValueError("compression dictionary {0:08x} isn't loaded".format(
+            key)) from None
+
+    if dictionary:
+        decompressor = zlib.decompressobj(wbits=-15, zdict=dictionary)
+    else:
+        decompressor = zlib.decompressobj(wbits=-15)
+
+    data = decompressor.decompress(value[HEADER.size:])
+    return (data + decompressor.flush()).decode('utf8')
+
+
+class Compressor:
+    def __init__(self, dictionary=b'', threshold=THRESHOLD):
+        self.dictionary = dictionary
+        self.key = register(dictionary)
+        self.threshold = threshold
+
+    def compress(self, value):
+        """Returns the value to store for a string: the string itself if
+        it's short, or its compressed form otherwise."""
+        if value is None:
+            return None
+
+        data = value.encode('utf8')
+        if len(data) < self.threshold:
+            return value
+
+        if self.dictionary:
+            compressor = zlib.compressobj(9, wbits=-15, zdict=self.dictionary)
+        else:
+            compressor = zlib.compressobj(9, wbits=-15)
+
+        compressed = HEADER.pack(VERSION, self.key) \
+            + compressor.compress(data) + compressor.flush()
+
+        return compressed if len(compressed) < len(data) else value
+
+
+def train(samples, size=DICTIONARY_SIZE):
+    """Builds a preset dictionary from sample strings, out of the words and
+    word pairs that would save the most bytes. Deflate finds matches closer
+    to the end of the dictionary more cheaply, so the best ones go last."""
+    counts = Counter()
+
+    for sample in samples:
+        words = WORDS.findall(sample)
+        counts.update(words)
+        counts.update(' '.join(pair) for pair in zip(words, words[1:]))
+
+    # Strings that only occur once, or are too short to be matched, don't
+    # help
+    scored = sorted(((len(string.encode('utf8')) * count, string)
+        for string, count in counts.items()
+        if count > 1 and len(string) >= 3), reverse=True)
+
+    chosen = []
+    total = 0
+    for _, string in scored:
+        if total >= size:
+            break
+
+        data = string.encode('utf8') + b' '
+        if total + len(data) > size:
+            continue
+
+        chosen.append(data)
+        total += len(data)
+
+    return b''.join(reversed(chosen))
@@ -47,6 +47,73 @@ CREATE TABLE IF NOT EXISTS quote (
     quoted_by INTEGER REFERENCES user (id)
         ON UPDATE CASCADE
         ON DELETE RESTRICT,
+    -- The message's raw text and entities (as JSON), which content is
+    -- rendered from
+    text TEXT,
+    entities TEXT,
 
     UNIQUE(chat_id, message_id) ON CONFLICT ROLLBACK
 );
+
+-- The full-text search index over quotes, quote_fts, is created by
+-- migration 8 and kept by search.py.
+
+-- Per-chat and per-user quote counts, used by /stats and /quotes. Kept up to
+-- date by triggers on the quote table.
+CREATE TABLE IF NOT EXISTS chat_stats (
+    chat_id INTEGER PRIMARY KEY,
+    quote_count INTEGER NOT NULL DEFAULT 0,
+    first_quote_id INTEGER,
+    first_sent_at INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS user_stats (
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    quotes_sent INTEGER NOT NULL DEFAULT 0,
+    quotes_added INTEGER NOT NULL DEFAULT 0,
+
+    PRIMARY KEY (chat_id, user_id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS user_stats_sent
+    ON user_stats (chat_id, quotes_sent);
+CREATE INDEX IF NOT EXISTS user_stats_added
+    ON user_stats (chat_id, quotes_added);
+
+CREATE TRIGGER IF NOT EXISTS quote_stats_insert AFTER INSERT ON quote BEGIN
+    INSERT INTO chat_stats (chat_id, quote_count, first_quote_id, first_sent_at)
+    VALUES (new.chat_id, 1, new.id, new.sent_at)
+    ON CONFLICT (chat_id) DO UPDATE SET
+        quote_count = quote_count + 1,
+        first_quote_id = CASE WHEN first_sent_at IS NULL
+            OR new.sent_at < first_sent_at THEN new.id
+            ELSE first_quote_id END,
+        first_sent_at = MIN(IFNULL(first_sent_at, new.sent_at), new.sent_at);
+
+    INSERT INTO user_stats (chat_id, user_id, quotes_sent)
+    VALUES (new.chat_id, new.sent_by, 1)
+    ON CONFLICT (chat_id, user_id) DO UPDATE SET
+        quotes_sent = quotes_sent + 1;
+
+    INSERT INTO user_stats (chat_id, user_id, quotes_added)
+    SELECT new.chat_id, new.quoted_by, 1 WHERE new.quoted_by IS NOT NULL
+    ON CONFLICT (chat_id, user_id) DO UPDATE SET
+        quotes_added = quotes_added + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS quote_stats_delete AFTER DELETE ON quote BEGIN
+    UPDATE chat_stats SET quote_count = quote_count - 1
+    WHERE chat_id = old.chat_id;
+
+    UPDATE chat_stats SET (first_quote_id, first_sent_at) = (
+        SELECT id, sent_at FROM quote WHERE chat_id = old.chat_id
+        ORDER BY sent_at ASC LIMIT 1)
+    WHERE chat_id = old.chat_id AND first_quote_id = old.id;
+
+    UPDATE user_stats SET quotes_sent = quotes_sent - 1
+    WHERE chat_id = old.chat_id AND user_id = old.sent_by;
+
+    UPDATE user_stats SET quotes_added = quotes_added - 1
+    WHERE chat_id = old.chat_id AND user_id = old.quoted_by;
+END;
@@ -1,15 +1,126 @@
+import itertools
+import json
+import logging
 import os
+import random
 import sqlite3
+import threading
+
+import migrations
+import search
+from authors import AuthorIndex
+from cache import LRUCache
+from classes import Quote, User, chat_row, result_row, user_row
+from compression import Compressor, decompress, register
+from entities import render
+from metrics import TracedConnection
+from sampler import QuoteSampler
+from search import match_query
+from writer import WriteBehindQueue
+
+
+log = logging.getLogger('soup.database')
+
+QUOTE_COLUMNS = """quote.id, quote.chat_id, quote.message_id, quote.sent_at,
+    quote.sent_by, quote.content, quote.quoted_by, quote.text, quote.entities"""
+
+USER_COLUMNS = "user.id, user.first_name, user.last_name, user.username"
+
+# Length of the days that quote_daily counts quotes by, in seconds, and of
+# the periods that quote_monthly counts them by, in days
+DAY = migrations.DAY
+MONTH = migrations.MONTH
+
+
+def day_of(timestamp):
+    """Returns the UTC day that a timestamp is in, as a number of days since
+    the epoch."""
+    return timestamp // DAY
+
+
+def window_parameters(chat_id, since, **parameters):
+    """Returns the parameters of WINDOW_COUNTS for a chat's quotes sent on
+    or after the day `since`."""
+    # The first MONTH-day period that starts on or after that day
+    month = -(-since // MONTH)
+    return dict(parameters, chat_id=chat_id, since=since, month=month)
+
+
+def shard_filename(filename, shard):
+    """Returns the name of a shard's database file. Shard 0 is the main
+    file, which also holds the tables that aren't sharded."""
+    if shard == 0:
+        return filename
+
+    root, extension = os.path.splitext(filename)
+    return '{0}-{1}{2}'.format(root, shard, extension)
+
+
+class ConnectionManager:
+    """Hands out one long-lived connection per thread, so that repeated
+    queries don't pay for opening the database file again."""
+    PRAGMAS = (
+        ('journal_mode', 'WAL'),
+        # In WAL mode, NORMAL doesn't sync commits, so a power loss could
+        # lose a quote after "quote added" was sent. FULL syncs the log on
+        # every commit. Most writes are batched, so there are few commits.
+        ('synchronous', 'FULL'),
+        # Negative values are in KiB: 16 MiB of page cache per connection
+        ('cache_size', -16384),
+        ('mmap_size', 64 * 1024 * 1024),
+        ('temp_store', 'MEMORY'),
+        # Truncate the write-ahead log back to 64 MiB after checkpoints
+        ('journal_size_limit', 64 * 1024 * 1024),
+    )
+
+    def __init__(self, filename, tracer=None):
+        self.filename = filename
+        self.tracer = tracer
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def _open(self):
+        # Connections are only ever used by the thread that opened them, but
+        # close() may be called from another thread during shutdown.
+        factory = sqlite3.Connection if self.tracer is None \
+            else TracedConnection
+        db = sqlite3.connect(self.filename, timeout=30,
+            check_same_thread=False, factory=factory)
+
+        for name, value in self.PRAGMAS:
+            db.execute("PRAGMA {0} = {1};".format(name, value))
+
+        if self.tracer is not None:
+            self.tracer.attach(db)
+
+        return db
+
+    def get(self):
+        """Returns the calling thread's connection, opening it if needed."""
+        db = getattr(self._local, 'db', None)
+
+        if db is None:
+            db = self._local.db = self._open()
 
-from classes import Quote, Result, Chat, User
+            with self._lock:
+                self._connections.append(db)
 
+        return db
 
-ENTITY_TAGS = {
-    'bold': ('<b>', '</b>'),
-    'italic': ('<i>', '</i>'),
-    'code': ('<code>', '</code>'),
-    'pre': ('<pre>', '</pre>'),
-}
+    def close(self):
+        """Closes every connection opened by this manager."""
+        with self._lock:
+            connections, self._connections = self._connections, []
+
+        for db in connections:
+            try:
+                db.close()
+            except sqlite3.ProgrammingError:
+                pass
+
+        self._local = threading.local()
 
 
 class QuoteDatabase:
@@ -17,334 +128,1074 @@ class QuoteDatabase:
     QUOTE_ADDED = 1
     QUOTE_ALREADY_EXISTS = 2
 
-    def __init__(self, filename='data.db'):
-        self.filename = filename
+    # Number of best-ranked matches that /search picks a random quote from
+    SEARCH_POOL = 25
 
-        if not os.path.isfile(filename):
-            self.setup()
+    def __init__(self, filename='data.db', write_behind=True, tracer=None,
+            online=True, shards=1, shared=False, compress=False,
+            build_indexes=True):
+        self.filename = filename
+        self.tracer = tracer
+
+        # Whether other processes add quotes to the same database, in which
+        # case in-memory quote indexes are checked against chat_stats
+        self.shared = shared
+        self.connections = ConnectionManager(filename, tracer=tracer)
+
+        # Quotes and their derived tables are split by chat across `shards`
+        # database files, so that writes to different chats don't wait for
+        # each other. Users, chats, memberships and states are only in the
+        # main file, except that every shard keeps a copy of the user table
+        # for its joins and triggers.
+        self.shard_count = shards
+        self.shards = [self.connections]
+        self._chat_shards = dict()
+
+        self.sampler = QuoteSampler(self._load_quote_ids)
+
+        # The IDs of each user's quotes in a chat, keyed by (chat ID, user
+        # ID), for /author
+        self.author_sampler = QuoteSampler(self._load_author_quote_ids,
+            max_chats=10000)
+        self.authors = AuthorIndex(self._load_authors)
+
+        # The last data written for each user, chat and membership, so that
+        # upserts that wouldn't change anything can be skipped
+        self.identities = LRUCache(size=50000)
+
+        # Browsing states of users who recently sent direct messages. States
+        # are written through to the database, so expired states are reloaded
+        self.states = LRUCache(size=10000, ttl=60 * 60)
+
+        # Changed whenever a chat's quotes or a user's list of chats change,
+        # so that responses built from them can be cached. Keyed by chat ID
+        # or user ID.
+        self._versions = dict()
+        self._version_counter = itertools.count(1)
+
+        # The thread that builds deferred indexes, if any. close() stops it
+        # between statements and waits for it, before closing connections.
+        self._migrations = None
+        self._stopped = threading.Event()
+
+        # Only one of the processes that share a database should build its
+        # deferred indexes, since the builds would wait for each other
+        self.build_indexes = build_indexes
+
+        self.setup(online)
+
+        # With compress, long quote text and entities are stored compressed,
+        # with the newest dictionary. Compressed values are always read.
+        dictionary = self.load_dictionaries()
+        self.compressor = Compressor(dictionary) if compress else None
+
+        # User, chat and membership upserts are written in batches by a
+        # background thread, unless write_behind is False
+        self.writer = None
+        if write_behind:
+            self.writer = WriteBehindQueue(self._write_batch)
 
     # Database methods
 
-    def connect(self):
-        """Connects to the database."""
-        self.db = sqlite3.connect(self.filename)
-        self.c = self.db.cursor()
+    @property
+    def db(self):
+        """The calling thread's connection to the database."""
+        return self.connections.get()
+
+    def close(self):
+        """Writes any pending upserts, then closes all connections to the
+        database."""
+        if self.writer is not None:
+            self.writer.close()
+
+        # An index that is being built can't be interrupted, so this waits
+        # for it to finish
+        self._stopped.set()
+        if self._migrations is not None:
+            self._migrations.join()
+
+        for manager in self.shards:
+            manager.close()
+
+    def setup(self, online=True):
+        """Creates the database and its shards, or migrates them to the
+        latest schema. With online, index migrations are built by a
+        background thread, after the other migrations."""
+        migrations.migrate(self.db, defer_online=online)
+
+        # Shards that chats were assigned to are opened even if there are
+        # now fewer shards, so that their chats can be moved
+        c = self.db.cursor()
+        c.execute("SELECT IFNULL(MAX(shard), 0) FROM chat_shard;")
+        count = max(self.shard_count, c.fetchone()[0] + 1)
+
+        for shard in range(1, count):
+            manager = ConnectionManager(
+                shard_filename(self.filename, shard), tracer=self.tracer)
+            self.shards.append(manager)
+
+            created = migrations.get_version(manager.get()) == 0
+            migrations.migrate(manager.get(), defer_online=online)
+
+            if created:
+                self.copy_users(manager.get())
+
+        # Indexes deferred by an earlier run are built now if the caller
+        # can't wait for them to be built in the background
+        if not online:
+            self._migrate_online(background=False)
+        elif self.build_indexes and any(migrations.deferred(manager.get())
+                for manager in self.shards):
+            self._migrations = threading.Thread(target=self._migrate_online,
+                name='migrations', daemon=True)
+            self._migrations.start()
+
+    def _migrate_online(self, background=True):
+        for manager in self.shards:
+            try:
+                if background:
+                    migrations.build_deferred(manager.get(), self._stopped,
+                        max_quotes=migrations.ONLINE_MAX_QUOTES)
+                else:
+                    migrations.build_deferred(manager.get())
+            except sqlite3.Error:
+                log.exception("online migration of %s failed",
+                    manager.filename)
+
+    # Compression
+
+    def load_dictionaries(self):
+        """Loads every compression dictionary, and returns the newest one,
+        or an empty dictionary if there are none."""
+        c = self.db.cursor()
+        c.execute("SELECT data FROM compression_dictionary "
+            "ORDER BY created_at, id;")
+
+        dictionary = b''
+        for dictionary, in c.fetchall():
+            register(dictionary)
+
+        return dictionary
+
+    def _compress(self, value):
+        if self.compressor is None:
+            return value
+
+        return self.compressor.compress(value)
+
+    def _content(self, text, entities):
+        """Returns the rendered HTML to store in a new quote's content
+        column. Quotes are rendered from their raw text, so with compression,
+        content is NULL instead of a second, uncompressed copy of the
+        text."""
+        if self.compressor is not None:
+            return None
+
+        return render(text, entities)
+
+    # Versions
+
+    def version(self, key):
+        """Returns the version of a chat's quotes, or of a user's list of
+        chats."""
+        return self._versions.get(key, 0)
 
-    def setup(self):
-        """Creates the database."""
-        self.connect()
+    def _bump(self, keys):
+        # Versions are taken from one counter rather than incremented, so
+        # that bumps from different threads can't race
+        for key in keys:
+            self._versions[key] = next(self._version_counter)
 
-        with open('create.sql', 'r') as f:
-            create = f.read().strip()
+    # Shard methods
 
-        self.c.executescript(create)
+    def shard_of(self, chat_id):
+        """Returns the number of the shard that holds the chat's quotes.
+        Chats are assigned to a shard the first time they're seen."""
+        shard = self._chat_shards.get(chat_id)
+        if shard is not None:
+            return shard
+
+        c = self.db.cursor()
+
+        insert = """INSERT INTO chat_shard (chat_id, shard) VALUES (?, ?)
+            ON CONFLICT (chat_id) DO NOTHING;"""
+        c.execute(insert, (chat_id, abs(chat_id) % self.shard_count))
+        # Commit even if the chat was already assigned, which ends the
+        # transaction that the INSERT opened
         self.db.commit()
 
+        c.execute("SELECT shard FROM chat_shard WHERE chat_id = ?;",
+            (chat_id,))
+        shard = self._chat_shards[chat_id] = c.fetchone()[0]
+
+        return shard
+
+    def shard(self, chat_id):
+        """Returns the calling thread's connection to the shard that holds
+        the chat's quotes."""
+        return self.shards[self.shard_of(chat_id)].get()
+
+    def copy_users(self, db):
+        """Copies the users that a shard doesn't have from the main file."""
+        c = self.db.cursor()
+        c.execute("SELECT * FROM user;")
+
+        db.executemany(self.INSERT_USER, c)
+        db.commit()
+
     # User methods
 
     def get_user_by_id(self, user_id):
         """Returns a User object for the user with the given ID, or None if the
         user doesn't exist."""
-        self.connect()
+        c = self.db.cursor()
+        c.row_factory = user_row
 
         select = "SELECT * FROM user WHERE id = ?;"
-        self.c.execute(select, (user_id,))
+        c.execute(select, (user_id,))
 
-        user = self.c.fetchone()
-        if not user:
-            return None
-        else:
-            return User.from_database(user)
+        return c.fetchone()
 
     def user_exists(self, user):
         """Returns whether the given user exists in the database."""
-        self.connect()
+        c = self.db.cursor()
 
         select = "SELECT EXISTS(SELECT * FROM user WHERE id = ? LIMIT 1);"
-        self.c.execute(select, (user.id,))
+        c.execute(select, (user.id,))
 
-        result = self.c.fetchone()
+        result = c.fetchone()
         return result[0]
 
     def add_or_update_user(self, user):
         """Adds a user to the database if they don't exist, or updates their
         data otherwise."""
-        self.connect()
+        key = ('user', user.id)
+        data = (user.first_name, user.last_name, user.username)
+
+        if self.identities.get(key) == data:
+            return
 
-        if self.user_exists(user):
-            update = ("UPDATE user SET "
-                "first_name = ?, last_name = ?, username = ? WHERE id = ?;")
-            self.c.execute(update,
-                (user.first_name, user.last_name, user.username, user.id))
+        self.authors.update_user(user)
+
+        if self.writer is not None:
+            self.writer.put_user(user)
         else:
-            insert = "INSERT INTO user VALUES (?, ?, ?, ?);"
-            self.c.execute(insert,
-                (user.id, user.first_name, user.last_name, user.username))
+            self._write_batch([user], [], [], [])
 
-        self.db.commit()
+        # Cached once the row is queued or written, so that a failed write is
+        # tried again. The queue keeps batches that fail until they're
+        # written.
+        self.identities.put(key, data)
 
     def get_chats(self, user_id):
         """Returns a list of chats that a user is a member of."""
-        self.connect()
+        c = self.db.cursor()
 
         select = """SELECT chat.id, chat.title AS title FROM chat
             INNER JOIN membership AS mem
             ON mem.chat_id = chat.id
             AND mem.user_id = ?
             ORDER BY title COLLATE NOCASE"""
-        self.c.execute(select, (user_id,))
+        c.execute(select, (user_id,))
 
-        return self.c.fetchall()
+        return c.fetchall()
 
     def get_state(self, user_id):
-        """Returns the user's browsing state."""
-        self.connect()
+        """Returns the user's browsing state as a (code, data) tuple, or None
+        if the user has no state."""
+        state = self.states.get(user_id)
+        if state is None and self.writer is not None:
+            state = self.writer.pending_state(user_id)
+
+        if state is not None:
+            return state
+
+        c = self.db.cursor()
 
         select = "SELECT code, data FROM state WHERE user_id = ?"
-        self.c.execute(select, (user_id,))
+        c.execute(select, (user_id,))
 
-        return self.c.fetchone()
+        row = c.fetchone()
+        if row is None:
+            return None
+
+        state = (row[0], row[1] or '')
+        self.states.put(user_id, state)
+        return state
 
     def get_or_create_state(self, user_id):
         """Returns the user's browsing state, or creates it if it doesn't
         exist."""
-        self.connect()
+        state = self.get_state(user_id)
 
-        result = self.get_state(user_id)
+        if state is None:
+            state = self.set_state(user_id, 0)
 
-        if result is None:
-            insert = "INSERT INTO state (user_id, chat_id) VALUES (?, -1)"
-            self.c.execute(insert, (user_id,))
-            self.db.commit()
+        return state
 
-            return self.get_state(user_id)
+    def set_state(self, user_id, code, data=''):
+        """Sets the user's browsing state, keeping its data if no data is
+        given, and returns the new state. The state is written to the
+        database in the background."""
+        if not data:
+            previous = self.states.get(user_id)
+            data = previous[1] if previous is not None else ''
+
+        state = (code, data)
+        self.states.put(user_id, state)
+
+        if self.writer is not None:
+            self.writer.put_state(user_id, code, data)
+        else:
+            self._write_batch([], [], [], [(user_id, code, data)])
 
-        return result
+        return state
 
-    def set_state(self, user_id, code, data=''):
-        """Sets the user's browsing state."""
-        self.connect()
+    # Checkpoints
 
-        if data:
-            update = "UPDATE state SET code = ?, data = ? WHERE user_id = ?"
-            self.c.execute(update, (code, data, user_id))
-        else:
-            update = "UPDATE state SET code = ? WHERE user_id = ?"
-            self.c.execute(update, (code, user_id))
+    def get_checkpoint(self, name):
+        """Returns the value stored under the name and the Unix time when it
+        was saved, which is None for values saved by older versions, or None
+        if there's no value."""
+        c = self.db.cursor()
 
-        self.db.commit()
+        select = "SELECT value, saved_at FROM checkpoint WHERE name = ?;"
+        c.execute(select, (name,))
+
+        return c.fetchone()
+
+    def set_checkpoint(self, name, value):
+        """Stores a value under the name, with the time, in the
+        background."""
+        if self.writer is not None:
+            self.writer.put_checkpoint(name, value)
+        else:
+            self._write_batch([], [], [], [], [(name, value)])
 
     # Chat methods
 
     def get_chat_by_id(self, chat_id):
         """Returns the chat with the given ID."""
-        self.connect()
+        c = self.db.cursor()
+        c.row_factory = chat_row
 
         select = "SELECT * FROM chat WHERE id = ?;"
-        self.c.execute(select, (chat_id,))
+        c.execute(select, (chat_id,))
 
-        chat = self.c.fetchone()
-        if not chat:
-            return None
-        else:
-            return Chat.from_database(chat)
+        return c.fetchone()
+
+    def get_chat_titles(self, chat_ids):
+        """Returns (ID, title) pairs for the chats with the given IDs, in the
+        same order. Missing chats have no title."""
+        c = self.db.cursor()
+
+        select = """SELECT id, title FROM chat
+            WHERE id IN (SELECT value FROM json_each(?));"""
+        c.execute(select, (json.dumps(chat_ids),))
+
+        titles = dict(c.fetchall())
+        return [(chat_id, titles.get(chat_id)) for chat_id in chat_ids]
 
     def chat_exists(self, chat):
         """Determines if the given chat exists in the database."""
-        self.connect()
+        c = self.db.cursor()
 
         select = "SELECT EXISTS(SELECT * FROM chat WHERE id = ? LIMIT 1);"
-        self.c.execute(select, (chat.id,))
+        c.execute(select, (chat.id,))
 
-        return self.c.fetchone()[0]
+        return c.fetchone()[0]
 
     def add_or_update_chat(self, chat):
         """Adds a chat to the database if it doesn't exist, or updates its data
         if it does."""
-        self.connect()
+        key = ('chat', chat.id)
+        data = (chat.type, chat.title, chat.username)
 
-        if self.chat_exists(chat):
-            update = ("UPDATE chat SET "
-                "title = ?, username = ? WHERE id = ?;")
-            self.c.execute(update, (chat.title, chat.username, chat.id))
+        if self.identities.get(key) == data:
+            return
+
+        if self.writer is not None:
+            self.writer.put_chat(chat)
         else:
-            insert = "INSERT INTO chat VALUES (?, ?, ?, ?);"
-            self.c.execute(insert,
-                (chat.id, chat.type, chat.title, chat.username))
+            self._write_batch([], [chat], [], [])
 
-        self.db.commit()
+        self.identities.put(key, data)
 
     # Membership methods
 
     def add_membership(self, user_id, chat_id):
         """Adds a membership listing, indicating that a user is in a chat."""
-        self.connect()
+        key = ('membership', user_id, chat_id)
+
+        if self.identities.get(key):
+            return
+
+        if self.writer is not None:
+            self.writer.put_membership(user_id, chat_id)
+        else:
+            self._write_batch([], [], [(user_id, chat_id)], [])
+
+        self.identities.put(key, True)
+
+    # Batched writes
+
+    UPSERT_USER = """INSERT INTO user VALUES (?, ?, ?, ?)
+        ON CONFLICT (id) DO UPDATE SET
+        first_name = excluded.first_name,
+        last_name = excluded.last_name,
+        username = excluded.username;"""
+
+    UPSERT_CHAT = """INSERT INTO chat VALUES (?, ?, ?, ?)
+        ON CONFLICT (id) DO UPDATE SET
+        title = excluded.title,
+        username = excluded.username;"""
+
+    INSERT_MEMBERSHIP = """INSERT INTO membership (user_id, chat_id)
+        VALUES (?, ?)
+        ON CONFLICT (user_id, chat_id) DO NOTHING;"""
+
+    UPSERT_CHECKPOINT = """INSERT INTO checkpoint (name, value, saved_at)
+        VALUES (?, ?, CAST(strftime('%s', 'now') AS INTEGER))
+        ON CONFLICT (name) DO UPDATE SET
+        value = excluded.value,
+        saved_at = excluded.saved_at;"""
+
+    # The chat_id column is unused: the selected chat is kept in data
+    UPSERT_STATE = """INSERT INTO state (user_id, chat_id, code, data)
+        VALUES (?, -1, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET
+        code = excluded.code,
+        data = excluded.data;"""
+
+    def _write_batch(self, users, chats, memberships, states,
+            checkpoints=()):
+        """Upserts users, chats, memberships, browsing states and checkpoints
+        in one transaction, and users into every other shard."""
+        # Usernames are unique, so users without one are stored as NULL
+        user_rows = [(user.id, user.first_name, user.last_name,
+            user.username or None) for user in users]
+
+        self._write_rows(self.db, [
+            (self._upsert_users, user_rows),
+            (self.UPSERT_CHAT, [(chat.id, chat.type, chat.title, chat.username)
+                for chat in chats]),
+            (self.INSERT_MEMBERSHIP, memberships),
+            (self.UPSERT_STATE, states),
+            (self.UPSERT_CHECKPOINT, checkpoints),
+        ])
+
+        if user_rows:
+            for manager in self.shards[1:]:
+                self._write_rows(manager.get(),
+                    [(self._upsert_users, user_rows)])
+
+        self._bump(user_id for user_id, _ in memberships)
+
+    def _upsert_users(self, c, rows):
+        """Upserts users, and reindexes the quotes of users whose names
+        change, since the search index can only remove a quote given the
+        name that it was indexed with."""
+        c.execute("""SELECT id, first_name, last_name, username FROM user
+            WHERE id IN (SELECT value FROM json_each(?));""",
+            (json.dumps([row[0] for row in rows]),))
+        existing = {row[0]: row for row in c.fetchall()}
+
+        # Users that are new may have quotes that were indexed without a name
+        renamed = [row[0] for row in rows if existing.get(row[0]) != row]
+        if not renamed:
+            c.executemany(self.UPSERT_USER, rows)
+            return
+
+        # Found through the chats that the users have quotes in, so that the
+        # (chat_id, sent_by) index is used
+        where = """quote.chat_id IN (SELECT chat_id FROM user_stats
+            WHERE user_id IN (SELECT value FROM json_each(:users)))
+            AND quote.sent_by IN (SELECT value FROM json_each(:users))"""
+        parameters = {'users': json.dumps(renamed)}
+
+        # Read before the upsert, which can fail, so that the index is only
+        # changed once it has succeeded
+        indexed = search.indexed_rows(c, where, parameters)
+        c.executemany(self.UPSERT_USER, rows)
+
+        search.remove_rows(c, indexed)
+        search.index_quotes(c, where, parameters)
+
+    def _write_rows(self, db, statements):
+        """Runs each statement on its rows in one transaction. Statements can
+        also be functions that take a cursor and the rows."""
+        c = db.cursor()
+
+        def run(statement, rows):
+            if callable(statement):
+                statement(c, rows)
+            else:
+                c.executemany(statement, rows)
 
-        select = "INSERT INTO membership (user_id, chat_id) VALUES (?, ?)"
         try:
-            self.c.execute(select, (user_id, chat_id))
+            for statement, rows in statements:
+                if rows:
+                    run(statement, rows)
         except sqlite3.IntegrityError:
-            pass
+            db.rollback()
+        except BaseException:
+            # e.g. the database stayed locked: the caller retries the batch
+            db.rollback()
+            raise
         else:
-            self.db.commit()
+            db.commit()
+            return
+
+        # A row broke a constraint (e.g. a username that moved to another
+        # user before the old owner's row was updated): write the rows one by
+        # one, skipping the ones that fail
+        for statement, rows in statements:
+            for row in rows:
+                try:
+                    run(statement, [row])
+                except sqlite3.IntegrityError:
+                    pass
+
+        db.commit()
+
+    # Bulk import and export
+
+    INSERT_USER = """INSERT INTO user VALUES (?, ?, ?, ?)
+        ON CONFLICT DO NOTHING;"""
+
+    INSERT_CHAT = """INSERT INTO chat VALUES (?, ?, ?, ?)
+        ON CONFLICT DO NOTHING;"""
+
+    INSERT_QUOTE = """INSERT INTO quote (chat_id, message_id, sent_at,
+        sent_by, content, quoted_by, text, entities)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (chat_id, message_id) DO NOTHING;"""
+
+    # Statements that count the quotes inserted after the given quote ID in
+    # quote_daily
+    DAILY_ROLLUP = [
+        """INSERT INTO quote_daily (chat_id, day, user_id, quotes_sent)
+        SELECT chat_id, sent_at / {day}, sent_by, COUNT(*)
+        FROM quote WHERE id > :after GROUP BY 1, 2, 3
+        ON CONFLICT (chat_id, day, user_id) DO UPDATE SET
+            quotes_sent = quotes_sent + excluded.quotes_sent;""".format(
+            day=DAY),
+        """INSERT INTO quote_daily (chat_id, day, user_id, quotes_added)
+        SELECT chat_id, sent_at / {day}, quoted_by, COUNT(*)
+        FROM quote WHERE id > :after AND quoted_by IS NOT NULL
+        GROUP BY 1, 2, 3
+        ON CONFLICT (chat_id, day, user_id) DO UPDATE SET
+            quotes_added = quotes_added + excluded.quotes_added;""".format(
+            day=DAY),
+    ]
+
+    # Statements that count the quotes inserted after the given quote ID in
+    # quote_monthly
+    MONTHLY_ROLLUP = [
+        """INSERT INTO quote_monthly (chat_id, month, user_id, quotes_sent)
+        SELECT chat_id, sent_at / {period}, sent_by, COUNT(*)
+        FROM quote WHERE id > :after GROUP BY 1, 2, 3
+        ON CONFLICT (chat_id, month, user_id) DO UPDATE SET
+            quotes_sent = quotes_sent + excluded.quotes_sent;""".format(
+            period=DAY * MONTH),
+        """INSERT INTO quote_monthly (chat_id, month, user_id, quotes_added)
+        SELECT chat_id, sent_at / {period}, quoted_by, COUNT(*)
+        FROM quote WHERE id > :after AND quoted_by IS NOT NULL
+        GROUP BY 1, 2, 3
+        ON CONFLICT (chat_id, month, user_id) DO UPDATE SET
+            quotes_added = quotes_added + excluded.quotes_added;""".format(
+            period=DAY * MONTH),
+    ]
+
+    # Triggers that are dropped during bulk imports, and the statements that
+    # do their work for every quote inserted after the given quote ID instead
+    BULK_TRIGGERS = ('quote_stats_insert', 'quote_daily_insert',
+        'quote_monthly_insert')
+
+    BULK_DERIVED = [
+        """INSERT INTO chat_stats
+        (chat_id, quote_count, first_quote_id, first_sent_at)
+        SELECT chat_id, COUNT(*), id, MIN(sent_at)
+        FROM quote WHERE id > :after GROUP BY chat_id
+        ON CONFLICT (chat_id) DO UPDATE SET
+            quote_count = quote_count + excluded.quote_count,
+            first_quote_id = CASE WHEN first_sent_at IS NULL
+                OR excluded.first_sent_at < first_sent_at
+                THEN excluded.first_quote_id ELSE first_quote_id END,
+            first_sent_at = MIN(IFNULL(first_sent_at, excluded.first_sent_at),
+                excluded.first_sent_at);""",
+        """INSERT INTO user_stats (chat_id, user_id, quotes_sent)
+        SELECT chat_id, sent_by, COUNT(*)
+        FROM quote WHERE id > :after GROUP BY chat_id, sent_by
+        ON CONFLICT (chat_id, user_id) DO UPDATE SET
+            quotes_sent = quotes_sent + excluded.quotes_sent;""",
+        """INSERT INTO user_stats (chat_id, user_id, quotes_added)
+        SELECT chat_id, quoted_by, COUNT(*)
+        FROM quote WHERE id > :after AND quoted_by IS NOT NULL
+        GROUP BY chat_id, quoted_by
+        ON CONFLICT (chat_id, user_id) DO UPDATE SET
+            quotes_added = quotes_added + excluded.quotes_added;""",
+    ] + DAILY_ROLLUP + MONTHLY_ROLLUP
+
+    def import_quotes(self, chat, users, quotes):
+        """Inserts a batch of quotes into a chat in one transaction, and
+        returns the number of quotes inserted. Quotes are tuples of
+        (message_id, sent_at, sent_by, text, entities, quoted_by); quotes
+        that already exist are skipped.
+
+        Users and the chat are only added if they don't exist, so that data
+        from the bot isn't overwritten by older data from an export."""
+        if self.writer is not None:
+            self.writer.flush()
+
+        user_rows = [(user.id, user.first_name, user.last_name,
+            user.username or None) for user in users]
+
+        c = self.db.cursor()
+        c.execute(self.INSERT_CHAT,
+            (chat.id, chat.type, chat.title, chat.username or None))
+        c.executemany(self.INSERT_USER, user_rows)
+        c.executemany(self.INSERT_MEMBERSHIP,
+            [(user.id, chat.id) for user in users])
+        self.db.commit()
+
+        db = self.shard(chat.id)
+        c = db.cursor()
+
+        # The insert triggers are dropped and recreated within the
+        # transaction, so other connections never see the quote table
+        # without them
+        c.execute("BEGIN IMMEDIATE;")
+
+        try:
+            c.execute("SELECT name, sql FROM sqlite_master "
+                "WHERE type = 'trigger' AND name IN ({0});".format(
+                    ', '.join('?' * len(self.BULK_TRIGGERS))),
+                self.BULK_TRIGGERS)
+            triggers = c.fetchall()
+
+            for name, _ in triggers:
+                c.execute("DROP TRIGGER {0};".format(name))
+
+            c.execute("SELECT IFNULL(MAX(id), 0) FROM quote;")
+            after = c.fetchone()[0]
+
+            if db is not self.db:
+                c.executemany(self.INSERT_USER, user_rows)
+
+            c.executemany(self.INSERT_QUOTE, (
+                (chat.id, message_id, sent_at, sent_by,
+                    self._content(text, entities), quoted_by,
+                    self._compress(text),
+                    self._compress(json.dumps(entities)) if entities
+                        else None)
+                for message_id, sent_at, sent_by, text, entities, quoted_by
+                in quotes))
+            inserted = c.rowcount
+
+            for statement in self.BULK_DERIVED:
+                c.execute(statement, {'after': after})
+
+            search.index_quotes(c, "quote.id > ?", (after,))
+
+            for _, sql in triggers:
+                c.execute(sql)
+        except BaseException:
+            db.rollback()
+            raise
+
+        db.commit()
+
+        if inserted > 0:
+            self.sampler.invalidate(chat.id)
+            self.authors.invalidate(chat.id)
+            self._bump([chat.id])
+
+        self._bump(user.id for user in users)
+
+        return inserted
+
+    def export_quotes(self, chat_id=None):
+        """Yields every quote, or every quote in the given chat, along with
+        its chat and the users who sent and added it, in order of shard and
+        ID."""
+        if chat_id is None:
+            managers = self.shards
+        else:
+            managers = [self.shards[self.shard_of(chat_id)]]
+
+        select = """SELECT """ + QUOTE_COLUMNS + """, sender.*, adder.*
+            FROM quote
+            LEFT JOIN user AS sender ON sender.id = quote.sent_by
+            LEFT JOIN user AS adder ON adder.id = quote.quoted_by"""
+
+        # Chats are only in the main file
+        chats = dict()
+
+        for manager in managers:
+            c = manager.get().cursor()
+
+            if chat_id is None:
+                c.execute(select + " ORDER BY quote.id;")
+            else:
+                c.execute(select +
+                    " WHERE quote.chat_id = ? ORDER BY quote.id;", (chat_id,))
+
+            for row in c:
+                quote = Quote.from_database(row[:9])
+
+                if quote.chat_id not in chats:
+                    chats[quote.chat_id] = self.get_chat_by_id(quote.chat_id)
+
+                sender = User.from_database(row[9:13]) \
+                    if row[9] is not None else None
+                adder = User.from_database(row[13:17]) \
+                    if row[13] is not None else None
+
+                yield quote, chats[quote.chat_id], sender, adder
 
     # User ranking methods
 
-    def get_most_quoted(self, chat_id, limit=5):
+    # Counts over recent days are summed from quote_monthly for the whole
+    # periods since the start of the window, and from quote_daily for the
+    # days before the first of them, so they don't depend on the number of
+    # quotes, and a year reads at most 42 rows per user
+    WINDOW_COUNTS = """SELECT user_id, quotes_sent, quotes_added
+        FROM quote_daily
+        WHERE chat_id = :chat_id AND day >= :since
+            AND day < :month * {0}
+        UNION ALL
+        SELECT user_id, quotes_sent, quotes_added
+        FROM quote_monthly
+        WHERE chat_id = :chat_id AND month >= :month""".format(MONTH)
+
+    WINDOW_LEADERBOARD = """SELECT SUM(counts.{0}) AS count,
+        user.first_name || " " || user.last_name
+        FROM (""" + WINDOW_COUNTS + """) AS counts INNER JOIN user
+        ON counts.user_id = user.id
+        GROUP BY counts.user_id
+        HAVING count > 0
+        ORDER BY count DESC
+        LIMIT :limit"""
+
+    def get_most_quoted(self, chat_id, limit=5, since=None):
         """Returns the names of the users who have the most quotes attributed
-        to them."""
-        self.connect()
+        to them, counting quotes sent on or after the day `since` if it's
+        given."""
+        c = self.shard(chat_id).cursor()
+
+        if since is not None:
+            select = self.WINDOW_LEADERBOARD.format('quotes_sent')
+            c.execute(select, window_parameters(chat_id, since, limit=limit))
+            return c.fetchall()
 
-        select = """SELECT COUNT(*) AS count,
+        select = """SELECT stats.quotes_sent,
             user.first_name || " " || user.last_name
-            FROM quote INNER JOIN user
-            ON quote.sent_by = user.id
-            AND quote.chat_id = ?
-            GROUP BY quote.sent_by
-            ORDER BY count DESC
+            FROM user_stats AS stats INNER JOIN user
+            ON stats.user_id = user.id
+            WHERE stats.chat_id = ? AND stats.quotes_sent > 0
+            ORDER BY stats.quotes_sent DESC
             LIMIT ?"""
-        self.c.execute(select, (chat_id, limit))
+        c.execute(select, (chat_id, limit))
 
-        return self.c.fetchall()
+        return c.fetchall()
 
-    def get_most_quotes_added(self, chat_id, limit=5):
-        """Returns the names of the users who have added the most quotes."""
-        self.connect()
+    def get_most_quotes_added(self, chat_id, limit=5, since=None):
+        """Returns the names of the users who have added the most quotes,
+        counting quotes sent on or after the day `since` if it's given."""
+        c = self.shard(chat_id).cursor()
 
-        select = """SELECT COUNT(*) AS count,
+        if since is not None:
+            select = self.WINDOW_LEADERBOARD.format('quotes_added')
+            c.execute(select, window_parameters(chat_id, since, limit=limit))
+            return c.fetchall()
+
+        select = """SELECT stats.quotes_added,
             user.first_name || " " || user.last_name
-            FROM quote INNER JOIN user
-            ON quote.quoted_by = user.id
-            AND quote.chat_id = ?
-            GROUP BY quote.quoted_by
-            ORDER BY count DESC
+            FROM user_stats AS stats INNER JOIN user
+            ON stats.user_id = user.id
+            WHERE stats.chat_id = ? AND stats.quotes_added > 0
+            ORDER BY stats.quotes_added DESC
             LIMIT ?"""
-        self.c.execute(select, (chat_id, limit))
+        c.execute(select, (chat_id, limit))
 
-        return self.c.fetchall()
+        return c.fetchall()
 
     # Quote methods
 
-    def get_quote_count(self, chat_id, search=None):
-        """Returns the number of quotes added in the given chat."""
-        self.connect()
+    def get_quote_count(self, chat_id, search=None, since=None):
+        """Returns the number of quotes added in the given chat, or the
+        number of them sent on or after the day `since`."""
+        c = self.shard(chat_id).cursor()
+
+        if since is not None:
+            select = """SELECT IFNULL(SUM(quotes_sent), 0)
+                FROM (""" + self.WINDOW_COUNTS + """);"""
+            c.execute(select, window_parameters(chat_id, since))
+            return c.fetchone()[0]
 
         if search is None:
-            select = """SELECT COUNT(*) FROM quote
-                WHERE quote.chat_id = ?"""
-            self.c.execute(select, (chat_id,))
-        else:
-            select = """SELECT COUNT(DISTINCT quote.id),
-                user.first_name || " " || user.last_name AS full_name
-                FROM quote INNER JOIN user
-                ON quote.sent_by = user.id
-                AND quote.chat_id = ?
-                AND (quote.content LIKE ?
-                    OR full_name LIKE ?
-                    OR user.username LIKE ?)"""
-            search = '%' + search + '%'
-            self.c.execute(select,
-                (chat_id, search, search, search))
-
-        return self.c.fetchone()[0]
+            select = "SELECT quote_count FROM chat_stats WHERE chat_id = ?;"
+            c.execute(select, (chat_id,))
 
-    def get_first_quote(self, chat_id):
-        """Returns the first quote added in the given chat."""
-        self.connect()
+            row = c.fetchone()
+            return 0 if row is None else row[0]
 
-        select = """SELECT * FROM quote
-            WHERE chat_id = ?
-            ORDER BY sent_at ASC
-            LIMIT 1"""
-        self.c.execute(select, (chat_id,))
+        query = match_query(search, chat_id)
+        if query is None:
+            return 0
 
-        row = self.c.fetchone()
-        return Quote.from_database(row)
+        select = "SELECT COUNT(*) FROM quote_fts WHERE quote_fts MATCH ?"
+        c.execute(select, (query,))
 
-    def get_random_quote(self, chat_id, name=None):
-        """Returns a random quote, and the user who wrote the quote."""
-        self.connect()
+        return c.fetchone()[0]
 
-        if name is None:
-            select = """SELECT id, chat_id, message_id, sent_at, sent_by,
-                content FROM quote
-                WHERE chat_id = ?
-                ORDER BY RANDOM() LIMIT 1;"""
-            self.c.execute(select, (chat_id,))
-        else:
-            name = name.lstrip('@')
-            select = """SELECT
-                quote.id, chat_id, message_id, sent_at, sent_by, content,
-                user.first_name || " " || user.last_name AS full_name
-                FROM quote INNER JOIN user
-                ON quote.sent_by = user.id
-                AND quote.chat_id = ?
-                AND (full_name LIKE ? OR username LIKE ?)
-                ORDER BY RANDOM() LIMIT 1;"""
-            self.c.execute(select,
-                (chat_id, '%' + name + '%', '%' + name + '%'))
-
-        row = self.c.fetchone()
+    def get_quote_page(self, chat_id, after=None, search=None, limit=10):
+        """Returns up to `limit` quotes from the chat, oldest first, with the
+        users who wrote them. Only quotes after the (sent_at, id) cursor are
+        returned, and with a search, only quotes that match it.
+
+        Pages are found by seeking in the quote_chat_sent_at index, so each
+        page costs the same however many quotes come before it."""
+        c = self.shard(chat_id).cursor()
+        c.row_factory = result_row
+
+        after = after or (-1, -1)
+
+        if search is None:
+            select = """SELECT """ + QUOTE_COLUMNS + """, """ + USER_COLUMNS + """
+                FROM quote LEFT JOIN user ON user.id = quote.sent_by
+                WHERE quote.chat_id = ? AND (quote.sent_at, quote.id) > (?, ?)
+                ORDER BY quote.sent_at, quote.id
+                LIMIT ?;"""
+            c.execute(select, (chat_id, after[0], after[1], limit))
+
+            return c.fetchall()
+
+        query = match_query(search, chat_id)
+        if query is None:
+            return []
+
+        # Searches cost as much as the number of matches in the chat
+        select = """SELECT """ + QUOTE_COLUMNS + """, """ + USER_COLUMNS + """
+            FROM quote_fts INNER JOIN quote ON quote.id = quote_fts.rowid
+            LEFT JOIN user ON user.id = quote.sent_by
+            WHERE quote_fts MATCH ? AND (quote.sent_at, quote.id) > (?, ?)
+            ORDER BY quote.sent_at, quote.id
+            LIMIT ?;"""
+        c.execute(select, (query, after[0], after[1], limit))
+
+        return c.fetchall()
+
+    def get_first_quote(self, chat_id):
+        """Returns the first quote added in the given chat, or None if the
+        chat has no quotes."""
+        c = self.shard(chat_id).cursor()
+
+        select = """SELECT """ + QUOTE_COLUMNS + """ FROM chat_stats
+            INNER JOIN quote ON quote.id = chat_stats.first_quote_id
+            WHERE chat_stats.chat_id = ?"""
+        c.execute(select, (chat_id,))
+
+        row = c.fetchone()
         if row is None:
             return None
 
+        return Quote.from_database(row)
+
+    def get_random_quote(self, chat_id, name=None, user_id=None):
+        """Returns a random quote, and the user who wrote the quote. With a
+        name, the quote is by the user whose name best matches it; with a
+        user ID, by that user."""
         if name is not None:
-            row = row[0:6]
+            authors = self.find_authors(chat_id, name)
+            if not authors:
+                return None
 
-        quote = Quote.from_database(row)
-        user = self.get_user_by_id(quote.sent_by)
-        return Result(quote, user)
+            user_id = authors[0][0].id
 
-    def search_quote(self, chat_id, search_terms):
-        """Returns a random quote matching the search terms, and the user
-        who wrote the quote."""
-        self.connect()
+        if user_id is None:
+            return self._get_sampled_quote(chat_id)
 
-        select = """SELECT id, chat_id, message_id, sent_at, sent_by, content
-            FROM quote
-            WHERE content LIKE ?
-            ORDER BY RANDOM() LIMIT 1;"""
-        self.c.execute(select, ('%' + search_terms + '%',))
+        c = self.shard(chat_id).cursor()
 
-        row = self.c.fetchone()
-        if row is None:
+        select = """SELECT quotes_sent FROM user_stats
+            WHERE chat_id = ? AND user_id = ?;"""
+        c.execute(select, (chat_id, user_id))
+
+        row = c.fetchone()
+        if row is None or row[0] < 1:
             return None
 
-        quote = Quote.from_database(row)
-        user = self.get_user_by_id(quote.sent_by)
-        return Result(quote, user)
+        key = (chat_id, user_id)
 
-    def add_quote(self, chat_id, message_id, sent_at, sent_by, content,
-            entities, quoted_by):
-        """Inserts a quote."""
-        self.connect()
+        # The index is stale if quotes were added by other processes, or
+        # removed, since it was loaded
+        if self.author_sampler.count(key) not in (None, row[0]):
+            self.author_sampler.invalidate(key)
 
-        select = ("SELECT * FROM quote "
-                  "WHERE chat_id = ? AND message_id = ?;")
-        self.c.execute(select, (chat_id, message_id))
+        c.row_factory = result_row
 
-        if self.c.fetchone() is None:
-            pass
-        else:
-            return self.QUOTE_ALREADY_EXISTS
+        # The quote is checked against the key, in case the chat's quotes
+        # were moved to another shard since the index was loaded
+        select = """SELECT """ + QUOTE_COLUMNS + """, """ + USER_COLUMNS + """
+            FROM quote LEFT JOIN user ON user.id = quote.sent_by
+            WHERE quote.id = ? AND quote.chat_id = ?
+                AND quote.sent_by = ?;"""
 
-        # Convert text formatting to HTML
-        entities = sorted(entities, key=lambda e: e['offset'], reverse=True)
+        for _ in range(2):
+            quote_id = self.author_sampler.sample(key)
+            if quote_id is None:
+                return None
 
-        for entity in entities:
-            if entity['type'] not in ENTITY_TAGS:
-                continue
+            c.execute(select, (quote_id, chat_id, user_id))
+            result = c.fetchone()
+            if result is not None:
+                return result
 
-            s = entity['offset']
-            e = s + entity['length']
-            s_tag, e_tag = ENTITY_TAGS[entity['type']]
+            self.author_sampler.invalidate(key)
 
-            content = content[0:s] + s_tag + content[s:e] + e_tag + content[e:]
+        return None
 
-        insert = ("INSERT INTO quote (chat_id, message_id, sent_at, sent_by,"
-            "content, quoted_by) VALUES (?, ?, ?, ?, ?, ?);")
-        self.c.execute(insert,
-            (chat_id, message_id, sent_at, sent_by, content, quoted_by))
-        self.db.commit()
+    def find_authors(self, chat_id, name):
+        """Returns the users with quotes in the chat whose names best match
+        the given name, as (user, quote count) pairs. Several users are
+        returned if they match equally well."""
+        # Quotes added by other processes aren't in the index
+        if self.shared and self.authors.count(chat_id) is not None:
+            if self.authors.count(chat_id) != self.get_quote_count(chat_id):
+                self.authors.invalidate(chat_id)
+
+        return self.authors.find(chat_id, name)
+
+    def _load_authors(self, chat_id):
+        """Returns the users who have quotes in the given chat, and their
+        number of quotes."""
+        c = self.shard(chat_id).cursor()
+
+        select = """SELECT """ + USER_COLUMNS + """, user_stats.quotes_sent
+            FROM user_stats INNER JOIN user ON user.id = user_stats.user_id
+            WHERE user_stats.chat_id = ? AND user_stats.quotes_sent > 0;"""
+        c.execute(select, (chat_id,))
+
+        return [(User.from_database(row[:-1]), row[-1])
+            for row in c.fetchall()]
+
+    def _load_quote_ids(self, chat_id):
+        """Returns the IDs of every quote in the given chat."""
+        c = self.shard(chat_id).cursor()
+
+        select = "SELECT id FROM quote WHERE chat_id = ?;"
+        c.execute(select, (chat_id,))
+
+        return (row[0] for row in c)
+
+    def _load_author_quote_ids(self, key):
+        """Returns the IDs of every quote by a user in a chat, given (chat
+        ID, user ID)."""
+        chat_id, user_id = key
+        c = self.shard(chat_id).cursor()
+
+        select = "SELECT id FROM quote WHERE chat_id = ? AND sent_by = ?;"
+        c.execute(select, (chat_id, user_id))
+
+        return (row[0] for row in c)
+
+    def _get_sampled_quote(self, chat_id):
+        """Returns a random quote picked by the sampler, and the user who
+        wrote the quote."""
+        c = self.shard(chat_id).cursor()
+        c.row_factory = result_row
+
+        select = """SELECT """ + QUOTE_COLUMNS + """, """ + USER_COLUMNS + """
+            FROM quote LEFT JOIN user ON user.id = quote.sent_by
+            WHERE quote.id = ?;"""
+
+        # Quotes added by other processes aren't in the index
+        if self.shared and self.sampler.count(chat_id) is not None:
+            if self.sampler.count(chat_id) != self.get_quote_count(chat_id):
+                self.sampler.invalidate(chat_id)
+
+        # The sampled ID is stale if the quote was removed after the chat's
+        # index was loaded: reload the index and try again
+        for _ in range(2):
+            quote_id = self.sampler.sample(chat_id)
+            if quote_id is None:
+                return None
+
+            c.execute(select, (quote_id,))
+            result = c.fetchone()
+            if result is not None:
+                return result
+
+            self.sampler.invalidate(chat_id)
+
+        return None
+
+    def search_quote(self, chat_id, search_terms):
+        """Returns a random quote matching the search terms, and the user
+        who wrote the quote."""
+        c = self.shard(chat_id).cursor()
+
+        query = match_query(search_terms, chat_id, column='content')
+        if query is None:
+            return None
+
+        select = """SELECT """ + QUOTE_COLUMNS + """, """ + USER_COLUMNS + """
+            FROM quote_fts INNER JOIN quote
+            ON quote.id = quote_fts.rowid
+            LEFT JOIN user ON user.id = quote.sent_by
+            WHERE quote_fts MATCH ?
+            ORDER BY quote_fts.rank
+            LIMIT ?;"""
+        c.execute(select, (query, self.SEARCH_POOL))
+
+        rows = c.fetchall()
+        if not rows:
+            return None
+
+        # Only the picked row is turned into objects
+        return result_row(c, random.choice(rows))
+
+    def add_quote(self, chat_id, message_id, sent_at, sent_by, content,
+            entities, quoted_by):
+        """Inserts a quote, and returns QUOTE_ADDED, or QUOTE_ALREADY_EXISTS
+        if the message was already added."""
+        # Make sure the users involved are written before the quote
+        if self.writer is not None:
+            self.writer.flush()
+
+        # The raw text and entities are kept, so that the quote can be
+        # rendered again if the renderer changes
+        html = self._content(content, entities)
+        text = self._compress(content)
+        raw_entities = self._compress(json.dumps(entities)) if entities \
+            else None
+
+        db = self.shard(chat_id)
+        c = db.cursor()
+
+        # An existing quote with the same message is left alone, and no row
+        # is changed
+        c.execute(self.INSERT_QUOTE, (chat_id, message_id, sent_at, sent_by,
+            html, quoted_by, text, raw_entities))
+        added = c.rowcount > 0
+        quote_id = c.lastrowid
+
+        # Indexed in the same transaction, from the text before it's
+        # compressed
+        if added:
+            c.execute(search.INSERT_QUOTE, {'id': quote_id,
+                'chat_id': chat_id, 'text': content, 'sent_by': sent_by})
+
+        db.commit()
+
+        if not added:
+            return self.QUOTE_ALREADY_EXISTS
+
+        self.sampler.add(chat_id, quote_id)
+        self.author_sampler.add((chat_id, sent_by), quote_id)
+        self.authors.add(chat_id, sent_by)
+        self._bump([chat_id])
 
         return self.QUOTE_ADDED
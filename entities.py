@@ -0,0 +1,107 @@
+"""Converts Telegram message entities to HTML.
+
+Entity offsets and lengths are counted in UTF-16 code units, so characters
+outside the Basic Multilingual Plane (such as most emoji) count twice."""
+import re
+from html import escape, unescape
+
+
+TAG_PATTERN = re.compile(r'<[^>]+>')
+
+
+ENTITY_TAGS = {
+    'bold': ('<b>', '</b>'),
+    'italic': ('<i>', '</i>'),
+    'code': ('<code>', '</code>'),
+    'pre': ('<pre>', '</pre>'),
+}
+
+
+def utf16_to_index(text, offsets):
+    """Maps UTF-16 offsets into the text to indices into the Python string.
+    Offsets past the end of the text map to its length."""
+    if len(text.encode('utf-16-le')) == 2 * len(text):
+        return {offset: min(offset, len(text)) for offset in offsets}
+
+    wanted = sorted(set(offsets))
+    mapping = dict()
+
+    i = position = 0
+    for offset in wanted:
+        while position < offset and i < len(text):
+            position += 2 if ord(text[i]) > 0xFFFF else 1
+            i += 1
+
+        mapping[offset] = i
+
+    return mapping
+
+
+def render(text, entities):
+    """Returns the text as HTML, with its formatting entities converted to
+    tags. Overlapping entities are split so that the tags nest properly."""
+    spans = []
+    for entity in entities or ():
+        if entity['type'] not in ENTITY_TAGS or entity['length'] <= 0:
+            continue
+
+        start = entity['offset']
+        spans.append((start, start + entity['length'], entity['type']))
+
+    if not spans:
+        return escape(text, quote=False)
+
+    index = utf16_to_index(text,
+        [start for start, _, _ in spans] + [end for _, end, _ in spans])
+
+    # Outer entities open first: by start, then longest first
+    opening = dict()
+    for span in sorted(spans, key=lambda s: (s[0], -s[1])):
+        opening.setdefault(index[span[0]], []).append(
+            (index[span[1]], span[2]))
+
+    boundaries = sorted(set(opening) | {index[end] for _, end, _ in spans})
+
+    html = []
+    stack = []
+    last = 0
+
+    for boundary in boundaries:
+        html.append(escape(text[last:boundary], quote=False))
+        last = boundary
+
+        # Close the entities that end here, along with any entities opened
+        # inside them, then reopen the ones that don't end here
+        for depth, (end, _) in enumerate(stack):
+            if end <= boundary:
+                break
+        else:
+            depth = len(stack)
+
+        closed = stack[depth:]
+        del stack[depth:]
+
+        for _, kind in reversed(closed):
+            html.append(ENTITY_TAGS[kind][1])
+
+        for end, kind in closed:
+            if end > boundary:
+                stack.append((end, kind))
+                html.append(ENTITY_TAGS[kind][0])
+
+        for end, kind in opening.get(boundary, ()):
+            if end > boundary:
+                stack.append((end, kind))
+                html.append(ENTITY_TAGS[kind][0])
+
+    html.append(escape(text[last:], quote=False))
+
+    for _, kind in reversed(stack):
+        html.append(ENTITY_TAGS[kind][1])
+
+    return ''.join(html)
+
+
+def strip(html):
+    """Returns the plain text of HTML made by render()."""
+    return unescape(TAG_PATTERN.sub('', html))
@@ -0,0 +1,301 @@
+"""Keeps the database files small and their statistics current.
+
+While the bot runs, a background thread does these tasks in every database
+file, once the bot has been quiet for QUIET_SECONDS:
+
+- checkpoint: copies the write-ahead log into the database file, so that
+  reads don't have to look through a long log
+- optimize: runs PRAGMA optimize, which updates the query planner's
+  statistics for tables that changed a lot
+- vacuum: returns free pages to the file system, a few at a time, in files
+  that use incremental auto-vacuum
+
+The rest is run by hand, with the bot stopped:
+
+    python3 maintenance.py vacuum     # switch to incremental auto-vacuum
+    python3 maintenance.py train      # train a compression dictionary
+    python3 maintenance.py compress   # recompress quotes with it
+    python3 maintenance.py rollup     # recount quotes by day and period
+    python3 maintenance.py reindex    # rebuild the search index
+    python3 maintenance.py run        # run the background tasks once
+
+Quotes are only compressed when they're added if the bot is started with
+--compress."""
+import argparse
+import logging
+import sys
+import threading
+import time
+
+import compression
+import search
+from compression import Compressor, decompress
+from database import QuoteDatabase
+
+
+log = logging.getLogger('soup.maintenance')
+
+# Seconds between checks for tasks that are due, and seconds without updates
+# after which the bot counts as quiet
+CHECK_INTERVAL = 60
+QUIET_SECONDS = 30
+
+# Pages freed by each incremental vacuum step
+VACUUM_PAGES = 1000
+
+# Quotes sampled to train a dictionary, and quotes recompressed per
+# transaction
+TRAINING_SAMPLES = 10000
+BATCH_SIZE = 1000
+
+
+def checkpoint(db):
+    # PASSIVE doesn't wait for readers or writers
+    db.execute("PRAGMA wal_checkpoint(PASSIVE);").fetchall()
+
+
+def optimize(db):
+    db.execute("PRAGMA optimize;").fetchall()
+
+
+def vacuum(db):
+    # 2 is INCREMENTAL. Other files have to be converted by a full VACUUM.
+    if db.execute("PRAGMA auto_vacuum;").fetchone()[0] != 2:
+        return
+
+    if db.execute("PRAGMA freelist_count;").fetchone()[0] > 0:
+        db.execute("PRAGMA incremental_vacuum({0:d});".format(
+            VACUUM_PAGES)).fetchall()
+
+
+# Tasks, and the number of seconds between runs
+TASKS = [
+    ('checkpoint', checkpoint, 5 * 60),
+    ('optimize', optimize, 60 * 60),
+    ('vacuum', vacuum, 60 * 60),
+]
+
+
+def run_task(database, function):
+    for manager in database.shards:
+        function(manager.get())
+
+
+class Maintenance:
+    def __init__(self, database, metrics, last_update):
+        # last_update() returns the time.monotonic() of the last update
+        self.database = database
+        self.metrics = metrics
+        self.last_update = last_update
+
+        self._next_run = {name: 0 for name, _, _ in TASKS}
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name='maintenance', daemon=True)
+
+        metrics.describe('maintenance_seconds',
+            "Time spent in database maintenance tasks")
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """Stops the thread, after the task that's running finishes."""
+        self._stopped.set()
+
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(CHECK_INTERVAL):
+            for name, function, interval in TASKS:
+                now = time.monotonic()
+                if self._stopped.is_set() or now < self._next_run[name] \
+                        or now - self.last_update() < QUIET_SECONDS:
+                    continue
+
+                self._next_run[name] = now + interval
+
+                try:
+                    with self.metrics.timer('maintenance_seconds', task=name):
+                        run_task(self.database, function)
+                except Exception:
+                    log.exception("maintenance task %s failed", name)
+
+
+# Tasks run by hand
+
+def convert(database):
+    """Rebuilds every database file with incremental auto-vacuum."""
+    for manager in database.shards:
+        db = manager.get()
+        db.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+        db.execute("VACUUM;")
+
+
+def train(database, samples=TRAINING_SAMPLES):
+    """Trains a compression dictionary from a sample of quotes in every
+    file, stores it, and returns its ID and size."""
+    texts = []
+
+    for manager in database.shards:
+        c = manager.get().cursor()
+        c.execute("SELECT text FROM quote WHERE text IS NOT NULL "
+            "ORDER BY RANDOM() LIMIT ?;", (samples,))
+        texts.extend(decompress(text) for text, in c.fetchall())
+
+    dictionary = compression.train(texts)
+    key = compression.register(dictionary)
+
+    database.db.execute("""INSERT INTO compression_dictionary
+        (id, created_at, data) VALUES (?, ?, ?)
+        ON CONFLICT (id) DO NOTHING;""", (key, int(time.time()), dictionary))
+    database.db.commit()
+
+    return key, len(dictionary)
+
+
+def recompress(database):
+    """Compresses every quote's text and entities with the newest
+    dictionary, and returns the number of quotes that changed. The rendered
+    content of quotes that have raw text is dropped, since they're rendered
+    from it."""
+    compressor = Compressor(database.load_dictionaries())
+    changed = 0
+
+    for manager in database.shards:
+        db = manager.get()
+        c = db.cursor()
+        after = 0
+
+        while True:
+            c.execute("""SELECT id, text, entities, content FROM quote
+                WHERE id > ? ORDER BY id LIMIT ?;""", (after, BATCH_SIZE))
+            rows = c.fetchall()
+            if not rows:
+                break
+
+            updates = []
+            for quote_id, text, entities, content in rows:
+                new_text = compressor.compress(decompress(text))
+                new_entities = compressor.compress(decompress(entities))
+
+                # Quotes added before the raw text was kept only have
+                # content
+                new_content = content if text is None else None
+
+                if new_text != text or new_entities != entities \
+                        or new_content != content:
+                    updates.append(
+                        (new_text, new_entities, new_content, quote_id))
+
+            c.executemany("""UPDATE quote SET text = ?, entities = ?,
+                content = ? WHERE id = ?;""", updates)
+            db.commit()
+
+            changed += len(updates)
+            after = rows[-1][0]
+
+    return changed
+
+
+def rollup(database):
+    """Rebuilds the daily and 30-day quote counts from the quotes in every
+    file, and returns the number of daily rows written."""
+    rows = 0
+
+    for manager in database.shards:
+        db = manager.get()
+        c = db.cursor()
+        c.execute("BEGIN IMMEDIATE;")
+
+        try:
+            c.execute("DELETE FROM quote_daily;")
+            c.execute("DELETE FROM quote_monthly;")
+
+            for statement in QuoteDatabase.DAILY_ROLLUP \
+                    + QuoteDatabase.MONTHLY_ROLLUP:
+                c.execute(statement, {'after': 0})
+
+            c.execute("SELECT COUNT(*) FROM quote_daily;")
+            rows += c.fetchone()[0]
+        except BaseException:
+            db.rollback()
+            raise
+
+        db.commit()
+
+    return rows
+
+
+def reindex(database):
+    """Rebuilds the search index in every file, and returns the number of
+    quotes indexed."""
+    quotes = 0
+
+    for manager in database.shards:
+        db = manager.get()
+        c = db.cursor()
+        c.execute("BEGIN IMMEDIATE;")
+
+        try:
+            search.rebuild(c)
+
+            c.execute("SELECT COUNT(*) FROM quote;")
+            quotes += c.fetchone()[0]
+        except BaseException:
+            db.rollback()
+            raise
+
+        db.commit()
+
+    return quotes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', default='data.db')
+    parser.add_argument('--shards', type=int, default=1,
+        help="number of shards that the bot uses")
+    parser.add_argument('command',
+        choices=['vacuum', 'train', 'compress', 'rollup', 'reindex', 'run'])
+    args = parser.parse_args()
+
+    database = QuoteDatabase(args.database, write_behind=False,
+        online=False, shards=args.shards)
+    start = time.perf_counter()
+
+    try:
+        if args.command == 'vacuum':
+            convert(database)
+
+        elif args.command == 'train':
+            key, size = train(database)
+            print("trained dictionary {0:08x} ({1} bytes)".format(key, size),
+                file=sys.stderr)
+
+        elif args.command == 'compress':
+            changed = recompress(database)
+            print("recompressed {0} quotes".format(changed), file=sys.stderr)
+
+        elif args.command == 'rollup':
+            rows = rollup(database)
+            print("wrote {0} daily counts".format(rows), file=sys.stderr)
+
+        elif args.command == 'reindex':
+            quotes = reindex(database)
+            print("indexed {0} quotes".format(quotes), file=sys.stderr)
+
+        elif args.command == 'run':
+            for name, function, _ in TASKS:
+                run_task(database, function)
+    finally:
+        database.close()
+
+    print("done in {0:.1f} s".format(time.perf_counter() - start),
+        file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
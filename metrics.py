@@ -0,0 +1,351 @@
+"""In-process metrics, exported in the Prometheus text format.
+
+Metrics are cheap enough to leave on: recording a value takes a lock, a
+bisect and two additions."""
+import bisect
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Latency buckets in seconds, from 100 microseconds to 10 seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+PREFIX = 'soup_'
+
+log = logging.getLogger('soup.sql')
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+
+    def escape(value):
+        return (str(value).replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+    return '{' + ','.join(
+        '{0}="{1}"'.format(key, escape(value)) for key, value in pairs) + '}'
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """A registry of counters, histograms and gauges, keyed by name and
+    labels."""
+
+    def __init__(self):
+        self.counters = dict()
+        self.histograms = dict()
+        self.gauges = dict()
+        self.help = dict()
+
+        self._lock = threading.Lock()
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+
+            histogram.observe(value)
+
+    def gauge(self, name, function, **labels):
+        """Registers a function that returns the gauge's current value."""
+        key = (name, tuple(sorted(labels.items())))
+        self.gauges[key] = function
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self):
+        """Returns every metric in the Prometheus text format."""
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(
+                (key, list(h.counts), h.sum, h.count, h.buckets)
+                for key, h in self.histograms.items())
+
+        gauges = []
+        for key, function in sorted(self.gauges.items(), key=lambda i: i[0]):
+            try:
+                gauges.append((key, function()))
+            except Exception:
+                pass
+
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name in typed:
+                return
+
+            typed.add(name)
+            if name in self.help:
+                lines.append('# HELP {0}{1} {2}'.format(
+                    PREFIX, name, self.help[name]))
+            lines.append('# TYPE {0}{1} {2}'.format(PREFIX, name, kind))
+
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append('{0}{1}{2} {3}'.format(
+                PREFIX, name, _format_labels(labels), value))
+
+        for (name, labels), value in gauges:
+            header(name, 'gauge')
+            lines.append('{0}{1}{2} {3}'.format(
+                PREFIX, name, _format_labels(labels), value))
+
+        for (name, labels), counts, total, count, buckets in histograms:
+            header(name, 'histogram')
+
+            cumulative = 0
+            for bound, bucket_count in zip(buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append('{0}{1}_bucket{2} {3}'.format(PREFIX, name,
+                    _format_labels(labels, [('le', bound)]), cumulative))
+
+            lines.append('{0}{1}_sum{2} {3}'.format(
+                PREFIX, name, _format_labels(labels), total))
+            lines.append('{0}{1}_count{2} {3}'.format(
+                PREFIX, name, _format_labels(labels), count))
+
+        return '\n'.join(lines) + '\n'
+
+
+def serve(metrics, port, host='127.0.0.1'):
+    """Serves the metrics over HTTP from a background thread, and returns the
+    server."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.render().encode('utf8')
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+
+    thread = threading.Thread(
+        target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+
+    return server
+
+
+def write_periodically(metrics, filename, interval=15):
+    """Writes the metrics to a file every `interval` seconds, from a
+    background thread, for node_exporter's textfile collector."""
+    def run():
+        while True:
+            time.sleep(interval)
+
+            temporary = filename + '.tmp'
+            with open(temporary, 'w') as f:
+                f.write(metrics.render())
+
+            os.replace(temporary, filename)
+
+    thread = threading.Thread(target=run, name='metrics-file', daemon=True)
+    thread.start()
+
+    return thread
+
+
+# SQL tracing
+
+WHITESPACE = re.compile(r'\s+')
+# The first keyword of a statement, after any comments
+FIRST_WORD = re.compile(r'(?:\s|--[^\n]*\n)*(\w+)')
+
+
+class TracedCursor(sqlite3.Cursor):
+    """Records the time, rows and virtual machine steps of each statement it
+    executes, and logs the query plan of slow statements."""
+    label = None
+
+    def _run(self, method, sql, parameters):
+        connection = self.connection
+        steps = connection.steps
+        statements = connection.statements
+        start = time.perf_counter()
+
+        try:
+            return method(sql, parameters)
+        finally:
+            elapsed = time.perf_counter() - start
+            tracer = connection.tracer
+            label = self.label = tracer.label(sql)
+
+            tracer.metrics.observe('query_seconds', elapsed, query=label)
+            tracer.metrics.inc('query_steps_total',
+                (connection.steps - steps) * tracer.step_interval, query=label)
+            tracer.metrics.inc('query_statements_total',
+                connection.statements - statements, query=label)
+
+            if self.rowcount > 0:
+                tracer.metrics.inc('query_rows_total', self.rowcount,
+                    query=label)
+
+            if elapsed >= tracer.slow_seconds:
+                tracer.slow(connection, label, sql, parameters, elapsed)
+
+    def execute(self, sql, parameters=()):
+        return self._run(super().execute, sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self._run(super().executemany, sql, parameters)
+
+    def _count(self, rows):
+        self.connection.tracer.metrics.inc('query_rows_total', rows,
+            query=self.label)
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            self._count(1)
+        return row
+
+    def fetchall(self):
+        rows = super().fetchall()
+        if rows:
+            self._count(len(rows))
+        return rows
+
+
+class TracedConnection(sqlite3.Connection):
+    """A connection whose cursors are traced. The tracer is attached after
+    the connection is opened, by Tracer.attach."""
+    tracer = None
+    steps = 0
+    statements = 0
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+
+class Tracer:
+    """Collects per-statement metrics from TracedConnections."""
+
+    def __init__(self, metrics, slow_seconds=0.05, step_interval=1000,
+            slow_log_interval=60):
+        self.metrics = metrics
+        self.slow_seconds = slow_seconds
+        self.step_interval = step_interval
+        self.slow_log_interval = slow_log_interval
+
+        self._labels = dict()
+        self._logged = dict()
+
+        metrics.describe('query_seconds', "Time spent executing statements")
+        metrics.describe('query_steps_total',
+            "Approximate SQLite virtual machine steps run by statements")
+        metrics.describe('query_rows_total',
+            "Rows returned or changed by statements")
+        metrics.describe('query_statements_total',
+            "Statements run, counting each statement run by a trigger")
+        metrics.describe('slow_queries_total',
+            "Statements slower than the slow query threshold")
+
+    def label(self, sql):
+        """Returns the statement's label: the module and function that ran
+        it, and its first keyword, such as database.add_quote:insert. Labels
+        don't include the SQL, so their number is bounded by the code, and
+        they don't change when a statement is reformatted."""
+        label = self._labels.get(sql)
+
+        if label is None:
+            # The first frame outside this module
+            frame = sys._getframe(1)
+            while frame.f_code.co_filename == __file__:
+                frame = frame.f_back
+
+            module = os.path.splitext(
+                os.path.basename(frame.f_code.co_filename))[0]
+            match = FIRST_WORD.match(sql)
+            verb = match.group(1).lower() if match is not None else 'sql'
+
+            label = self._labels[sql] = '{0}.{1}:{2}'.format(
+                module, frame.f_code.co_name, verb)
+
+        return label
+
+    def attach(self, connection):
+        """Installs the progress handler and trace callback on a
+        connection."""
+        connection.tracer = self
+
+        def progress():
+            connection.steps += 1
+            return 0
+
+        # Called for each statement, including those run by triggers
+        def trace(statement):
+            connection.statements += 1
+
+        connection.set_progress_handler(progress, self.step_interval)
+        connection.set_trace_callback(trace)
+
+    def slow(self, connection, label, sql, parameters, elapsed):
+        self.metrics.inc('slow_queries_total', query=label)
+
+        # Log each slow statement at most once per interval
+        now = time.monotonic()
+        if now - self._logged.get(label, -self.slow_log_interval) \
+                < self.slow_log_interval:
+            return
+        self._logged[label] = now
+
+        plan = []
+        if label.rsplit(':', 1)[1] in ('select', 'with'):
+            try:
+                c = sqlite3.Cursor(connection)
+                c.execute('EXPLAIN QUERY PLAN ' + sql, parameters)
+                plan = [row[3] for row in c.fetchall()]
+            except sqlite3.Error:
+                pass
+
+        log.warning("slow query %s (%.1f ms): %s\n  plan: %s",
+            label, elapsed * 1000, WHITESPACE.sub(' ', sql).strip(),
+            '\n        '.join(plan) or 'n/a')
@@ -0,0 +1,434 @@
+"""Versioned schema migrations.
+
+The schema's version is stored in the database's user_version. Each migration
+upgrades the schema by one version, in its own transaction, so a failed
+migration leaves the database at the previous version.
+
+create.sql is the schema at version 1, except for the search index, which
+is created by version 8. Don't edit it: add a migration to the end of
+MIGRATIONS instead. Migrations are either SQL statements, or functions that
+take a cursor.
+
+Migrations that only build indexes can be marked as online. At startup,
+they're recorded in the deferred_migration table instead of being run, so
+later migrations don't wait for them, and a background thread in one of the
+processes sharing the database builds them afterwards; queries are correct,
+if slower, until they're built. Their steps must be safe to run again
+(CREATE INDEX IF NOT EXISTS), since a build that's interrupted is started
+over. Online migrations index the quote table."""
+import logging
+import os
+import sqlite3
+from collections import namedtuple
+
+import compression
+import search
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Length of the days that quote_daily counts quotes by, in seconds
+DAY = 24 * 60 * 60
+
+# Days in the periods that quote_monthly counts quotes by
+MONTH = 30
+
+# A statement holds the write lock until it finishes, and can't be split, so
+# deferred indexes aren't built in the background for more quotes than this:
+# other processes would give up waiting for the lock (after 30 s). `python3
+# maintenance.py run`, with the bot stopped, builds them.
+ONLINE_MAX_QUOTES = 1000000
+
+# Seconds between the statements of a background build, so that writers
+# that are waiting for the lock get it
+BUILD_PAUSE = 1
+
+log = logging.getLogger('soup.migrations')
+
+Migration = namedtuple('Migration', ['description', 'steps', 'online'])
+
+
+class SchemaTooNew(Exception):
+    """Raised when the database was migrated by a newer version of the
+    bot."""
+
+
+def split_statements(script):
+    """Splits an SQL script into statements. Unlike executescript, the
+    statements can be run in an open transaction."""
+    statements = []
+    statement = ''
+
+    for line in script.splitlines(keepends=True):
+        statement += line
+
+        if sqlite3.complete_statement(statement):
+            statements.append(statement.strip())
+            statement = ''
+
+    if statement.strip():
+        statements.append(statement.strip())
+
+    return statements
+
+
+# Version 1
+
+# Columns that were added to existing tables before the schema was versioned
+COLUMNS = [
+    ('quote', 'text', 'TEXT'),
+    ('quote', 'entities', 'TEXT'),
+]
+
+# Statements that fill derived tables from the quote table, for databases
+# that were created before the derived table existed
+BACKFILL = {
+    'chat_stats': [
+        # SQLite takes the bare id column from the row with the minimum sent_at
+        """INSERT INTO chat_stats
+        (chat_id, quote_count, first_quote_id, first_sent_at)
+        SELECT chat_id, COUNT(*), id, MIN(sent_at)
+        FROM quote GROUP BY chat_id;""",
+    ],
+    'user_stats': [
+        """INSERT INTO user_stats (chat_id, user_id, quotes_sent)
+        SELECT chat_id, sent_by, COUNT(*)
+        FROM quote GROUP BY chat_id, sent_by;""",
+        """INSERT INTO user_stats (chat_id, user_id, quotes_added)
+        SELECT chat_id, quoted_by, COUNT(*)
+        FROM quote WHERE quoted_by IS NOT NULL GROUP BY chat_id, quoted_by
+        ON CONFLICT (chat_id, user_id) DO UPDATE SET
+            quotes_added = excluded.quotes_added;""",
+    ],
+}
+
+
+def create_baseline(c):
+    """Creates the schema in create.sql, or brings a database created before
+    the schema was versioned up to it."""
+    with open(os.path.join(HERE, 'create.sql'), 'r') as f:
+        create = f.read()
+
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table';")
+    existing = {row[0] for row in c.fetchall()}
+
+    for table, column, definition in COLUMNS:
+        if table not in existing:
+            continue
+
+        c.execute("PRAGMA table_info({0});".format(table))
+        if column not in {row[1] for row in c.fetchall()}:
+            c.execute("ALTER TABLE {0} ADD COLUMN {1} {2};".format(
+                table, column, definition))
+
+    for statement in split_statements(create):
+        c.execute(statement)
+
+    for table, statements in BACKFILL.items():
+        if table in existing or 'quote' not in existing:
+            continue
+
+        for statement in statements:
+            c.execute(statement)
+
+
+def register_dictionaries(c):
+    """Makes the compression dictionaries in the database available to
+    decompress()."""
+    c.execute("SELECT data FROM compression_dictionary;")
+    for data, in c.fetchall():
+        compression.register(data)
+
+
+MIGRATIONS = [
+    Migration("create the baseline schema", [create_baseline], online=False),
+    Migration("index quotes by chat for the first quote and leaderboards", [
+        # The membership table's unique constraint already indexes
+        # (user_id, chat_id), which serves lookups by user
+        """CREATE INDEX IF NOT EXISTS quote_chat_sent_at
+            ON quote (chat_id, sent_at);""",
+        """CREATE INDEX IF NOT EXISTS quote_chat_sent_by
+            ON quote (chat_id, sent_by);""",
+        """CREATE INDEX IF NOT EXISTS quote_chat_quoted_by
+            ON quote (chat_id, quoted_by);""",
+        # Statistics let the planner skip-scan quote_chat_sent_by for
+        # lookups by sender alone
+        "ANALYZE quote;",
+    ], online=True),
+    Migration("store the chats offered for selection as a list of IDs", [
+        # [[0, chat_id, title], ...] becomes "chat_id chat_id ..."
+        """UPDATE state SET data = (
+            SELECT group_concat(json_extract(value, '$[1]'), ' ')
+            FROM json_each(state.data))
+            WHERE code = 1 AND json_valid(data)
+                AND json_type(data) = 'array';""",
+    ], online=False),
+    Migration("record which shard each chat's quotes are in", [
+        # Only used in the main database file. Chats that already exist
+        # keep their quotes in it.
+        """CREATE TABLE IF NOT EXISTS chat_shard (
+            chat_id INTEGER PRIMARY KEY,
+            shard INTEGER NOT NULL
+        );""",
+        """INSERT INTO chat_shard (chat_id, shard)
+            SELECT id, 0 FROM chat UNION SELECT chat_id, 0 FROM chat_stats;""",
+    ], online=False),
+    Migration("record the last update handled, to skip redelivered updates", [
+        """CREATE TABLE IF NOT EXISTS checkpoint (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );""",
+    ], online=False),
+    Migration("store dictionaries for compressing quotes", [
+        # Only used in the main database file. IDs are the dictionaries'
+        # CRC-32s, which compressed values refer to.
+        """CREATE TABLE IF NOT EXISTS compression_dictionary (
+            id INTEGER PRIMARY KEY,
+            created_at INTEGER NOT NULL,
+            data BLOB NOT NULL
+        );""",
+    ], online=False),
+    Migration("count quotes by day, for leaderboards over recent days", [
+        # Days are UTC days since the epoch
+        """CREATE TABLE IF NOT EXISTS quote_daily (
+            chat_id INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            quotes_sent INTEGER NOT NULL DEFAULT 0,
+            quotes_added INTEGER NOT NULL DEFAULT 0,
+
+            PRIMARY KEY (chat_id, day, user_id)
+        ) WITHOUT ROWID;""",
+        # Existing quotes are counted before the triggers count new ones
+        """INSERT INTO quote_daily (chat_id, day, user_id, quotes_sent)
+            SELECT chat_id, sent_at / {day}, sent_by, COUNT(*)
+            FROM quote GROUP BY 1, 2, 3
+            ON CONFLICT (chat_id, day, user_id) DO UPDATE SET
+                quotes_sent = excluded.quotes_sent;""".format(day=DAY),
+        """INSERT INTO quote_daily (chat_id, day, user_id, quotes_added)
+            SELECT chat_id, sent_at / {day}, quoted_by, COUNT(*)
+            FROM quote WHERE quoted_by IS NOT NULL GROUP BY 1, 2, 3
+            ON CONFLICT (chat_id, day, user_id) DO UPDATE SET
+                quotes_added = excluded.quotes_added;""".format(day=DAY),
+        """CREATE TRIGGER IF NOT EXISTS quote_daily_insert
+            AFTER INSERT ON quote BEGIN
+            INSERT INTO quote_daily (chat_id, day, user_id, quotes_sent)
+            VALUES (new.chat_id, new.sent_at / {day}, new.sent_by, 1)
+            ON CONFLICT (chat_id, day, user_id) DO UPDATE SET
+                quotes_sent = quotes_sent + 1;
+
+            INSERT INTO quote_daily (chat_id, day, user_id, quotes_added)
+            SELECT new.chat_id, new.sent_at / {day}, new.quoted_by, 1
+            WHERE new.quoted_by IS NOT NULL
+            ON CONFLICT (chat_id, day, user_id) DO UPDATE SET
+                quotes_added = quotes_added + 1;
+        END;""".format(day=DAY),
+        """CREATE TRIGGER IF NOT EXISTS quote_daily_delete
+            AFTER DELETE ON quote BEGIN
+            UPDATE quote_daily SET quotes_sent = quotes_sent - 1
+            WHERE chat_id = old.chat_id AND day = old.sent_at / {day}
+                AND user_id = old.sent_by;
+
+            UPDATE quote_daily SET quotes_added = quotes_added - 1
+            WHERE chat_id = old.chat_id AND day = old.sent_at / {day}
+                AND user_id = old.quoted_by;
+        END;""".format(day=DAY),
+    ], online=False),
+    Migration("index quotes' plain text for search, scoped by chat", [
+        # search.py writes the index's rows, from the quotes' decompressed
+        # text, so the dictionaries have to be loaded first. The index was
+        # kept by triggers before.
+        register_dictionaries,
+        "DROP TRIGGER IF EXISTS quote_fts_insert;",
+        "DROP TRIGGER IF EXISTS quote_fts_delete;",
+        "DROP TRIGGER IF EXISTS quote_fts_update;",
+        "DROP TRIGGER IF EXISTS user_fts_update;",
+        "DROP TABLE IF EXISTS quote_fts;",
+        # Contentless, since the text is already in the quote table. Each
+        # quote is tagged with its chat's token in the chat column, so that
+        # searches only read the chat's matches.
+        """CREATE VIRTUAL TABLE quote_fts USING fts5(
+            chat,
+            content,
+            author,
+            content = '',
+            tokenize = 'unicode61 remove_diacritics 2'
+        );""",
+        search.index_quotes,
+    ], online=False),
+    Migration("record when each checkpoint was saved", [
+        # Checkpoints saved before this are treated as expired
+        "ALTER TABLE checkpoint ADD COLUMN saved_at INTEGER;",
+    ], online=False),
+    Migration("count quotes by 30-day period, for leaderboards over a year", [
+        # Periods are MONTH days long, counted from the epoch, so that a
+        # window reads whole periods from quote_monthly and only the days
+        # before the first whole period from quote_daily
+        """CREATE TABLE IF NOT EXISTS quote_monthly (
+            chat_id INTEGER NOT NULL,
+            month INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            quotes_sent INTEGER NOT NULL DEFAULT 0,
+            quotes_added INTEGER NOT NULL DEFAULT 0,
+
+            PRIMARY KEY (chat_id, month, user_id)
+        ) WITHOUT ROWID;""",
+        """INSERT INTO quote_monthly
+            (chat_id, month, user_id, quotes_sent, quotes_added)
+            SELECT chat_id, day / {month}, user_id, SUM(quotes_sent),
+                SUM(quotes_added)
+            FROM quote_daily GROUP BY 1, 2, 3
+            ON CONFLICT (chat_id, month, user_id) DO UPDATE SET
+                quotes_sent = excluded.quotes_sent,
+                quotes_added = excluded.quotes_added;""".format(month=MONTH),
+        """CREATE TRIGGER IF NOT EXISTS quote_monthly_insert
+            AFTER INSERT ON quote BEGIN
+            INSERT INTO quote_monthly (chat_id, month, user_id, quotes_sent)
+            VALUES (new.chat_id, new.sent_at / {period}, new.sent_by, 1)
+            ON CONFLICT (chat_id, month, user_id) DO UPDATE SET
+                quotes_sent = quotes_sent + 1;
+
+            INSERT INTO quote_monthly (chat_id, month, user_id, quotes_added)
+            SELECT new.chat_id, new.sent_at / {period}, new.quoted_by, 1
+            WHERE new.quoted_by IS NOT NULL
+            ON CONFLICT (chat_id, month, user_id) DO UPDATE SET
+                quotes_added = quotes_added + 1;
+        END;""".format(period=DAY * MONTH),
+        """CREATE TRIGGER IF NOT EXISTS quote_monthly_delete
+            AFTER DELETE ON quote BEGIN
+            UPDATE quote_monthly SET quotes_sent = quotes_sent - 1
+            WHERE chat_id = old.chat_id AND month = old.sent_at / {period}
+                AND user_id = old.sent_by;
+
+            UPDATE quote_monthly SET quotes_added = quotes_added - 1
+            WHERE chat_id = old.chat_id AND month = old.sent_at / {period}
+                AND user_id = old.quoted_by;
+        END;""".format(period=DAY * MONTH),
+    ], online=False),
+]
+
+LATEST = len(MIGRATIONS)
+
+
+def get_version(db):
+    return db.execute("PRAGMA user_version;").fetchone()[0]
+
+
+def check_version(db):
+    """Returns the database's schema version, or raises SchemaTooNew if the
+    bot doesn't know it."""
+    version = get_version(db)
+
+    if version > LATEST:
+        raise SchemaTooNew("the database's schema is at version {0}, but "
+            "this version of the bot only knows versions up to {1}".format(
+                version, LATEST))
+
+    return version
+
+
+DEFERRED_TABLE = """CREATE TABLE IF NOT EXISTS deferred_migration (
+    version INTEGER PRIMARY KEY
+);"""
+
+
+def migrate(db, target=LATEST, defer_online=False):
+    """Applies the migrations needed to bring the database up to the target
+    version, and returns the resulting version. With defer_online, online
+    migrations are left for build_deferred()."""
+    version = check_version(db)
+
+    while version < target:
+        migration = MIGRATIONS[version]
+        c = db.cursor()
+
+        # Take the write lock first, so that two processes can't both apply
+        # the same migration
+        c.execute("BEGIN IMMEDIATE;")
+
+        try:
+            if get_version(db) != version:
+                db.rollback()
+                version = check_version(db)
+                continue
+
+            if defer_online and migration.online:
+                log.info("deferring version %d: %s",
+                    version + 1, migration.description)
+
+                c.execute(DEFERRED_TABLE)
+                c.execute("INSERT OR IGNORE INTO deferred_migration "
+                    "VALUES (?);", (version + 1,))
+            else:
+                log.info("migrating to version %d: %s",
+                    version + 1, migration.description)
+
+                for step in migration.steps:
+                    if callable(step):
+                        step(c)
+                    else:
+                        c.execute(step)
+
+            # PRAGMA statements can't take parameters
+            c.execute("PRAGMA user_version = {0:d};".format(version + 1))
+        except BaseException:
+            db.rollback()
+            raise
+
+        db.commit()
+        version += 1
+
+    return version
+
+
+def deferred(db):
+    """Returns the versions of the online migrations that were deferred and
+    haven't been built yet."""
+    c = db.cursor()
+    c.execute("SELECT name FROM sqlite_master "
+        "WHERE type = 'table' AND name = 'deferred_migration';")
+    if c.fetchone() is None:
+        return []
+
+    c.execute("SELECT version FROM deferred_migration ORDER BY version;")
+    return [version for version, in c.fetchall()]
+
+
+def build_deferred(db, stopped=None, max_quotes=None):
+    """Runs the deferred online migrations. Each statement commits on its
+    own, so the write lock is only held while one index is built, not for a
+    whole migration.
+
+    With a stopped event, this pauses between statements, and returns before
+    the next statement once the event is set; the rest is built by a later
+    run. With max_quotes, nothing is built if the quote table is larger."""
+    versions = deferred(db)
+    if not versions:
+        return
+
+    if max_quotes is not None:
+        # The largest ID bounds the number of quotes without counting them
+        quotes, = db.execute("SELECT IFNULL(MAX(id), 0) FROM quote;") \
+            .fetchone()
+
+        if quotes > max_quotes:
+            log.warning("not building deferred versions %s in the "
+                "background, since there are too many quotes: run `python3 "
+                "maintenance.py run` with the bot stopped",
+                ', '.join(str(version) for version in versions))
+            return
+
+    for version in versions:
+        migration = MIGRATIONS[version - 1]
+        log.info("building version %d: %s", version, migration.description)
+
+        for step in migration.steps:
+            if stopped is not None and stopped.wait(BUILD_PAUSE):
+                return
+
+            # Outside a transaction, sqlite3 commits DDL as it runs
+            db.execute(step)
+
+        db.execute("DELETE FROM deferred_migration WHERE version = ?;",
+            (version,))
+        db.commit()
@@ -0,0 +1,323 @@
+"""Sends the bot's messages from a queue, within Telegram's rate limits.
+
+Handlers put messages in the outbox and return. A task sends them within a
+global rate and each chat's own rate. Each chat's messages are sent one at
+a time, in the order they were queued. Across chats, the chat whose next
+message has the most urgent priority goes first, and chats with the same
+priority take turns in the order their messages were queued.
+When Telegram answers with 429 Too Many Requests, the chat is paused for the
+retry_after it asks for, and the message is sent again.
+
+A message that's identical to one still waiting to be sent to the same chat,
+from the same source (such as a command) and with the same options, such as
+the message it replies to, is dropped, so that repeated commands get one
+response. The outbox holds at most MAX_PENDING messages, and MAX_CHAT_PENDING
+per chat: messages beyond that are dropped and counted, so that a flood of
+commands can't hold up every other chat, or use up memory."""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+
+from cache import LRUCache
+from telegram import TelegramError, TooManyRequestsError
+
+
+log = logging.getLogger('soup.outbox')
+
+# Message priorities, most urgent first: short replies that confirm what a
+# user did, then other responses
+REPLY = 0
+NOTICE = 1
+
+# Telegram allows about 30 messages a second overall, one a second in a
+# private chat, and 20 a minute in a group. Chats can burst a few messages.
+GLOBAL_RATE = 30
+PRIVATE_RATE = 1
+GROUP_RATE = 20 / 60
+CHAT_BURST = 3
+
+# Seconds to pause a chat after a 429 that doesn't include retry_after
+DEFAULT_RETRY_AFTER = 5
+
+# Seconds that the outbox gets to send its remaining messages when the bot
+# stops
+DRAIN_TIMEOUT = 10
+
+# Messages that can wait in the outbox, and in each chat's queue. A group
+# chat's queue takes a minute and a half to send at GROUP_RATE.
+MAX_PENDING = 10000
+MAX_CHAT_PENDING = 30
+
+
+class TokenBucket:
+    """Allows `rate` events a second on average, and bursts of up to
+    `capacity` events."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity,
+            self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Returns the number of seconds until an event is allowed."""
+        self._refill(now)
+        return max(0, (1 - self.tokens) / self.rate)
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class Message:
+    __slots__ = ('priority', 'order', 'chat_id', 'text', 'options', 'key',
+        'queued_at')
+
+    def __init__(self, priority, order, chat_id, text, source, options):
+        self.priority = priority
+        self.order = order
+        self.chat_id = chat_id
+        self.text = text
+        self.options = options
+        self.queued_at = time.monotonic()
+
+        # Responses to different commands, or replies to different messages,
+        # aren't duplicates, even if their text is the same
+        self.key = (chat_id, source, text, repr(sorted(options.items())))
+
+
+class Outbox:
+    def __init__(self, send, metrics, rate=GLOBAL_RATE, limit=MAX_PENDING,
+            chat_limit=MAX_CHAT_PENDING):
+        # send(chat_id, text, **options) is a coroutine function that sends
+        # a message
+        self.send = send
+        self.metrics = metrics
+        self.limit = limit
+        self.chat_limit = chat_limit
+
+        # Each chat's messages, in the order they were queued, and the
+        # number of messages in all of them
+        self._chats = dict()
+        self._pending = 0
+        self._keys = set()
+        self._order = itertools.count()
+
+        # A chat with messages is in exactly one of: _ready, a heap of
+        # (priority, order, chat ID) of its first message, for chats that
+        # can send now; _waiting, a heap of (time, chat ID) for chats that
+        # have to wait for their rate limit; or _in_flight
+        self._ready = []
+        self._waiting = []
+        self._in_flight = set()
+
+        self._global = TokenBucket(rate, max(rate, 1))
+        self._buckets = LRUCache(size=10000)
+        self._paused = dict()
+
+        self._tasks = set()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+        metrics.describe('outbox_wait_seconds',
+            "Time that sent messages waited in the outbox")
+        metrics.describe('messages_coalesced_total',
+            "Messages dropped because an identical message was waiting")
+        metrics.describe('messages_dropped_total',
+            "Messages dropped because the outbox was full, or because the "
+            "bot stopped before they could be sent")
+        metrics.describe('messages_throttled_total',
+            "Messages that Telegram answered with 429 Too Many Requests")
+        metrics.describe('messages_failed_total',
+            "Messages that couldn't be sent")
+
+        metrics.gauge('outbox_pending', lambda: self._pending)
+
+    def __len__(self):
+        return self._pending
+
+    def put(self, chat_id, text, priority, source=None, **options):
+        """Queues a message to be sent after the chat's other messages,
+        unless a message with the same text and options, from the same
+        source (such as a command), is already waiting. Returns whether the
+        message was queued: if the outbox or the chat's queue is full, the
+        message is dropped."""
+        message = Message(priority, next(self._order), chat_id, text, source,
+            options)
+
+        if message.key in self._keys:
+            self.metrics.inc('messages_coalesced_total')
+            return False
+
+        messages = self._chats.get(chat_id)
+        queued = len(messages) if messages is not None else 0
+
+        if self._pending >= self.limit or queued >= self.chat_limit:
+            reason = 'full' if self._pending >= self.limit else 'chat_full'
+            log.warning("outbox is full (%s), dropping a message to chat %d",
+                reason, chat_id)
+            self.metrics.inc('messages_dropped_total', reason=reason)
+            return False
+
+        if messages is None:
+            messages = self._chats[chat_id] = deque()
+
+        self._keys.add(message.key)
+        messages.append(message)
+        self._pending += 1
+
+        # Otherwise the chat is already scheduled, or in flight
+        if len(messages) == 1 and chat_id not in self._in_flight:
+            self._schedule(chat_id, time.monotonic())
+            self._wakeup.set()
+
+        return True
+
+    def start(self, loop):
+        self._task = loop.create_task(self._run())
+
+    async def close(self):
+        """Sends the remaining messages, for up to DRAIN_TIMEOUT seconds,
+        then stops. Messages that are still queued are dropped."""
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+
+        while (self._pending or self._tasks) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+        if self._pending:
+            log.warning("dropping %d unsent messages to %d chats",
+                self._pending, len(self._chats))
+            self.metrics.inc('messages_dropped_total', self._pending,
+                reason='shutdown')
+
+        if self._task is not None:
+            self._task.cancel()
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+
+        if bucket is None:
+            # Group chats have negative IDs
+            rate = GROUP_RATE if chat_id < 0 else PRIVATE_RATE
+            bucket = TokenBucket(rate, CHAT_BURST)
+            self._buckets.put(chat_id, bucket)
+
+        return bucket
+
+    def _chat_delay(self, chat_id, now):
+        """Returns the number of seconds until a message can be sent to the
+        chat."""
+        paused = self._paused.get(chat_id)
+        if paused is not None:
+            if paused > now:
+                return paused - now
+            del self._paused[chat_id]
+
+        return self._bucket(chat_id).delay(now)
+
+    def _schedule(self, chat_id, now):
+        """Puts a chat that has messages and isn't in flight in the ready
+        heap, or in the waiting heap until its rate limit allows a
+        message."""
+        delay = self._chat_delay(chat_id, now)
+
+        if delay == 0:
+            first = self._chats[chat_id][0]
+            heapq.heappush(self._ready, (first.priority, first.order, chat_id))
+        else:
+            heapq.heappush(self._waiting, (now + delay, chat_id))
+
+    def _next(self, now):
+        """Removes and returns the message to send now: the first message of
+        the ready chat whose first message is most urgent. Returns None if no
+        chat is ready."""
+        while self._waiting and self._waiting[0][0] <= now:
+            _, chat_id = heapq.heappop(self._waiting)
+            self._schedule(chat_id, now)
+
+        if not self._ready:
+            return None
+
+        _, _, chat_id = heapq.heappop(self._ready)
+        messages = self._chats[chat_id]
+        message = messages.popleft()
+
+        if not messages:
+            del self._chats[chat_id]
+        self._pending -= 1
+
+        return message
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+
+            wait = self._global.delay(now)
+            if wait == 0:
+                message = self._next(now)
+
+                if message is not None:
+                    self._global.take(now)
+                    self._bucket(message.chat_id).take(now)
+                    self._in_flight.add(message.chat_id)
+
+                    task = asyncio.ensure_future(self._send(message))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+                    continue
+
+                # Nothing can be sent until a waiting chat's turn comes
+                wait = self._waiting[0][0] - now if self._waiting else None
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send(self, message):
+        chat_id = message.chat_id
+        retry = False
+
+        try:
+            await self.send(chat_id, message.text, **message.options)
+        except TooManyRequestsError as e:
+            parameters = (e.json or {}).get('parameters') or {}
+            retry_after = parameters.get('retry_after', DEFAULT_RETRY_AFTER)
+
+            log.warning("rate limited in chat %d, retrying in %s s",
+                chat_id, retry_after)
+            self.metrics.inc('messages_throttled_total')
+
+            # The message is sent again before the chat's other messages
+            self._paused[chat_id] = time.monotonic() + retry_after
+            self._chats.setdefault(chat_id, deque()).appendleft(message)
+            self._pending += 1
+            retry = True
+        except TelegramError as e:
+            log.warning("couldn't send a message to chat %d: %s",
+                chat_id, e.description)
+            self.metrics.inc('messages_failed_total')
+        except Exception:
+            log.exception("couldn't send a message to chat %d", chat_id)
+            self.metrics.inc('messages_failed_total')
+        else:
+            self.metrics.observe('outbox_wait_seconds',
+                time.monotonic() - message.queued_at)
+        finally:
+            if not retry:
+                self._keys.discard(message.key)
+
+            self._in_flight.discard(chat_id)
+            if chat_id in self._chats:
+                self._schedule(chat_id, time.monotonic())
+
+            self._wakeup.set()
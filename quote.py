@@ -1,311 +1,962 @@
-import json
-import telepot
+import argparse
+import asyncio
+import functools
+import html
+import logging
+import re
+import signal
 import time
-from datetime import datetime
-from subprocess import check_output
+import traceback
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
+import build
+from cache import LRUCache, RecentKeys
 from classes import Chat, User
-from database import QuoteDatabase
+from database import DAY, QuoteDatabase, day_of
+from entities import render
+from maintenance import Maintenance
+from metrics import Metrics, Tracer, serve, write_periodically
+from migrations import SchemaTooNew
+from outbox import GLOBAL_RATE, NOTICE, REPLY, Outbox
+from telegram import Bot
+from webhook import WebhookServer, load_secret, register
+from workers import supervise
 
 
 TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+DATE_FORMAT = "%Y-%m-%d"
 
 REPOSITORY_NAME = "Doktor/soup-dumpling"
 REPOSITORY_URL = "https://github.com/Doktor/soup-dumpling"
 
-COMMIT_HASH = check_output(['git', 'rev-parse', 'HEAD'],
-    encoding='utf8').rstrip('\n')
-COMMIT_URL = REPOSITORY_URL + '/commit/' + COMMIT_HASH
+VERSION = (1, 1, 0)
 
-DATE_ARGS = ['git', 'log', COMMIT_HASH,
-    '-1', '--date=iso', r'--pretty=format:%cd']
-COMMIT_DATE = check_output(DATE_ARGS, encoding='utf8')[:19]
+# Seconds that cached responses are kept, when only this process adds quotes
+# and when other worker processes do
+RESPONSE_TTL = 10 * 60
+SHARED_RESPONSE_TTL = 30
 
-# The relative date is used for the 'about' command
-DATE_ARGS[4] = '--date=relative'
+# Windows that /stats can count quotes over, in days, including today
+STATS_WINDOWS = {'week': 7, 'month': 30, 'year': 365}
 
-VERSION = (1, 1, 0)
+# Number of users listed when several users match an /author search
+AUTHOR_CHOICES = 5
+
+# Number of quotes on a page of /list, and the length that each quote is
+# cut to
+PAGE_SIZE = 10
+PREVIEW_LENGTH = 200
+
+TAG_PATTERN = re.compile(r'<[^>]+>')
+
+# Number of recent update IDs and messages remembered to recognize updates
+# that are delivered again
+RECENT_UPDATES = 10000
+
+# Telegram numbers updates from a random ID once a bot has had no updates for
+# a week, so a checkpoint older than that says nothing about new updates
+CHECKPOINT_TTL = 7 * 24 * 60 * 60
+
+# Matches "/command", "/command@bot_username" and "/command arguments"
+COMMAND_PATTERN = re.compile(
+    r'/(?P<name>\w+)(?:@(?P<mention>\w+))?(?:\s+(?P<args>.*))?', re.DOTALL)
+
+# Chat types that commands can be used in
+PRIVATE = ('private',)
+GROUPS = ('group', 'supergroup')
+ANYWHERE = PRIVATE + GROUPS
 
 # User state codes
 NO_CHAT_SPECIFIED = 0
 SELECTING_CHAT = 1
 SELECTED_CHAT = 2
 
+# A command's handler, the chat types it can be used in, whether it acts on
+# the chat being browsed when it's used in a direct message, and the outbox
+# priority of its responses
+Command = namedtuple('Command', ['handler', 'chats', 'browse', 'priority'])
+
+# A parsed message. chat_id is the chat to act on, which is the chat being
+# browsed for direct messages, and origin is the chat to reply to.
+Request = namedtuple('Request', ['message', 'chat_type', 'origin', 'chat_id',
+    'user_id', 'message_id', 'command', 'args', 'text', 'priority'])
+
+
+class QuoteBot(Bot):
+    def __init__(self, token, loop=None, workers=8, max_pending=64,
+            metrics=None, shards=1, shared=False, send_rate=GLOBAL_RATE,
+            checkpoint='last_update_id', compress=False, maintenance=True):
+        super(QuoteBot, self).__init__(token, loop=loop)
+
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.database = QuoteDatabase(
+            tracer=Tracer(self.metrics), shards=shards, shared=shared,
+            compress=compress, build_indexes=maintenance)
+        self.user = None
+
+        # Database maintenance runs when no updates have arrived for a while.
+        # Only one process sharing the database runs it, and builds its
+        # deferred indexes.
+        self.last_update = time.monotonic()
+        self.maintenance = Maintenance(self.database, self.metrics,
+            lambda: self.last_update) if maintenance else None
+
+        # Database calls run in a thread pool, so that a slow query only
+        # holds up the chat that made it. The semaphore bounds the number of
+        # calls that can be waiting for a thread.
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='database')
+        self._pending = asyncio.Semaphore(max_pending)
+
+        # Updates from the same chat are handled one at a time, in order.
+        # Maps chat IDs to a lock and the number of updates using it.
+        self._chat_locks = dict()
+        self._tasks = set()
+        self._closing = False
+
+        # Responses are queued and sent within Telegram's rate limits, so
+        # handlers don't wait for them
+        self.outbox = Outbox(self.sendMessage, self.metrics, rate=send_rate)
 
-class QuoteBot(telepot.Bot):
-    commands = ['about',
-        'random', 'quotes', 'stats', 'author', 'search', 'addquote']
+        with open('tokens/username.txt', 'r') as f:
+            self.username = f.read().strip().lstrip('@').lower()
+
+        self.build = build.load()
+
+        # Maps quotes to their text rendered as HTML. Quote IDs are only
+        # unique within a shard, so keys include the chat ID.
+        self.rendered = LRUCache(size=5000)
+
+        # Maps (chat, command, arguments, version) to a response, where the
+        # version is the database's version of the data it was built from.
+        # Entries also expire, since renamed users and chats don't change
+        # versions, nor do quotes added by other worker processes.
+        self.responses = LRUCache(size=5000,
+            ttl=SHARED_RESPONSE_TTL if shared else RESPONSE_TTL)
+
+        # Updates are skipped if they were recently handled, or if they're no
+        # later than the checkpoint, which is saved as updates are handled:
+        # every update up to it was handled before the bot last stopped.
+        # The checkpoint expires CHECKPOINT_TTL seconds after the last update
+        # was handled. With no checkpoint name, only recent updates are
+        # skipped.
+        self.recent = RecentKeys(size=RECENT_UPDATES)
+        self.checkpoint = checkpoint
+
+        saved = None
+        if checkpoint is not None:
+            saved = self.database.get_checkpoint(checkpoint)
+        self._handled_through, self._handled_at = saved or (0, None)
+        self._saved_through = self._latest_update = self._handled_through
+        self._updates_in_progress = set()
+
+        self._register_metrics()
+
+    def _register_metrics(self):
+        metrics = self.metrics
+
+        metrics.describe('command_seconds',
+            "Time spent handling a message, by command")
+        metrics.describe('database_call_seconds',
+            "Time spent in QuoteDatabase methods, including waiting for a "
+            "thread")
+        metrics.describe('telegram_request_seconds',
+            "Time spent in Telegram Bot API requests")
+
+        metrics.describe('updates_duplicate_total',
+            "Updates skipped because they were already handled")
+
+        metrics.gauge('updates_in_progress', lambda: len(self._tasks))
+
+        if self.database.writer is not None:
+            metrics.gauge('write_behind_pending',
+                lambda: len(self.database.writer))
+
+        caches = [('identities', self.database.identities),
+            ('rendered', self.rendered), ('responses', self.responses)]
+
+        for name, cache in caches:
+            metrics.gauge('cache_size', functools.partial(len, cache),
+                cache=name)
+            metrics.gauge('cache_hits', lambda cache=cache: cache.hits,
+                cache=name)
+            metrics.gauge('cache_misses', lambda cache=cache: cache.misses,
+                cache=name)
+
+    async def start(self):
+        self.user = await self.getMe()
+        self.outbox.start(self.loop)
+
+        if self.maintenance is not None:
+            self.maintenance.start()
+
+    async def shutdown(self):
+        """Stops accepting updates, waits for the ones being handled and
+        their responses, then closes the HTTP session and the database."""
+        self._closing = True
+
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+
+        await self.outbox.close()
+        await self.close()
+        self.executor.shutdown(wait=True)
+
+        if self.maintenance is not None:
+            self.maintenance.stop()
+        self.database.close()
+
+    async def run_db(self, function, *args, **kwargs):
+        """Calls a database method in the thread pool."""
+        with self.metrics.timer('database_call_seconds',
+                method=function.__name__):
+            async with self._pending:
+                return await self.loop.run_in_executor(self.executor,
+                    functools.partial(function, *args, **kwargs))
+
+    async def _api_request(self, method, *args, **kwargs):
+        with self.metrics.timer('telegram_request_seconds', method=method):
+            return await super()._api_request(method, *args, **kwargs)
+
+    def on_update(self, update):
+        """Schedules an update from getUpdates to be handled."""
+        self.loop.create_task(self.handle_update(update))
+
+    async def handle_update(self, update):
+        self.last_update = time.monotonic()
+        self._expire_checkpoint()
+
+        if self._is_duplicate(update):
+            self.metrics.inc('updates_duplicate_total')
+            return
 
-    def __init__(self, token):
-        super(QuoteBot, self).__init__(token)
+        update_id = update.get('update_id')
+        if update_id is not None:
+            self._updates_in_progress.add(update_id)
+
+        handled = False
+        try:
+            m = update.get('message') or update.get('edited_message')
+
+            handled = m is None or await self.handle(m)
+        finally:
+            # An update that wasn't handled, e.g. because the bot is shutting
+            # down, stays in progress, so the checkpoint stays before it and
+            # it's handled when it's delivered again
+            if update_id is not None and handled:
+                self._handled(update_id)
+
+    def _expire_checkpoint(self):
+        """Forgets the checkpoint if no update was handled for
+        CHECKPOINT_TTL seconds, since later update IDs can be lower."""
+        if self._handled_at is not None \
+                and time.time() - self._handled_at < CHECKPOINT_TTL:
+            return
 
-        self.database = QuoteDatabase()
-        self.user = self.getMe()
+        self._handled_through = self._saved_through = self._latest_update = 0
+
+    def _is_duplicate(self, update):
+        """Returns whether the update was already handled, and remembers it
+        otherwise."""
+        update_id = update.get('update_id')
+
+        if update_id is not None:
+            if update_id <= self._handled_through:
+                return True
+            if not self.recent.add(update_id):
+                return True
+
+        # The same message can come back in a new update, e.g. from another
+        # instance's webhook. Edits have the same message ID, so they aren't
+        # checked.
+        m = update.get('message')
+        if m is not None and 'chat' in m and 'message_id' in m:
+            if not self.recent.add((m['chat']['id'], m['message_id'])):
+                return True
+
+        return False
+
+    def _handled(self, update_id):
+        """Saves the checkpoint up to the earliest update still being
+        handled."""
+        self._updates_in_progress.discard(update_id)
+        self._latest_update = max(self._latest_update, update_id)
+        self._handled_at = time.time()
+
+        if self._updates_in_progress:
+            through = min(self._updates_in_progress) - 1
+        else:
+            through = self._latest_update
+
+        if self.checkpoint is not None and through > self._saved_through:
+            self._saved_through = through
+            self.database.set_checkpoint(self.checkpoint, through)
+
+    async def handle(self, m):
+        """Handles a message, and returns whether it was handled: messages
+        that arrive while the bot is shutting down are dropped."""
+        if self._closing:
+            return False
+        if 'chat' not in m:
+            return True
+
+        chat_id = m['chat']['id']
+        task = asyncio.current_task()
+        self._tasks.add(task)
+
+        entry = self._chat_locks.get(chat_id)
+        if entry is None:
+            entry = self._chat_locks[chat_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+
+        try:
+            # asyncio locks are fair, so updates keep their arrival order
+            async with entry[0]:
+                await self._handle(m)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[chat_id]
+
+            self._tasks.discard(task)
+
+        return True
+
+    def _render_quote(self, quote):
+        text = self.rendered.get((quote.chat_id, quote.id))
+
+        if text is None:
+            # Quotes added before raw text was stored only have their HTML
+            if quote.text is None:
+                text = quote.content
+            else:
+                text = render(quote.text, quote.entities)
 
-        with open('tokens/username.txt', 'r') as f:
-            self.username = f.read().strip()
+            self.rendered.put((quote.chat_id, quote.id), text)
+
+        return text
 
     def _format_quote(self, quote, user):
         date = datetime.fromtimestamp(quote.sent_at).strftime(TIME_FORMAT)
         message = '"{text}" - {name}\n<i>{date}</i>'.format(
-            text=quote.content, name=user.first_name, date=date)
+            text=self._render_quote(quote), name=user.first_name, date=date)
         return message
 
-    def _send_quote(self, chat_id, message, quote_id):
-        sent = self.sendMessage(chat_id, message, parse_mode='HTML')
+    def _reply(self, request, text, **options):
+        """Queues a response to a request in the outbox. Responses to
+        different commands are never coalesced."""
+        self.outbox.put(request.origin, text, request.priority,
+            source=request.command, **options)
 
-    def handle(self, m):
-        content_type, chat_type, chat_id = telepot.glance(m)
-        origin = chat_id
+    def _send_quote(self, request, message, quote_id):
+        self._reply(request, message, parse_mode='HTML')
 
-        if content_type != 'text':
-            return
+    def parse(self, m):
+        """Returns the request for a message, or None if the bot should
+        ignore the message. Doesn't touch the database."""
+        if 'text' not in m or 'from' not in m:
+            return None
 
-        if chat_type == 'channel':
-            return
+        chat_type = m['chat']['type']
+        if chat_type not in ANYWHERE:
+            return None
 
-        message_id = m['message_id']
-        user_id = m['from']['id']
-        text = m['text'].lower()
+        text = m['text']
+        name, args = None, ''
 
-        if chat_type != 'private' and not text.startswith('/'):
-            return
+        match = COMMAND_PATTERN.match(text)
+        if match is not None:
+            mention = match.group('mention')
 
-        raw_command = text.split(' ')[0]
-        args = text.replace(raw_command, '').lstrip()
-        command = raw_command.replace(self.username.lower(), '').lstrip('/')
+            # Commands addressed to other bots
+            if mention is not None and mention.lower() != self.username:
+                return None
 
-        # Ignore unsupported commands
-        if chat_type != 'private' and command not in self.commands:
-            return
+            name = match.group('name').lower()
+            args = (match.group('args') or '').strip()
 
-        self.database.add_or_update_user(User.from_telegram(m['from']))
-
-        if user_id != chat_id:
-            self.database.add_or_update_chat(Chat.from_telegram(m['chat']))
-            self.database.add_membership(user_id, chat_id)
-
-        if command == 'about':
-            info = {
-                'version': '.'.join((str(n) for n in VERSION)),
-                'updated': COMMIT_DATE,
-                'updated_rel': check_output(DATE_ARGS, encoding='utf8'),
-                'repo_url': REPOSITORY_URL,
-                'repo_name': REPOSITORY_NAME,
-                'hash_url': COMMIT_URL,
-                'hash': COMMIT_HASH[:7],
-            }
-
-            response = ['"Nice quote!" - <b>Soup Dumpling {version}</b>',
-                '<i>{updated} ({updated_rel})</i>',
-                '',
-                'Source code at <a href="{repo_url}">{repo_name}</a>',
-                'Running on commit <a href="{hash_url}">{hash}</a>',
-            ]
-
-            response = '\n'.join(response).format(**info)
-            return self.sendMessage(chat_id, response,
-                disable_web_page_preview=True, parse_mode='HTML')
-
-        elif chat_type != 'private' and command == 'addquote':
-            quote = m.get('reply_to_message', '')
-            if not quote:
-                return
+        command = self.COMMANDS.get(name)
 
-            # Only text messages can be added as quotes
-            content_type, _, _ = telepot.glance(quote)
-            if content_type != 'text':
-                return
+        if command is None or chat_type not in command.chats:
+            # Direct messages can be plain text, to select a chat
+            if chat_type != 'private':
+                return None
 
-            quoted_by = m['from']
+            name, args = None, ''
 
-            # Forwarded messages
-            if 'forward_from' in quote:
-                sent_by = quote['forward_from']
-                sent_at = quote['forward_date']
-            else:
-                sent_by = quote['from']
-                sent_at = quote['date']
+        # Plain text selects a chat
+        priority = command.priority if name is not None else REPLY
+
+        chat_id = m['chat']['id']
+        return Request(m, chat_type, chat_id, chat_id, m['from']['id'],
+            m['message_id'], name, args, text, priority)
 
-            # Bot messages can't be added as quotes
-            if sent_by['id'] == self.user['id']:
-                response = "can't quote bot messages"
-                return self.sendMessage(
-                    origin, response, reply_to_message_id=message_id)
+    async def _handle(self, m):
+        request = self.parse(m)
+        if request is None:
+            return
 
-            # Users can't add their own messages as quotes
-            if sent_by['id'] == quoted_by['id']:
-                response = "can't quote own messages"
-                return self.sendMessage(
-                    origin, response, reply_to_message_id=message_id)
+        with self.metrics.timer('command_seconds',
+                command=request.command or 'text'):
+            await self._dispatch(request)
 
-            self.database.add_or_update_user(User.from_telegram(sent_by))
-            self.database.add_or_update_user(User.from_telegram(quoted_by))
+    async def _dispatch(self, request):
+        m = request.message
 
-            result = self.database.add_quote(
-                chat_id, quote['message_id'], sent_at, sent_by['id'],
-                quote['text'], quote.get('entities', list()), quoted_by['id'])
+        await self.run_db(
+            self.database.add_or_update_user, User.from_telegram(m['from']))
 
-            if result == QuoteDatabase.QUOTE_ADDED:
-                response = "quote added"
-            elif result == QuoteDatabase.QUOTE_ALREADY_EXISTS:
-                response = "quote already exists"
+        if request.chat_type != 'private':
+            await self.run_db(self.database.add_or_update_chat,
+                Chat.from_telegram(m['chat']))
+            await self.run_db(self.database.add_membership,
+                request.user_id, request.chat_id)
 
-            return self.sendMessage(
-                chat_id, response, reply_to_message_id=message_id)
+        command = self.COMMANDS.get(request.command)
 
         # Browse quotes via direct message
+        if request.chat_type == 'private' and (
+                command is None or command.browse):
+            request = await self._browse(request)
+            if request is None:
+                return
 
-        if chat_type == 'private':
-            code, data = self.database.get_or_create_state(user_id)
-            data = '' if data is None or not data else json.loads(data)
+        if command is not None:
+            await command.handler(self, request)
+
+    # Chat selection in direct messages
 
-            if command in ['start', 'chats'] or code == NO_CHAT_SPECIFIED:
-                chats = self.database.get_chats(user_id)
+    async def _browse(self, request):
+        """Returns the request with chat_id set to the chat the user is
+        browsing, or None if the message was used to select a chat."""
+        code, data = await self.run_db(
+            self.database.get_or_create_state, request.user_id)
+
+        if code == NO_CHAT_SPECIFIED:
+            await self.command_chats(request)
+            return None
+
+        elif code == SELECTING_CHAT:
+            await self._select_chat(request, data)
+            return None
+
+        # The data is the chat's ID, followed by the /list cursor if the
+        # user is paging through its quotes
+        return request._replace(chat_id=int(data.split(' ', 1)[0]))
+
+    async def _select_chat(self, request, data):
+        # The state's data lists the IDs of the chats that were offered
+        chat_ids = [int(chat_id) for chat_id in data.split()]
+        chats = await self.run_db(self.database.get_chat_titles, chat_ids)
+
+        choice = request.text.lower()
+
+        try:
+            i = int(choice)
+            if i < 0:
+                raise IndexError
+            selected_id, title = chats[i]
+        except IndexError:
+            return self._reply(request, "invalid chat number")
+        except ValueError:
+            try:
+                selected_id, title = next(filter(
+                    lambda chat: choice in (chat[1] or '').lower(), chats))
+            except StopIteration:
+                return self._reply(request, "no chat titles matched")
+
+        await self.run_db(self.database.set_state,
+            request.user_id, SELECTED_CHAT, data=str(selected_id))
+
+        response = 'selected chat "{0}"'.format(title)
+        self._reply(request, response, parse_mode='HTML')
+
+    async def command_chats(self, request):
+        key = (request.user_id, 'chats', '',
+            self.database.version(request.user_id))
+        cached = self.responses.get(key)
+
+        if cached is None:
+            chats = await self.run_db(
+                self.database.get_chats, request.user_id)
+            cached = self._chat_list(chats)
+            self.responses.put(key, cached)
+
+        response, data = cached
+
+        if data is not None:
+            await self.run_db(self.database.set_state, request.user_id,
+                SELECTING_CHAT, data=data)
+
+        return self._reply(request, response, parse_mode='HTML')
+
+    def _chat_list(self, chats):
+        """Returns the chat selection message, and the state data that lists
+        the chats, or None if there are no chats."""
+        if not chats:
+            return "<b>Chat selection</b>\nno chats found", None
+
+        response = [
+            "<b>Chat selection</b>",
+            "Choose a chat by its number or title:",
+            "",
+        ]
+
+        for i, (chat_id, chat_title) in enumerate(chats):
+            response.append("<b>[{0}]</b> {1}".format(i, chat_title))
+
+        data = ' '.join(str(chat_id) for chat_id, _ in chats)
+        return '\n'.join(response), data
+
+    async def command_list(self, request):
+        await self._send_page(request, None, request.args or None)
+
+    async def command_next(self, request):
+        _, data = await self.run_db(
+            self.database.get_or_create_state, request.user_id)
+
+        # chat_id sent_at quote_id [search]
+        cursor = data.split(' ', 3)
+        if len(cursor) < 3:
+            return self._reply(request,
+                "no more quotes: use /list to start from the first quote")
+
+        after = (int(cursor[1]), int(cursor[2]))
+        search = cursor[3] if len(cursor) > 3 else None
+
+        await self._send_page(request, after, search)
+
+    async def _send_page(self, request, after, search):
+        # One more quote than fits on the page shows whether there's a next
+        # page
+        results = await self.run_db(self.database.get_quote_page,
+            request.chat_id, after=after, search=search, limit=PAGE_SIZE + 1)
+        page = results[:PAGE_SIZE]
+
+        if not page:
+            response = "no quotes found" if after is None else "no more quotes"
+            return self._reply(request, response)
+
+        response = []
+        for quote, user in page:
+            date = datetime.fromtimestamp(quote.sent_at).strftime(DATE_FORMAT)
+            response.append('• "{0}" - {1} <i>{2}</i>'.format(
+                self._preview(quote), html.escape(user.first_name), date))
+
+        data = str(request.chat_id)
+        if len(results) > PAGE_SIZE:
+            last = page[-1].quote
+            data = '{0} {1} {2}'.format(request.chat_id, last.sent_at, last.id)
+            if search is not None:
+                data += ' ' + search
 
-                if not chats:
-                    response = "<b>Chat selection</b>\nno chats found"
-                    return self.sendMessage(
-                        origin, response, parse_mode='HTML')
+            response.append("")
+            response.append("/next for more")
+
+        await self.run_db(self.database.set_state,
+            request.user_id, SELECTED_CHAT, data=data)
+
+        self._reply(request, '\n'.join(response),
+            parse_mode='HTML')
+
+    def _preview(self, quote):
+        """Returns the quote's text as HTML, without formatting, cut to
+        PREVIEW_LENGTH characters."""
+        if quote.text is None:
+            text = html.unescape(TAG_PATTERN.sub('', quote.content or ''))
+        else:
+            text = quote.text
+
+        if len(text) > PREVIEW_LENGTH:
+            text = text[:PREVIEW_LENGTH - 1].rstrip() + '…'
+
+        return html.escape(text, quote=False)
+
+    async def command_which(self, request):
+        chat = await self.run_db(
+            self.database.get_chat_by_id, request.chat_id)
+        response = 'searching quotes from "{0}"'.format(chat.title)
+        return self._reply(request, response)
+
+    # Commands
+
+    async def command_about(self, request):
+        commit_hash = self.build['hash']
+        timestamp = self.build['timestamp']
+
+        if timestamp is None:
+            updated = updated_rel = 'unknown'
+        else:
+            updated = datetime.fromtimestamp(timestamp).strftime(TIME_FORMAT)
+            updated_rel = build.relative_date(timestamp)
+
+        info = {
+            'version': '.'.join((str(n) for n in VERSION)),
+            'updated': updated,
+            'updated_rel': updated_rel,
+            'repo_url': REPOSITORY_URL,
+            'repo_name': REPOSITORY_NAME,
+            'hash_url': REPOSITORY_URL + '/commit/' + commit_hash,
+            'hash': commit_hash[:7],
+        }
+
+        response = ['"Nice quote!" - <b>Soup Dumpling {version}</b>',
+            '<i>{updated} ({updated_rel})</i>',
+            '',
+            'Source code at <a href="{repo_url}">{repo_name}</a>',
+            'Running on commit <a href="{hash_url}">{hash}</a>',
+        ]
+
+        response = '\n'.join(response).format(**info)
+        return self._reply(request, response,
+            disable_web_page_preview=True, parse_mode='HTML')
+
+    async def command_addquote(self, request):
+        m = request.message
+        chat_id = request.chat_id
+        message_id = request.message_id
+
+        quote = m.get('reply_to_message', '')
+        if not quote:
+            return
 
-                response = [
-                    "<b>Chat selection</b>",
-                    "Choose a chat by its number or title:",
-                    "",
-                ]
+        # Only text messages can be added as quotes
+        if 'text' not in quote:
+            return
 
-                mapping = []
-                for i, (chat_id, chat_title) in enumerate(chats):
-                    response.append("<b>[{0}]</b> {1}".format(i, chat_title))
-                    mapping.append([i, chat_id, chat_title])
+        quoted_by = m['from']
+
+        # Forwarded messages
+        if 'forward_from' in quote:
+            sent_by = quote['forward_from']
+            sent_at = quote['forward_date']
+        else:
+            sent_by = quote['from']
+            sent_at = quote['date']
+
+        # Bot messages can't be added as quotes
+        if sent_by['id'] == self.user['id']:
+            response = "can't quote bot messages"
+            return self._reply(
+                request, response, reply_to_message_id=message_id)
+
+        # Users can't add their own messages as quotes
+        if sent_by['id'] == quoted_by['id']:
+            response = "can't quote own messages"
+            return self._reply(
+                request, response, reply_to_message_id=message_id)
+
+        await self.run_db(
+            self.database.add_or_update_user, User.from_telegram(sent_by))
+        await self.run_db(self.database.add_or_update_user,
+            User.from_telegram(quoted_by))
+
+        result = await self.run_db(self.database.add_quote,
+            chat_id, quote['message_id'], sent_at, sent_by['id'],
+            quote['text'], quote.get('entities', list()), quoted_by['id'])
+
+        if result == QuoteDatabase.QUOTE_ADDED:
+            response = "quote added"
+        elif result == QuoteDatabase.QUOTE_ALREADY_EXISTS:
+            response = "quote already exists"
+
+        return self._reply(
+            request, response, reply_to_message_id=message_id)
+
+    async def command_shuffle(self, request):
+        sampler = self.database.sampler
+        enabled = not sampler.is_shuffled(request.chat_id)
+        sampler.set_shuffled(request.chat_id, enabled)
+
+        if enabled:
+            response = "shuffle on: /random won't repeat a quote until " \
+                "every quote has been shown"
+        else:
+            response = "shuffle off"
+
+        return self._reply(request, response,
+            reply_to_message_id=request.message_id)
+
+    async def command_random(self, request):
+        result = await self.run_db(
+            self.database.get_random_quote, request.chat_id)
+
+        if result is None:
+            response = "no quotes in database"
+            self._reply(request, response)
+        else:
+            response = self._format_quote(*result)
+            self._send_quote(request, response, result.quote.id)
+
+    async def command_quotes(self, request):
+        args = request.args
+
+        key = (request.chat_id, 'quotes', args,
+            self.database.version(request.chat_id))
+        response = self.responses.get(key)
+
+        if response is None:
+            if not args:
+                count = await self.run_db(
+                    self.database.get_quote_count, request.chat_id)
+                response = "{0} quotes in this chat".format(count)
+            else:
+                count = await self.run_db(self.database.get_quote_count,
+                    request.chat_id, search=args)
+                response = ('{0} quotes in this chat '
+                    'for search term "{1}"').format(count, args)
 
-                self.database.set_state(
-                    user_id, SELECTING_CHAT, data=json.dumps(mapping))
+            self.responses.put(key, response)
 
-                response = '\n'.join(response)
-                return self.sendMessage(origin, response, parse_mode='HTML')
+        self._reply(request, response,
+            reply_to_message_id=request.message_id)
 
-            elif code == SELECTING_CHAT:
-                choice = text
+    async def command_stats(self, request):
+        window = request.args.strip().lower() if request.args else ''
+        if window and window not in STATS_WINDOWS:
+            response = "usage: /stats [{0}]".format('|'.join(STATS_WINDOWS))
+            return self._reply(request, response)
 
-                try:
-                    i = int(choice)
-                    _, selected_id, title = data[i]
-                except IndexError:
-                    return self.sendMessage(chat_id, "invalid chat number")
-                except ValueError:
-                    try:
-                        _, selected_id, title = next(filter(data,
-                            lambda chat: choice.lower() in chat[2].lower()))
-                    except StopIteration:
-                        return self.sendMessage(
-                            chat_id, "no chat titles matched")
+        # Windows start at the beginning of a UTC day
+        since = None
+        if window:
+            since = day_of(int(time.time())) - STATS_WINDOWS[window] + 1
 
-                self.database.set_state(
-                    user_id, SELECTED_CHAT, data=str(selected_id))
+        key = (request.chat_id, 'stats', since,
+            self.database.version(request.chat_id))
+        response = self.responses.get(key)
 
-                response = 'selected chat "{0}"'.format(title)
-                self.sendMessage(origin, response, parse_mode='HTML')
+        if response is None:
+            response = await self._build_stats(request.chat_id, window, since)
+            self.responses.put(key, response)
 
-                chat_id = selected_id
+        self._reply(request, response, parse_mode='HTML')
 
-            elif code == SELECTED_CHAT:
-                chat_id = int(self.database.get_state(user_id)[1])
+    async def _build_stats(self, chat_id, window='', since=None):
+        response = list()
 
-                if command == 'which':
-                    chat = self.database.get_chat_by_id(chat_id)
-                    response = 'searching quotes from "{0}"'.format(chat.title)
-                    return self.sendMessage(origin, response)
+        # Overall
+        if since is None:
+            first_quote = await self.run_db(
+                self.database.get_first_quote, chat_id)
+            if first_quote is None:
+                return "no quotes in database"
 
-        # Find quotes
+            total_count = await self.run_db(
+                self.database.get_quote_count, chat_id)
+            first_quote_dt = first_quote.sent_at
 
-        if command == 'random':
-            result = self.database.get_random_quote(chat_id)
+            response.append("<b>Total quote count</b>")
+            response.append("• {0} quotes since {1}".format(total_count,
+                datetime.fromtimestamp(first_quote_dt).strftime(TIME_FORMAT)))
+        else:
+            total_count = await self.run_db(
+                self.database.get_quote_count, chat_id, since=since)
+            if total_count == 0:
+                return "no quotes from the past {0}".format(window)
 
-            if result is None:
-                response = "no quotes in database"
-                self.sendMessage(origin, response)
-            else:
-                response = self._format_quote(*result)
-                self._send_quote(origin, response, result.quote.id)
+            start = datetime.fromtimestamp(since * DAY, timezone.utc)
 
-        elif command == 'quotes':
-            if not args:
-                count = self.database.get_quote_count(chat_id)
-                response = "{0} quotes in this chat".format(count)
-            else:
-                count = self.database.get_quote_count(chat_id, search=args)
-                response = ('{0} quotes in this chat '
-                    'for search term "{1}"').format(count, args)
+            response.append("<b>Quotes from the past {0}</b>".format(window))
+            response.append("• {0} quotes since {1}".format(total_count,
+                start.strftime(DATE_FORMAT)))
 
-            self.sendMessage(origin, response, reply_to_message_id=message_id)
+        response.append("")
 
-        elif command == 'stats':
-            # Overall
-            total_count = self.database.get_quote_count(chat_id)
-            first_quote_dt = self.database.get_first_quote(chat_id).sent_at
+        # Users
+        most_quoted = await self.run_db(
+            self.database.get_most_quoted, chat_id, limit=5, since=since)
 
-            response = list()
+        response.append("<b>Users with the most quotes</b>")
+        for count, name in most_quoted:
+            response.append("• {0} ({1:.1%}): {2}".format(
+                count, count / total_count, name))
+        response.append("")
 
-            response.append("<b>Total quote count</b>")
-            response.append("• {0} quotes since {1}".format(total_count,
-                datetime.fromtimestamp(first_quote_dt).strftime(TIME_FORMAT)))
-            response.append("")
+        added_most = await self.run_db(
+            self.database.get_most_quotes_added, chat_id, limit=5,
+            since=since)
 
-            # Users
-            most_quoted = self.database.get_most_quoted(chat_id, limit=5)
+        response.append("<b>Users who add the most quotes</b>")
+        for count, name in added_most:
+            response.append("• {0} ({1:.1%}): {2}".format(
+                count, count / total_count, name))
 
-            response.append("<b>Users with the most quotes</b>")
-            for count, name in most_quoted:
-                response.append("• {0} ({1:.1%}): {2}".format(
-                    count, count / total_count, name))
-            response.append("")
+        return '\n'.join(response)
 
-            added_most = self.database.get_most_quotes_added(chat_id, limit=5)
+    async def command_author(self, request):
+        if not request.args:
+            return
 
-            response.append("<b>Users who add the most quotes</b>")
-            for count, name in added_most:
-                response.append("• {0} ({1:.1%}): {2}".format(
-                    count, count / total_count, name))
+        authors = await self.run_db(self.database.find_authors,
+            request.chat_id, request.args)
 
-            self.sendMessage(origin, '\n'.join(response), parse_mode='HTML')
+        if len(authors) > 1:
+            response = ['several users match "{0}":'.format(request.args)]
 
-        elif command == 'author':
-            if not args:
-                return
+            for user, count in authors[:AUTHOR_CHOICES]:
+                name = ' '.join(filter(None, (user.first_name,
+                    user.last_name, user.username and '@' + user.username)))
+                response.append("• {0} ({1} quotes)".format(name, count))
 
-            result = self.database.get_random_quote(chat_id, name=args)
+            return self._reply(request, '\n'.join(response))
 
-            if result is None:
-                response = 'no quotes found by author "{}"'.format(args)
-                self.sendMessage(origin, response)
-            else:
-                response = self._format_quote(*result)
-                self._send_quote(origin, response, result.quote.id)
+        result = None
+        if authors:
+            result = await self.run_db(self.database.get_random_quote,
+                request.chat_id, user_id=authors[0][0].id)
 
-        elif command == 'search':
-            if not args:
-                return
+        if result is None:
+            response = 'no quotes found by author "{}"'.format(request.args)
+            self._reply(request, response)
+        else:
+            response = self._format_quote(*result)
+            self._send_quote(request, response, result.quote.id)
 
-            result = self.database.search_quote(chat_id, args)
+    async def command_search(self, request):
+        if not request.args:
+            return
 
-            if result is None:
-                response = 'no quotes found for search terms "{}"'.format(args)
-                self.sendMessage(origin, response)
-            else:
-                response = self._format_quote(*result)
-                self._send_quote(origin, response, result.quote.id)
+        result = await self.run_db(
+            self.database.search_quote, request.chat_id, request.args)
+
+        if result is None:
+            response = 'no quotes found for search terms "{}"'.format(
+                request.args)
+            self._reply(request, response)
+        else:
+            response = self._format_quote(*result)
+            self._send_quote(request, response, result.quote.id)
+
+    COMMANDS = {
+        'about': Command(command_about, ANYWHERE, browse=False,
+            priority=NOTICE),
+        'start': Command(command_chats, PRIVATE, browse=False,
+            priority=REPLY),
+        'chats': Command(command_chats, PRIVATE, browse=False,
+            priority=REPLY),
+        'which': Command(command_which, PRIVATE, browse=True,
+            priority=REPLY),
+        'list': Command(command_list, PRIVATE, browse=True,
+            priority=NOTICE),
+        'next': Command(command_next, PRIVATE, browse=True,
+            priority=NOTICE),
+        'addquote': Command(command_addquote, GROUPS, browse=False,
+            priority=REPLY),
+        'shuffle': Command(command_shuffle, GROUPS, browse=False,
+            priority=REPLY),
+        'random': Command(command_random, ANYWHERE, browse=True,
+            priority=NOTICE),
+        'quotes': Command(command_quotes, ANYWHERE, browse=True,
+            priority=NOTICE),
+        'stats': Command(command_stats, ANYWHERE, browse=True,
+            priority=NOTICE),
+        'author': Command(command_author, ANYWHERE, browse=True,
+            priority=NOTICE),
+        'search': Command(command_search, ANYWHERE, browse=True,
+            priority=NOTICE),
+    }
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--metrics-port', type=int,
+        help="serve Prometheus metrics on this local port")
+    parser.add_argument('--metrics-file',
+        help="write Prometheus metrics to this file every 15 seconds")
+    parser.add_argument('--shards', type=int, default=1,
+        help="number of database files to spread new chats' quotes across")
+    parser.add_argument('--workers', type=int, default=1,
+        help="number of worker processes to handle updates in")
+    parser.add_argument('--compress', action='store_true',
+        help="compress long quotes as they're added")
+    parser.add_argument('--webhook-port', type=int,
+        help="receive updates through a webhook on this port, instead of "
+            "polling")
+    parser.add_argument('--webhook-host', default='127.0.0.1',
+        help="address for the webhook to listen on")
+    parser.add_argument('--webhook-url',
+        help="public URL that forwards to the webhook, to register with "
+            "Telegram")
+    args = parser.parse_args()
+
+    if args.webhook_port is not None and args.workers > 1:
+        parser.error("--webhook-port can't be used with --workers")
+
+    logging.basicConfig(level=logging.INFO)
+
     with open('tokens/soup.txt', 'r') as f:
         token = f.read().strip()
 
-    bot = QuoteBot(token)
-    bot.message_loop()
-
-    while True:
-        time.sleep(10)
+    if args.workers > 1:
+        options = {'workers': args.workers, 'shards': args.shards,
+            'compress': args.compress, 'metrics_port': args.metrics_port,
+            'metrics_file': args.metrics_file}
+
+        try:
+            supervise(token, args.workers, options)
+        except SchemaTooNew as e:
+            logging.critical("refusing to start: %s", e)
+        return
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    # Webhook instances behind a load balancer each get a share of the
+    # updates, and an update that one instance failed to take can be
+    # delivered to another, so update IDs can't be checkpointed. Updates are
+    # answered once they're queued, and queued updates are handled before
+    # the bot stops, so Telegram only delivers an update again if it was
+    # never taken.
+    checkpoint = 'last_update_id' if args.webhook_port is None else None
+
+    try:
+        bot = QuoteBot(token, loop=loop, shards=args.shards,
+            compress=args.compress, checkpoint=checkpoint)
+    except SchemaTooNew as e:
+        logging.critical("refusing to start: %s", e)
+        loop.close()
+        return
+    loop.run_until_complete(bot.start())
+
+    if args.metrics_port is not None:
+        serve(bot.metrics, args.metrics_port)
+
+    if args.metrics_file is not None:
+        write_periodically(bot.metrics, args.metrics_file)
+
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    webhook = updates = None
+
+    if args.webhook_port is not None:
+        webhook = WebhookServer(bot.handle_update,
+            load_secret('tokens/webhook.txt'), bot.metrics)
+        loop.run_until_complete(
+            webhook.start(args.webhook_host, args.webhook_port))
+
+        if args.webhook_url is not None:
+            loop.run_until_complete(
+                register(bot, args.webhook_url, webhook.secret))
+    else:
+        updates = loop.create_task(bot.poll(bot.on_update))
+
+    try:
+        loop.run_until_complete(stop.wait())
+    finally:
+        if webhook is not None:
+            loop.run_until_complete(webhook.stop())
+        else:
+            updates.cancel()
+
+        loop.run_until_complete(bot.shutdown())
+        loop.close()
 
 
 if __name__ == '__main__':
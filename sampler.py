@@ -0,0 +1,159 @@
+import random
+import threading
+from array import array
+from collections import OrderedDict
+
+
+class _Loading:
+    """A load of a chat's IDs that is in progress."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # IDs of quotes added to the chat during the load
+        self.added = []
+
+
+class QuoteSampler:
+    """Picks random quote IDs from a per-chat, in-memory index of IDs, so that
+    a random pick doesn't depend on the number of quotes in the chat.
+
+    Chats can be switched to shuffle mode, in which quotes are dealt from a
+    shuffled deck and don't repeat until every quote has been shown.
+
+    Any hashable key can stand for a chat, e.g. (chat ID, user ID) for an
+    index of each user's quotes in a chat."""
+
+    def __init__(self, load, max_chats=1000):
+        # load(chat_id) returns an iterable of the IDs of the chat's quotes
+        self.load = load
+        self.max_chats = max_chats
+
+        self._ids = OrderedDict()
+        self._decks = dict()
+        self._shuffled = set()
+        self._lock = threading.Lock()
+
+        # Chats whose IDs are being loaded
+        self._loading = dict()
+
+    def _get_ids(self, chat_id):
+        """Returns the chat's index, loading it if it isn't loaded. Called
+        without the lock, so that loading a large chat doesn't hold up picks
+        in other chats. Concurrent loads of the same chat wait for each
+        other."""
+        with self._lock:
+            ids = self._cached_ids(chat_id)
+            if ids is not None:
+                return ids
+
+            loading = self._loading.get(chat_id)
+            if loading is None:
+                loading = self._loading[chat_id] = _Loading()
+
+        with loading.lock:
+            # Another thread may have loaded it while this one waited
+            with self._lock:
+                ids = self._cached_ids(chat_id)
+                if ids is not None:
+                    return ids
+
+            ids = array('q', self.load(chat_id))
+
+            with self._lock:
+                # An invalidation during the load drops this load's entry, so
+                # that its possibly stale IDs are used once but not kept
+                if self._loading.get(chat_id) is not loading:
+                    return ids
+                del self._loading[chat_id]
+
+                # Quotes added during the load may be missing from its result
+                if loading.added:
+                    loaded = set(ids)
+                    ids.extend(quote_id for quote_id in loading.added
+                        if quote_id not in loaded)
+
+                self._ids[chat_id] = ids
+
+                # Evict the least recently used chat
+                if len(self._ids) > self.max_chats:
+                    evicted, _ = self._ids.popitem(last=False)
+                    self._decks.pop(evicted, None)
+
+                return ids
+
+    def _cached_ids(self, chat_id):
+        # Called with the lock held
+        ids = self._ids.get(chat_id)
+        if ids is not None:
+            self._ids.move_to_end(chat_id)
+        return ids
+
+    def sample(self, chat_id):
+        """Returns the ID of a random quote from the chat, or None if the chat
+        has no quotes."""
+        ids = self._get_ids(chat_id)
+
+        with self._lock:
+            if not ids:
+                return None
+
+            if chat_id not in self._shuffled:
+                return ids[random.randrange(len(ids))]
+
+            deck = self._decks.get(chat_id)
+            if not deck:
+                deck = array('q', ids)
+                random.shuffle(deck)
+
+                # Only the loaded index gets a deck
+                if self._ids.get(chat_id) is ids:
+                    self._decks[chat_id] = deck
+
+            return deck.pop()
+
+    def add(self, chat_id, quote_id):
+        """Adds a new quote to the chat's index, if it's loaded."""
+        with self._lock:
+            ids = self._ids.get(chat_id)
+            if ids is None:
+                loading = self._loading.get(chat_id)
+                if loading is not None:
+                    loading.added.append(quote_id)
+                return
+
+            ids.append(quote_id)
+
+            # Deal the new quote at a random point in the current deck
+            deck = self._decks.get(chat_id)
+            if deck:
+                deck.append(quote_id)
+                i = random.randrange(len(deck))
+                deck[i], deck[-1] = deck[-1], deck[i]
+
+    def count(self, chat_id):
+        """Returns the number of IDs in the chat's index, or None if it isn't
+        loaded."""
+        with self._lock:
+            ids = self._ids.get(chat_id)
+            return None if ids is None else len(ids)
+
+    def invalidate(self, chat_id):
+        """Drops the chat's index, so that it's reloaded on the next pick."""
+        with self._lock:
+            self._ids.pop(chat_id, None)
+            self._decks.pop(chat_id, None)
+            self._loading.pop(chat_id, None)
+
+    def is_shuffled(self, chat_id):
+        """Returns whether the chat is in shuffle mode."""
+        return chat_id in self._shuffled
+
+    def set_shuffled(self, chat_id, enabled):
+        """Turns shuffle mode on or off for the chat."""
+        with self._lock:
+            if enabled:
+                self._shuffled.add(chat_id)
+            else:
+                self._shuffled.discard(chat_id)
+                self._decks.pop(chat_id, None)
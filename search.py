@@ -0,0 +1,118 @@
+"""Keeps the full-text search index over quotes, used by /search, /quotes
+<term> and /list <term>.
+
+quote_fts is a contentless FTS5 table: it stores the index, but not a copy
+of the text, which is already in the quote table (compressed, for long
+quotes). Each quote is indexed with its chat's token, its plain text and its
+sender's name. Rows are written from Python rather than by triggers, since
+compressed text has to be decompressed to be indexed, and a contentless
+table can only remove a row given the values that it was indexed with.
+
+Quotes that are added, removed or whose sender is renamed outside the bot
+(e.g. with the sqlite3 shell) aren't reindexed. `python3 maintenance.py
+reindex` rebuilds the index."""
+import re
+
+from compression import decompress
+from entities import strip
+
+
+SEARCH_TOKEN = re.compile(r'\w+')
+
+# The tokenizer splits on "-", so negative chat IDs are spelled with an "n".
+# Must match chat_token().
+CHAT_TOKEN = "'c' || replace({0}, '-', 'n')"
+
+AUTHOR = """{0}.first_name || ' ' || IFNULL({0}.last_name, '') || ' ' ||
+    IFNULL({0}.username, '')"""
+
+# The values that the quotes matching a condition are indexed with
+SELECT_INDEXED = """SELECT quote.id, """ + CHAT_TOKEN.format('quote.chat_id') \
+    + """, quote.text, quote.content, """ + AUTHOR.format('user') + """
+    FROM {0}.quote AS quote LEFT JOIN {0}.user AS user
+    ON user.id = quote.sent_by
+    WHERE {1};"""
+
+INSERT = """INSERT INTO {0}.quote_fts (rowid, chat, content, author)
+    VALUES (?, ?, ?, ?);"""
+
+DELETE = """INSERT INTO {0}.quote_fts (quote_fts, rowid, chat, content, author)
+    VALUES ('delete', ?, ?, ?, ?);"""
+
+# Indexes a new quote whose raw text is given, without decompressing it
+INSERT_QUOTE = """INSERT INTO quote_fts (rowid, chat, content, author)
+    VALUES (:id, """ + CHAT_TOKEN.format(':chat_id') + """, :text,
+    (SELECT """ + AUTHOR.format('user') + """ FROM user
+        WHERE id = :sent_by));"""
+
+
+def chat_token(chat_id):
+    """Returns the token that the search index tags a chat's quotes with."""
+    return 'c{0}{1}'.format('n' if chat_id < 0 else '', abs(chat_id))
+
+
+def search_text(text, content):
+    """Returns a quote's plain text for the search index: its raw text, or
+    for quotes added before the raw text was kept, its content without
+    HTML."""
+    if text is not None:
+        return decompress(text)
+
+    return strip(content) if content is not None else None
+
+
+def match_query(search, chat_id, column=None):
+    """Converts user input into an FTS5 query that matches every word in it
+    as a prefix, in the chat's quotes, or returns None if the input contains
+    no words."""
+    tokens = SEARCH_TOKEN.findall(search)
+    if not tokens:
+        return None
+
+    query = ' '.join('"{0}"*'.format(token) for token in tokens)
+
+    if column is not None:
+        query = '{0} : ({1})'.format(column, query)
+
+    # The chat is matched by the index, instead of filtering out other
+    # chats' matches afterwards
+    return 'chat : "{0}" AND ({1})'.format(chat_token(chat_id), query)
+
+
+def indexed_rows(c, where, parameters=(), schema='main'):
+    """Returns the rows that the quotes matching an SQL condition on the
+    quote table are indexed with."""
+    c.execute(SELECT_INDEXED.format(schema, where), parameters)
+
+    return [(quote_id, chat, search_text(text, content), author)
+        for quote_id, chat, text, content, author in c.fetchall()]
+
+
+def index_quotes(c, where='1', parameters=(), schema='main'):
+    """Adds the quotes that match an SQL condition on the quote table to the
+    index, in c's transaction."""
+    # Read with a cursor of its own, so that c can write while this one reads
+    select = c.connection.cursor()
+    select.execute(SELECT_INDEXED.format(schema, where), parameters)
+
+    c.executemany(INSERT.format(schema),
+        ((quote_id, chat, search_text(text, content), author)
+            for quote_id, chat, text, content, author in select))
+
+
+def remove_rows(c, rows, schema='main'):
+    """Removes rows returned by indexed_rows() from the index."""
+    c.executemany(DELETE.format(schema), rows)
+
+
+def unindex_quotes(c, where, parameters=(), schema='main'):
+    """Removes the quotes that match an SQL condition on the quote table from
+    the index, in c's transaction. Must be called before the quotes are
+    deleted or their senders renamed."""
+    remove_rows(c, indexed_rows(c, where, parameters, schema), schema)
+
+
+def rebuild(c):
+    """Empties the index and indexes every quote again."""
+    c.execute("INSERT INTO quote_fts (quote_fts) VALUES ('delete-all');")
+    index_quotes(c)
@@ -0,0 +1,166 @@
+"""Shows and changes which database file each chat's quotes are in.
+
+    python3 shards.py status --shards 4
+    python3 shards.py rebalance --shards 4
+    python3 shards.py move -1001234567890 2 --shards 4
+
+Chats are assigned to one of `--shards` files the first time the bot sees
+them, so existing chats stay where they are when the number of shards
+changes. `rebalance` moves every chat to the shard it would be assigned to
+now, and `move` moves a single chat.
+
+Stop the bot before moving chats: it remembers where each chat is."""
+import argparse
+import sys
+import time
+
+import search
+from database import QuoteDatabase
+
+
+QUOTE_FIELDS = """chat_id, message_id, sent_at, sent_by, content, quoted_by,
+    text, entities"""
+
+
+def status(database):
+    """Returns the number of chats and quotes in each shard."""
+    counts = []
+
+    for shard, manager in enumerate(database.shards):
+        c = manager.get().cursor()
+        c.execute("SELECT COUNT(*), IFNULL(SUM(quote_count), 0) "
+            "FROM chat_stats WHERE quote_count > 0;")
+        chats, quotes = c.fetchone()
+
+        counts.append((shard, manager.filename, chats, quotes))
+
+    return counts
+
+
+def move_chat(database, chat_id, target):
+    """Moves a chat's quotes to another shard, and returns the number of
+    quotes moved.
+
+    Quotes are copied, then the chat is reassigned, then the old copies are
+    deleted, each in its own transaction. If a move is interrupted, running
+    it again finishes it."""
+    source = database.shard_of(chat_id)
+    if source == target:
+        return 0
+
+    db = database.shards[source].get()
+    c = db.cursor()
+
+    c.execute("ATTACH DATABASE ? AS target;",
+        (database.shards[target].filename,))
+
+    try:
+        c.execute("SELECT IFNULL(MAX(id), 0) FROM target.quote;")
+        after = c.fetchone()[0]
+
+        # The target's triggers fill its stats
+        c.execute("""INSERT INTO target.quote (""" + QUOTE_FIELDS + """)
+            SELECT """ + QUOTE_FIELDS + """ FROM main.quote
+            WHERE chat_id = ? ORDER BY id
+            ON CONFLICT (chat_id, message_id) DO NOTHING;""", (chat_id,))
+        search.index_quotes(c, "quote.id > ?", (after,), schema='target')
+        db.commit()
+
+        database.db.execute(
+            "UPDATE chat_shard SET shard = ? WHERE chat_id = ?;",
+            (target, chat_id))
+        database.db.commit()
+        database._chat_shards[chat_id] = target
+
+        search.unindex_quotes(c, "quote.chat_id = ?", (chat_id,))
+        c.execute("DELETE FROM main.quote WHERE chat_id = ?;", (chat_id,))
+        moved = c.rowcount
+        c.execute("DELETE FROM main.chat_stats WHERE chat_id = ?;",
+            (chat_id,))
+        c.execute("DELETE FROM main.user_stats WHERE chat_id = ?;",
+            (chat_id,))
+        c.execute("DELETE FROM main.quote_daily WHERE chat_id = ?;",
+            (chat_id,))
+        c.execute("DELETE FROM main.quote_monthly WHERE chat_id = ?;",
+            (chat_id,))
+        db.commit()
+    finally:
+        c.execute("DETACH DATABASE target;")
+
+    database.sampler.invalidate(chat_id)
+    return moved
+
+
+def rebalance(database):
+    """Moves every chat to the shard it would be assigned to now. Yields the
+    chats that were moved, and the number of quotes in each."""
+    c = database.db.cursor()
+    c.execute("SELECT chat_id FROM chat_shard ORDER BY chat_id;")
+
+    for chat_id, in c.fetchall():
+        target = abs(chat_id) % database.shard_count
+
+        if database.shard_of(chat_id) != target:
+            yield chat_id, move_chat(database, chat_id, target)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', default='data.db')
+    parser.add_argument('--shards', type=int, default=1,
+        help="number of shards to assign chats to")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('status', help="show the chats and quotes per shard")
+    commands.add_parser('rebalance',
+        help="move chats to the shards they'd be assigned to now")
+
+    mover = commands.add_parser('move', help="move a chat to a shard")
+    mover.add_argument('chat_id', type=int)
+    mover.add_argument('shard', type=int)
+
+    args = parser.parse_args()
+
+    database = QuoteDatabase(args.database, write_behind=False,
+        online=False, shards=args.shards)
+    start = time.perf_counter()
+
+    try:
+        # Copy users that were added while a shard wasn't in use, so the
+        # moved quotes' authors are indexed
+        if args.command in ('rebalance', 'move'):
+            for manager in database.shards[1:]:
+                database.copy_users(manager.get())
+
+        if args.command == 'status':
+            for shard, filename, chats, quotes in status(database):
+                print("{0}: {1} chats, {2} quotes ({3})".format(
+                    shard, chats, quotes, filename))
+
+        elif args.command == 'rebalance':
+            total = 0
+            for chat_id, moved in rebalance(database):
+                print("moved {0} quotes from chat {1}".format(moved, chat_id),
+                    file=sys.stderr)
+                total += moved
+
+            print("moved {0} quotes in {1:.1f} s".format(
+                total, time.perf_counter() - start), file=sys.stderr)
+
+        elif args.command == 'move':
+            if not 0 <= args.shard < len(database.shards):
+                print("error: no shard {0}".format(args.shard),
+                    file=sys.stderr)
+                return 1
+
+            moved = move_chat(database, args.chat_id, args.shard)
+            print("moved {0} quotes in {1:.1f} s".format(
+                moved, time.perf_counter() - start), file=sys.stderr)
+    finally:
+        database.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,116 @@
+"""A small asyncio client for the Telegram Bot API.
+
+The HTTP session is created on first use, inside the event loop that makes
+the requests, so a client can be constructed before its loop runs and each
+process builds its own."""
+import asyncio
+import logging
+
+import aiohttp
+
+
+log = logging.getLogger('soup.telegram')
+
+API_URL = 'https://api.telegram.org/bot{0}/{1}'
+
+# Seconds that a request can take, on top of getUpdates' long-poll timeout
+REQUEST_TIMEOUT = 30
+
+# Seconds between getUpdates calls, and after a failed call
+POLL_RELAX = 0.1
+POLL_RETRY = 5
+
+
+class TelegramError(Exception):
+    """Raised when the Bot API answers a request with an error."""
+
+    def __init__(self, description, error_code, json):
+        super().__init__(description, error_code)
+        self.description = description
+        self.error_code = error_code
+        self.json = json
+
+
+class TooManyRequestsError(TelegramError):
+    """Raised for 429 Too Many Requests. The response's parameters say how
+    long to wait before retrying."""
+
+
+class Bot:
+    def __init__(self, token, loop=None):
+        self.token = token
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self._session = None
+
+    async def _api_request(self, method, params=None, timeout=None):
+        """Calls a Bot API method, and returns its result."""
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+
+        # Unset optional parameters are left out
+        params = {name: value for name, value in (params or {}).items()
+            if value is not None}
+
+        total = REQUEST_TIMEOUT + (timeout or 0)
+
+        async with self._session.post(API_URL.format(self.token, method),
+                json=params, timeout=aiohttp.ClientTimeout(total=total)) as r:
+            try:
+                data = await r.json(content_type=None)
+            except ValueError:
+                data = None
+
+        if not isinstance(data, dict):
+            raise TelegramError("HTTP {0}".format(r.status), r.status, None)
+
+        if data.get('ok'):
+            return data['result']
+
+        description = data.get('description', '')
+        error_code = data.get('error_code')
+
+        if error_code == 429:
+            raise TooManyRequestsError(description, error_code, data)
+        raise TelegramError(description, error_code, data)
+
+    async def getMe(self):
+        return await self._api_request('getMe')
+
+    async def sendMessage(self, chat_id, text, **options):
+        params = dict(options, chat_id=chat_id, text=text)
+        return await self._api_request('sendMessage', params)
+
+    async def getUpdates(self, offset=None, timeout=0, allowed_updates=None):
+        return await self._api_request('getUpdates', {
+            'offset': offset,
+            'timeout': timeout,
+            'allowed_updates': allowed_updates,
+        }, timeout=timeout)
+
+    async def poll(self, on_update, timeout=20):
+        """Long-polls getUpdates and calls on_update(update) for each update,
+        in order, until cancelled."""
+        offset = None
+
+        while True:
+            try:
+                updates = await self.getUpdates(offset=offset,
+                    timeout=timeout, allowed_updates=['message',
+                        'edited_message'])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("couldn't get updates")
+                await asyncio.sleep(POLL_RETRY)
+                continue
+
+            for update in updates:
+                on_update(update)
+                offset = update['update_id'] + 1
+
+            await asyncio.sleep(POLL_RELAX)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
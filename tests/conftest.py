@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+# The bot's modules are at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from classes import User
+from database import QuoteDatabase
+
+
+@pytest.fixture
+def database(tmp_path):
+    """A fresh database with two users, whose upserts are written
+    immediately."""
+    database = QuoteDatabase(str(tmp_path / 'data.db'), write_behind=False,
+        online=False)
+    database.add_or_update_user(User(1, 'Alice', 'Smith', 'alice'))
+    database.add_or_update_user(User(2, 'Bob'))
+
+    yield database
+
+    database.close()
@@ -0,0 +1,60 @@
+import compression
+from compression import Compressor, decompress
+
+
+LONG_TEXT = "the soup of the day is the soup of yesterday, reheated " * 10
+
+
+def test_short_values_are_not_compressed():
+    compressor = Compressor()
+
+    assert compressor.compress("soup") == "soup"
+    assert compressor.compress(None) is None
+    assert decompress("soup") == "soup"
+    assert decompress(None) is None
+
+
+def test_round_trip_without_dictionary():
+    compressed = Compressor().compress(LONG_TEXT)
+
+    assert isinstance(compressed, bytes)
+    assert len(compressed) < len(LONG_TEXT)
+    assert decompress(compressed) == LONG_TEXT
+
+
+def test_round_trip_with_dictionary():
+    dictionary = compression.train([LONG_TEXT, "soup of the day"] * 5)
+    compressor = Compressor(dictionary)
+
+    text = "yesterday's soup of the day, reheated: " + "ünïcode " * 20
+    compressed = compressor.compress(text)
+
+    assert isinstance(compressed, bytes)
+    assert decompress(compressed) == text
+
+
+def test_values_under_the_threshold_stay_text():
+    text = 'a' * (compression.THRESHOLD - 1)
+
+    assert Compressor().compress(text) == text
+    assert isinstance(Compressor().compress(text + 'a'), bytes)
+
+
+def test_quotes_round_trip_through_the_database(database):
+    database.compressor = Compressor()
+    entities = [{'type': 'bold', 'offset': 0, 'length': 3}]
+
+    database.add_quote(-5, 1, 1700000000, 1, LONG_TEXT, entities, 2)
+
+    # Compressed quotes don't keep their HTML, but are still searchable
+    db = database.shard(-5)
+    text, content = db.execute(
+        "SELECT text, content FROM quote WHERE message_id = 1;").fetchone()
+    assert isinstance(text, bytes)
+    assert content is None
+    assert database.get_quote_count(-5, search='reheated') == 1
+
+    quote, user = database.get_random_quote(-5)
+    assert quote.text == LONG_TEXT
+    assert quote.entities == entities
+    assert user.first_name == 'Alice'
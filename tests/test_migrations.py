@@ -0,0 +1,148 @@
+import sqlite3
+
+import pytest
+
+import migrations
+from database import DAY, QuoteDatabase
+
+
+# The schema before it was versioned
+BASELINE = """
+CREATE TABLE user (
+    id INTEGER PRIMARY KEY,
+    first_name TEXT NOT NULL,
+    last_name TEXT,
+    username TEXT UNIQUE
+);
+
+CREATE TABLE chat (
+    id INTEGER PRIMARY KEY,
+    type TEXT NOT NULL
+        CHECK (type IN ('private', 'group', 'supergroup', 'channel')),
+    title TEXT,
+    username TEXT
+);
+
+CREATE TABLE membership (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES user (id),
+    chat_id INTEGER NOT NULL REFERENCES chat (id),
+
+    UNIQUE(user_id, chat_id) ON CONFLICT ROLLBACK
+);
+
+CREATE TABLE state (
+    user_id INTEGER PRIMARY KEY REFERENCES user (id),
+    chat_id INTEGER NOT NULL REFERENCES chat (id),
+    code INTEGER NOT NULL DEFAULT 0,
+    data TEXT DEFAULT ''
+);
+
+CREATE TABLE quote (
+    id INTEGER PRIMARY KEY,
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    sent_at INTEGER NOT NULL,
+    sent_by INTEGER NOT NULL REFERENCES user (id),
+    content TEXT,
+    quoted_by INTEGER REFERENCES user (id),
+
+    UNIQUE(chat_id, message_id) ON CONFLICT ROLLBACK
+);
+"""
+
+SENT_AT = 1700000000
+
+
+@pytest.fixture
+def baseline(tmp_path):
+    """A database with the unversioned schema and a few quotes, whose HTML
+    is all that was kept."""
+    filename = str(tmp_path / 'data.db')
+
+    db = sqlite3.connect(filename)
+    db.executescript(BASELINE)
+    db.executemany("INSERT INTO user VALUES (?, ?, ?, ?);",
+        [(1, 'Alice', 'Smith', 'alice'), (2, 'Bob', None, None)])
+    db.executemany("INSERT INTO chat VALUES (?, ?, ?, ?);",
+        [(-5, 'group', 'Soup', None), (-6, 'group', 'Stew', None)])
+    db.executemany("""INSERT INTO quote (chat_id, message_id, sent_at,
+        sent_by, content, quoted_by) VALUES (?, ?, ?, ?, ?, ?);""", [
+        (-5, 1, SENT_AT, 1, '<i>hot</i> soup &amp; dumplings', 2),
+        (-5, 2, SENT_AT + DAY, 2, 'cold soup', 1),
+        (-6, 1, SENT_AT, 2, 'stew', None),
+    ])
+    db.commit()
+    db.close()
+
+    return filename
+
+
+def test_baseline_migrates_to_latest(baseline):
+    database = QuoteDatabase(baseline, write_behind=False, online=False)
+
+    try:
+        assert migrations.get_version(database.db) == migrations.LATEST
+        assert migrations.deferred(database.db) == []
+
+        # Derived tables are filled from the existing quotes
+        assert database.get_quote_count(-5) == 2
+        assert database.get_quote_count(-6) == 1
+        assert database.get_first_quote(-5).message_id == 1
+
+        since = SENT_AT // DAY
+        assert database.get_quote_count(-5, since=since) == 2
+        assert database.get_quote_count(-5, since=since + 1) == 1
+        assert [count for count, _ in
+            database.get_most_quoted(-5, since=since)] == [1, 1]
+        assert [count for count, _ in
+            database.get_most_quoted(-5, since=since + 1)] == [1]
+
+        # The search index is built from the HTML, without its markup
+        assert database.get_quote_count(-5, search='soup') == 2
+        assert database.get_quote_count(-5, search='dumpl') == 1
+        assert database.get_quote_count(-5, search='amp') == 0
+        assert database.get_quote_count(-5, search='i') == 0
+        assert database.get_quote_count(-5, search='stew') == 0
+        assert database.search_quote(-5, 'hot').quote.message_id == 1
+    finally:
+        database.close()
+
+
+def test_migrating_again_changes_nothing(baseline):
+    QuoteDatabase(baseline, write_behind=False, online=False).close()
+
+    database = QuoteDatabase(baseline, write_behind=False, online=False)
+    try:
+        assert database.get_quote_count(-5) == 2
+        assert database.get_quote_count(-5, search='soup') == 2
+    finally:
+        database.close()
+
+
+def test_online_migrations_are_deferred(tmp_path):
+    db = sqlite3.connect(str(tmp_path / 'data.db'))
+
+    try:
+        assert migrations.migrate(db, defer_online=True) == migrations.LATEST
+        assert migrations.deferred(db) == [2]
+
+        migrations.build_deferred(db)
+        assert migrations.deferred(db) == []
+
+        indexes = {name for name, in db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index';")}
+        assert 'quote_chat_sent_by' in indexes
+    finally:
+        db.close()
+
+
+def test_newer_schema_is_refused(tmp_path):
+    db = sqlite3.connect(str(tmp_path / 'data.db'))
+    db.execute("PRAGMA user_version = {0:d};".format(migrations.LATEST + 1))
+
+    try:
+        with pytest.raises(migrations.SchemaTooNew):
+            migrations.migrate(db)
+    finally:
+        db.close()
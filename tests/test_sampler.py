@@ -0,0 +1,93 @@
+import threading
+
+from sampler import QuoteSampler
+
+
+def add_quotes(database, chat_id, count, sent_by=1):
+    for i in range(count):
+        database.add_quote(chat_id, i, 1700000000 + i, sent_by,
+            'quote {0}'.format(i), [], 3 - sent_by)
+
+
+def delete_quotes(database, chat_id, message_ids):
+    db = database.shard(chat_id)
+    db.executemany("DELETE FROM quote WHERE chat_id = ? AND message_id = ?;",
+        [(chat_id, message_id) for message_id in message_ids])
+    db.commit()
+
+
+def picks(database, chat_id, count=200, **kwargs):
+    return {database.get_random_quote(chat_id, **kwargs).quote.message_id
+        for _ in range(count)}
+
+
+def test_sample_picks_every_id():
+    sampler = QuoteSampler(lambda chat_id: [1, 2, 3])
+
+    assert {sampler.sample(-5) for _ in range(200)} == {1, 2, 3}
+    assert QuoteSampler(lambda chat_id: []).sample(-5) is None
+
+
+def test_shuffle_deals_every_id_before_repeating():
+    sampler = QuoteSampler(lambda chat_id: range(10))
+    sampler.set_shuffled(-5, True)
+
+    assert sorted(sampler.sample(-5) for _ in range(10)) == list(range(10))
+
+
+def test_quotes_added_during_a_load_are_kept():
+    loading = threading.Event()
+    release = threading.Event()
+
+    def load(chat_id):
+        loading.set()
+        release.wait()
+        return [1, 2]
+
+    sampler = QuoteSampler(load)
+    thread = threading.Thread(target=sampler.sample, args=(-5,))
+    thread.start()
+
+    loading.wait()
+    sampler.add(-5, 3)
+    release.set()
+    thread.join()
+
+    assert sampler.count(-5) == 3
+
+
+def test_deleted_quotes_are_not_picked(database):
+    add_quotes(database, -5, 10)
+    assert picks(database, -5) == set(range(10))
+
+    # The chat's index was loaded before the quotes were deleted
+    delete_quotes(database, -5, range(5))
+    assert picks(database, -5) == set(range(5, 10))
+
+
+def test_chat_with_every_quote_deleted_has_no_pick(database):
+    add_quotes(database, -5, 3)
+    database.get_random_quote(-5)
+
+    delete_quotes(database, -5, range(3))
+    assert database.get_random_quote(-5) is None
+
+
+def test_deleted_quotes_are_not_picked_by_author(database):
+    add_quotes(database, -5, 10, sent_by=1)
+    database.add_quote(-5, 100, 1700000000, 2, "bob's quote", [], 1)
+
+    assert picks(database, -5, user_id=1) == set(range(10))
+
+    delete_quotes(database, -5, range(0, 10, 2))
+    assert picks(database, -5, user_id=1) == {1, 3, 5, 7, 9}
+    assert picks(database, -5, user_id=2) == {100}
+
+
+def test_shuffled_chat_skips_deleted_quotes(database):
+    add_quotes(database, -5, 6)
+    database.sampler.set_shuffled(-5, True)
+    database.get_random_quote(-5)
+
+    delete_quotes(database, -5, [0, 1, 2])
+    assert picks(database, -5, count=20) == {3, 4, 5}
@@ -0,0 +1,46 @@
+import pytest
+
+from search import chat_token, match_query
+
+
+def test_words_are_quoted_prefixes_scoped_to_the_chat():
+    assert match_query('hot soup', -5) == \
+        'chat : "cn5" AND ("hot"* "soup"*)'
+    assert match_query('soup', 7, column='content') == \
+        'chat : "c7" AND (content : ("soup"*))'
+
+
+@pytest.mark.parametrize('search', ['', '   ', '"', '***', '- ( ) :', '^'])
+def test_input_without_words_matches_nothing(search):
+    assert match_query(search, -5) is None
+
+
+@pytest.mark.parametrize('search', [
+    'soup"', '"soup', 'soup*', 'soup AND', 'OR soup', 'NOT soup',
+    'NEAR(soup stew)', 'chat:c7 soup', 'author : soup', '{chat} soup',
+    '-soup', 'soup^', "soup's", 'sou"p',
+])
+def test_syntax_in_input_is_not_interpreted(database, search):
+    database.add_quote(-5, 1, 1700000000, 1, "soup, not stew", [], 2)
+    database.add_quote(7, 1, 1700000000, 1, "soup elsewhere", [], 2)
+
+    # Every query is valid, and only matches the chat's quotes
+    assert match_query(search, -5).count('"') % 2 == 0
+    assert database.get_quote_count(-5, search=search) in (0, 1)
+    assert database.get_quote_count(7, search=search) in (0, 1)
+
+    result = database.search_quote(-5, search)
+    assert result is None or result.quote.chat_id == -5
+
+
+def test_keywords_are_searched_as_words(database):
+    database.add_quote(-5, 1, 1700000000, 1, "NOT a soup", [], 2)
+    database.add_quote(-5, 2, 1700000000, 1, "a stew", [], 2)
+
+    assert database.get_quote_count(-5, search='not') == 1
+    assert database.get_quote_count(-5, search='NEAR') == 0
+
+
+def test_negative_chat_ids_have_their_own_token():
+    assert chat_token(-5) != chat_token(5)
+    assert chat_token(-5) == 'cn5'
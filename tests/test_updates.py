@@ -0,0 +1,94 @@
+import asyncio
+import time
+
+import pytest
+
+from database import QuoteDatabase
+from quote import CHECKPOINT_TTL, QuoteBot
+
+
+class RecordingBot(QuoteBot):
+    """Records the messages it's given instead of handling them."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__('token', *args, maintenance=False, **kwargs)
+        self.handled = []
+
+    async def _handle(self, m):
+        self.handled.append(m['message_id'])
+
+
+def update(update_id, message_id=None):
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id if message_id is None else message_id,
+        'date': 1700000000,
+        'chat': {'id': -5, 'type': 'group', 'title': 'Soup'},
+        'from': {'id': 1, 'first_name': 'Alice'},
+        'text': 'soup',
+    }}
+
+
+@pytest.fixture
+def bot_dir(tmp_path, monkeypatch):
+    # The bot reads its username, and opens data.db, in the working
+    # directory
+    (tmp_path / 'tokens').mkdir()
+    (tmp_path / 'tokens' / 'username.txt').write_text('@soupbot\n')
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def run(updates, closing_after=None, **kwargs):
+    """Hands the updates to a new bot, and returns the IDs of the messages
+    it handled."""
+    async def main():
+        bot = RecordingBot(**kwargs)
+
+        try:
+            for i, u in enumerate(updates):
+                if i == closing_after:
+                    bot._closing = True
+                await bot.handle_update(u)
+        finally:
+            bot.database.close()
+
+        return bot.handled
+
+    return asyncio.run(main())
+
+
+def test_redelivered_updates_are_skipped(bot_dir):
+    assert run([update(1), update(2), update(2), update(1)]) == [1, 2]
+
+
+def test_same_message_in_a_new_update_is_skipped(bot_dir):
+    assert run([update(1), update(2, message_id=1)]) == [1]
+
+
+def test_checkpoint_skips_updates_handled_before_a_restart(bot_dir):
+    assert run([update(10), update(11)]) == [10, 11]
+    assert run([update(10), update(11), update(12)]) == [12]
+
+
+def test_updates_dropped_while_closing_are_handled_after_restart(bot_dir):
+    assert run([update(20), update(21)], closing_after=1) == [20]
+    assert run([update(21)]) == [21]
+
+
+def test_expired_checkpoint_lets_lower_update_ids_through(bot_dir):
+    run([update(100)])
+
+    database = QuoteDatabase(write_behind=False)
+    database.db.execute("UPDATE checkpoint SET saved_at = ?;",
+        (int(time.time()) - CHECKPOINT_TTL - 1,))
+    database.db.commit()
+    database.close()
+
+    assert run([update(5), update(6)]) == [5, 6]
+
+
+def test_without_checkpoint_only_recent_updates_are_skipped(bot_dir):
+    run([update(30)])
+
+    assert run([update(30), update(31), update(31)], checkpoint=None) == \
+        [30, 31]
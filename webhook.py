@@ -0,0 +1,145 @@
+"""Receives updates through a webhook, instead of polling getUpdates.
+
+Telegram POSTs each update as JSON, with the secret token that the webhook
+was registered with in the X-Telegram-Bot-Api-Secret-Token header; requests
+without it are refused. Arrays of updates are accepted too, so that recorded
+updates can be replayed locally:
+
+    curl -H "X-Telegram-Bot-Api-Secret-Token: $(cat tokens/webhook.txt)" \\
+        --data @updates.json http://127.0.0.1:8443/
+
+Updates are answered as soon as they're queued, and handed to the bot in
+order. When the queue is full, requests wait for room, which slows
+Telegram down instead of dropping updates."""
+import asyncio
+import hmac
+import json
+import logging
+import os
+import secrets
+import time
+
+from aiohttp import web
+
+
+log = logging.getLogger('soup.webhook')
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+# Updates that can be waiting to be handed to the bot, and updates that the
+# bot can be handling at once
+MAX_QUEUED = 1000
+CONCURRENCY = 256
+
+
+def load_secret(filename):
+    """Returns the webhook's secret token, generating it the first time.
+    Instances behind a load balancer have to share the file."""
+    try:
+        with open(filename, 'r') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+
+    secret = secrets.token_urlsafe(32)
+
+    with open(filename, 'w') as f:
+        f.write(secret)
+    os.chmod(filename, 0o600)
+
+    return secret
+
+
+async def register(bot, url, secret):
+    """Asks Telegram to send updates to the URL, with the secret token."""
+    return await bot._api_request('setWebhook', {
+        'url': url,
+        'secret_token': secret,
+        'allowed_updates': ['message', 'edited_message'],
+    })
+
+
+class WebhookServer:
+    def __init__(self, handle, secret, metrics, max_queued=MAX_QUEUED,
+            concurrency=CONCURRENCY):
+        # handle(update) is a coroutine function that handles an update
+        self.handle = handle
+        self.secret = secret
+        self.metrics = metrics
+
+        self.queue = asyncio.Queue(max_queued)
+        self._handling = asyncio.Semaphore(concurrency)
+        self._runner = None
+        self._dispatcher = None
+
+        metrics.describe('webhook_requests_total',
+            "Webhook requests, by response status")
+        metrics.describe('webhook_queue_seconds',
+            "Time that updates waited to be handed to the bot")
+
+        metrics.gauge('webhook_queued', self.queue.qsize)
+
+    async def receive(self, request):
+        token = request.headers.get(SECRET_HEADER, '').encode('utf8')
+        if not hmac.compare_digest(token, self.secret.encode('utf8')):
+            self.metrics.inc('webhook_requests_total', status=403)
+            return web.Response(status=403)
+
+        try:
+            data = json.loads(await request.read())
+        except ValueError:
+            self.metrics.inc('webhook_requests_total', status=400)
+            return web.Response(status=400)
+
+        updates = data if isinstance(data, list) else [data]
+        received = time.monotonic()
+
+        for update in updates:
+            if isinstance(update, dict):
+                await self.queue.put((received, update))
+
+        self.metrics.inc('webhook_requests_total', status=200)
+        return web.Response()
+
+    async def _dispatch(self):
+        # Updates are handed over in order, and the bot handles each chat's
+        # updates in the order they were handed over
+        while True:
+            received, update = await self.queue.get()
+            await self._handling.acquire()
+
+            self.metrics.observe('webhook_queue_seconds',
+                time.monotonic() - received)
+
+            task = asyncio.ensure_future(self.handle(update))
+            task.add_done_callback(self._handled)
+
+    def _handled(self, task):
+        self._handling.release()
+        self.queue.task_done()
+
+        if not task.cancelled() and task.exception() is not None:
+            log.error("couldn't handle an update", exc_info=task.exception())
+
+    async def start(self, host, port):
+        """Starts accepting updates on the port, at any path."""
+        app = web.Application()
+        app.router.add_post('/{path:.*}', self.receive)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+        self._dispatcher = asyncio.ensure_future(self._dispatch())
+
+        log.info("receiving updates on %s:%d", host, port)
+
+    async def stop(self):
+        """Stops accepting updates, and hands the queued ones to the bot."""
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+        await self.queue.join()
+
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
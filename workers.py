@@ -0,0 +1,267 @@
+"""Runs the bot as a supervisor process, which fetches updates, and worker
+processes, which handle them.
+
+Each chat is handled by one worker, picked by the chat's ID, so messages in a
+chat are handled in order and each chat's caches live in one process. Workers
+that exit are restarted, and read the updates that were queued for them."""
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import sqlite3
+import threading
+import time
+
+import migrations
+from metrics import Metrics, serve, write_periodically
+from outbox import GLOBAL_RATE
+from telegram import Bot
+
+
+log = logging.getLogger('soup.workers')
+
+# Seconds between checks for workers that exited
+CHECK_INTERVAL = 1
+
+# Workers that exit sooner than this after starting are restarted after a
+# delay, which doubles each time, up to MAX_RESTART_DELAY seconds
+MIN_UPTIME = 30
+MAX_RESTART_DELAY = 60
+
+# Seconds that workers get to finish their queued updates when stopping
+STOP_TIMEOUT = 30
+
+
+def worker_metrics_file(filename, index):
+    root, extension = os.path.splitext(filename)
+    return '{0}-worker{1}{2}'.format(root, index, extension)
+
+
+def run_worker(index, token, updates, received, options):
+    """Handles the updates sent to one worker until it receives None."""
+    # The supervisor handles signals, and stops workers through their pipes
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    logging.basicConfig(level=logging.INFO,
+        format='worker {0}: %(levelname)s:%(name)s:%(message)s'.format(index))
+
+    # quote imports this module, so it's imported once the process started
+    from quote import QuoteBot
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    # Telegram's global rate limit is shared between the workers, and each
+    # worker saves the last update that it handled. The first worker
+    # maintains the database.
+    bot = QuoteBot(token, loop=loop, shards=options['shards'], shared=True,
+        send_rate=GLOBAL_RATE / options['workers'],
+        checkpoint='last_update_id.worker{0}'.format(index),
+        compress=options['compress'], maintenance=index == 0)
+    loop.run_until_complete(bot.start())
+
+    if options['metrics_port'] is not None:
+        serve(bot.metrics, options['metrics_port'] + 1 + index)
+
+    if options['metrics_file'] is not None:
+        write_periodically(bot.metrics,
+            worker_metrics_file(options['metrics_file'], index))
+
+    async def receive():
+        while True:
+            try:
+                update = await loop.run_in_executor(None, updates.recv)
+            except EOFError:
+                return
+
+            if update is None:
+                return
+
+            received.value += 1
+            bot.on_update(update)
+
+    try:
+        loop.run_until_complete(receive())
+    finally:
+        loop.run_until_complete(bot.shutdown())
+        loop.close()
+
+
+class Supervisor:
+    def __init__(self, token, workers, options, metrics):
+        self.token = token
+        self.options = options
+        self.metrics = metrics
+
+        # Spawned workers don't inherit the supervisor's event loop or
+        # threads
+        self.context = multiprocessing.get_context('spawn')
+
+        # Each worker reads from its own pipe, which outlives the worker, so
+        # a restarted worker reads the updates that were already sent. Unlike
+        # multiprocessing.Queue, a pipe has no lock for a killed reader to
+        # leave held.
+        self.pipes = [self.context.Pipe(duplex=False)
+            for _ in range(workers)]
+        self.pending = [queue.Queue() for _ in range(workers)]
+
+        # Updates routed to each worker, and read by it
+        self.routed = [0] * workers
+        self.received = [self.context.RawValue('q', 0)
+            for _ in range(workers)]
+
+        self.processes = [None] * workers
+        self.started = [0.0] * workers
+        self.failures = [0] * workers
+        self.restart_at = [None] * workers
+
+        self._closing = False
+
+        metrics.describe('worker_queue_depth',
+            "Updates waiting to be read by each worker")
+        metrics.describe('updates_routed_total',
+            "Updates sent to each worker")
+        metrics.describe('worker_restarts_total',
+            "Times each worker was restarted after exiting")
+
+        for i in range(workers):
+            metrics.gauge('worker_queue_depth',
+                lambda i=i: self.routed[i] - self.received[i].value,
+                worker=i)
+            metrics.gauge('worker_up',
+                lambda i=i: int(self.processes[i] is not None
+                    and self.processes[i].is_alive()),
+                worker=i)
+
+        # Sending blocks while a pipe is full, so each pipe is written by a
+        # thread instead of the event loop
+        self.feeders = [threading.Thread(target=self._feed, args=(i,),
+            name='feeder-{0}'.format(i), daemon=True)
+            for i in range(workers)]
+
+    def _feed(self, i):
+        _, sender = self.pipes[i]
+
+        while True:
+            update = self.pending[i].get()
+            sender.send(update)
+
+            if update is None:
+                return
+
+    def start_worker(self, i):
+        receiver, _ = self.pipes[i]
+
+        process = self.context.Process(target=run_worker,
+            args=(i, self.token, receiver, self.received[i], self.options),
+            name='worker-{0}'.format(i))
+        process.start()
+
+        self.processes[i] = process
+        self.started[i] = time.monotonic()
+        self.restart_at[i] = None
+
+    def start(self):
+        for i, feeder in enumerate(self.feeders):
+            feeder.start()
+            self.start_worker(i)
+
+    def route(self, update):
+        """Sends an update to the worker that handles its chat."""
+        m = update.get('message') or update.get('edited_message')
+        if m is None or 'chat' not in m:
+            return
+
+        i = m['chat']['id'] % len(self.pending)
+        self.routed[i] += 1
+        self.pending[i].put(update)
+        self.metrics.inc('updates_routed_total', worker=i)
+
+    async def watch(self):
+        """Restarts workers that exited."""
+        while not self._closing:
+            await asyncio.sleep(CHECK_INTERVAL)
+            now = time.monotonic()
+
+            for i, process in enumerate(self.processes):
+                if self._closing or process.is_alive():
+                    continue
+
+                if self.restart_at[i] is None:
+                    if now - self.started[i] < MIN_UPTIME:
+                        self.failures[i] += 1
+                    else:
+                        self.failures[i] = 0
+
+                    delay = 0
+                    if self.failures[i]:
+                        delay = min(2 ** (self.failures[i] - 1),
+                            MAX_RESTART_DELAY)
+
+                    log.warning("worker %d exited with code %s, restarting "
+                        "in %d s", i, process.exitcode, delay)
+                    self.restart_at[i] = now + delay
+
+                if now >= self.restart_at[i]:
+                    self.metrics.inc('worker_restarts_total', worker=i)
+                    self.start_worker(i)
+
+    def stop(self):
+        """Lets the workers finish their queued updates, then stops them."""
+        self._closing = True
+
+        for pending in self.pending:
+            pending.put(None)
+
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for process in self.processes:
+            process.join(max(deadline - time.monotonic(), 0))
+
+            if process.is_alive():
+                log.warning("worker %s didn't stop in time", process.name)
+                process.terminate()
+
+
+def supervise(token, workers, options):
+    """Fetches updates and hands them to worker processes until SIGINT or
+    SIGTERM."""
+    # Check the schema once, instead of letting every worker fail to start
+    db = sqlite3.connect('data.db')
+    try:
+        migrations.check_version(db)
+    finally:
+        db.close()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    metrics = Metrics()
+    supervisor = Supervisor(token, workers, options, metrics)
+    supervisor.start()
+
+    if options['metrics_port'] is not None:
+        serve(metrics, options['metrics_port'])
+
+    if options['metrics_file'] is not None:
+        write_periodically(metrics, options['metrics_file'])
+
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    # The client's HTTP session is created in this loop, on first use
+    bot = Bot(token, loop=loop)
+    updates = loop.create_task(bot.poll(supervisor.route))
+    watcher = loop.create_task(supervisor.watch())
+
+    try:
+        loop.run_until_complete(stop.wait())
+    finally:
+        updates.cancel()
+        watcher.cancel()
+        supervisor.stop()
+        loop.run_until_complete(bot.close())
+        loop.close()
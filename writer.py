@@ -0,0 +1,165 @@
+import threading
+import time
+import traceback
+
+
+class WriteBehindQueue:
+    """Collects user, chat, membership, browsing state and checkpoint upserts
+    and writes them from a background thread, in batches, so that each
+    message doesn't pay for its own commit.
+
+    Pending writes are coalesced: if a user sends several messages before the
+    next batch is written, only their latest data is written."""
+
+    def __init__(self, write, max_batch=500, interval=1.0):
+        # write(users, chats, memberships, states, checkpoints) writes a batch
+        # in one transaction
+        self.write = write
+        self.max_batch = max_batch
+        self.interval = interval
+
+        self._users = dict()
+        self._chats = dict()
+        self._memberships = set()
+        self._states = dict()
+        self._checkpoints = dict()
+        self._first_queued = None
+
+        self._condition = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._closed = False
+
+        self._thread = threading.Thread(
+            target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        return (len(self._users) + len(self._chats) + len(self._memberships)
+            + len(self._states) + len(self._checkpoints))
+
+    def _queued(self):
+        # Wake the writer to start the clock, or to write a full batch
+        if self._first_queued is None:
+            self._first_queued = time.monotonic()
+            self._condition.notify()
+        elif len(self) >= self.max_batch:
+            self._condition.notify()
+
+    def put_user(self, user):
+        with self._condition:
+            self._users[user.id] = user
+            self._queued()
+
+    def put_chat(self, chat):
+        with self._condition:
+            self._chats[chat.id] = chat
+            self._queued()
+
+    def put_membership(self, user_id, chat_id):
+        with self._condition:
+            self._memberships.add((user_id, chat_id))
+            self._queued()
+
+    def put_state(self, user_id, code, data):
+        with self._condition:
+            self._states[user_id] = (code, data)
+            self._queued()
+
+    def put_checkpoint(self, name, value):
+        with self._condition:
+            self._checkpoints[name] = value
+            self._queued()
+
+    def pending_state(self, user_id):
+        """Returns the user's browsing state if it hasn't been written yet,
+        or None."""
+        with self._condition:
+            return self._states.get(user_id)
+
+    def _take(self):
+        """Removes and returns everything that's pending."""
+        with self._condition:
+            batch = (list(self._users.values()), list(self._chats.values()),
+                list(self._memberships), [(user_id, code, data)
+                    for user_id, (code, data) in self._states.items()],
+                list(self._checkpoints.items()))
+
+            self._users.clear()
+            self._chats.clear()
+            self._memberships.clear()
+            self._states.clear()
+            self._checkpoints.clear()
+            self._first_queued = None
+
+        return batch
+
+    def _requeue(self, batch):
+        """Puts back a batch that couldn't be written. Anything queued since
+        it was taken is newer, and is kept instead."""
+        users, chats, memberships, states, checkpoints = batch
+
+        with self._condition:
+            for user in users:
+                self._users.setdefault(user.id, user)
+            for chat in chats:
+                self._chats.setdefault(chat.id, chat)
+            self._memberships.update(memberships)
+            for user_id, code, data in states:
+                self._states.setdefault(user_id, (code, data))
+            for name, value in checkpoints:
+                self._checkpoints.setdefault(name, value)
+
+            if len(self):
+                self._queued()
+
+    def flush(self):
+        """Writes everything that's pending, in the calling thread. If the
+        write fails, the batch stays queued and the error is raised."""
+        # Holding the write lock while taking the batch keeps batches in order
+        with self._write_lock:
+            batch = self._take()
+
+            if not any(batch):
+                return
+
+            try:
+                self.write(*batch)
+            except BaseException:
+                self._requeue(batch)
+                raise
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed:
+                    if len(self) >= self.max_batch:
+                        break
+
+                    if self._first_queued is None:
+                        self._condition.wait()
+                        continue
+
+                    remaining = (self._first_queued + self.interval
+                        - time.monotonic())
+                    if remaining <= 0:
+                        break
+
+                    self._condition.wait(remaining)
+
+                if self._closed:
+                    return
+
+            try:
+                self.flush()
+            except Exception:
+                traceback.print_exc()
+
+    def close(self):
+        """Stops the background thread and writes everything that's
+        pending."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+        self._thread.join()
+        self.flush()